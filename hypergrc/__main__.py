@@ -20,20 +20,30 @@ if (sys.version_info.major < 3) or (sys.version_info.major == 3 and sys.version_
 
 ###########################################################
 
-import os
-import time
 import argparse
 import http.server
 import socketserver
 
+# `python -m hypergrc export ...` exports documents for projects without
+# starting the HTTP server. See export.py.
+if len(sys.argv) > 1 and sys.argv[1] == "export":
+  from .export import main
+  sys.exit(main(sys.argv[2:]))
+
 from .routes import PROJECT_LIST, ROUTES
+from . import repos, watcher
 
 # Read command-line arguments.
 
 parser = argparse.ArgumentParser(description='hyperGRC')
 parser.add_argument('--bind', default="localhost:8000", help='[host:]port to bind to')
 parser.add_argument('--showaddress', default=None, help='The address to recommend the user visit.')
-parser.add_argument('project', nargs="*", default=["@repos.conf"], help='Path to a directory containing an opencontrol.yaml file for a system. Specify more than once to edit multiple system projects. Precede with an @-sign to read a list of directories from a newline-delimited text file.')
+parser.add_argument('--index-db', default=None, metavar='PATH', help='Keep a persistent index of the projects in a SQLite database at PATH for faster searches and restarts.')
+parser.add_argument('--write-behind', type=float, default=None, metavar='SECONDS', help='Hold changes to data files in memory and write each file once no more changes have been made to it for SECONDS.')
+parser.add_argument('--watch-interval', type=float, default=None, metavar='SECONDS', help='Check the data files of the projects for changes made outside of hyperGRC every SECONDS. Defaults to every {} seconds, or longer with many files.'.format(int(watcher.POLL_INTERVAL)))
+parser.add_argument('--discover-depth', type=int, default=repos.DEFAULT_DISCOVER_DEPTH, metavar='N', help='How many directories deep to look for repositories in directories given as DIR/**.')
+parser.add_argument('--discover-ignore', action='append', default=None, metavar='PATTERN', help='A directory name pattern not to look in when looking for repositories. Specify more than once for multiple patterns. Defaults to {}.'.format(" ".join(repos.DEFAULT_IGNORE_PATTERNS)))
+parser.add_argument('project', nargs="*", default=["@repos.conf"], help='Path to a directory containing an opencontrol.yaml file for a system. Specify more than once to edit multiple system projects. Precede with an @-sign to read a list of directories from a newline-delimited text file, which is reloaded when it changes. End with /** to use every directory containing an opencontrol.yaml file within a directory.')
 args = parser.parse_args()
 
 # Get the host and port to bind to, which are in '[host:]port' format.
@@ -46,28 +56,24 @@ else:
   BIND_PORT = args.bind
 
 # Read list of projects from the command-line and any @-prefixed listing files.
-# '@' prefixes are the Unixy-way of saying read a list from a file and use
-# the contents of the listing file as if they were command-line arguments.
-for project in args.project:
-  if project.startswith("@"):
-    # Read the listing file.
-    if not os.path.isfile(project[1:]):
-      fatal_error("File `{}` listing Compliance as Code repositories was not found.".format(project[1:]))
-    with open(project[1:], 'r') as f:
-      for line in f:
-        line = line.strip()
-        if line and not line.startswith("#"):
-          PROJECT_LIST.append(line)
-  else:
-    # Append this argument.
-    PROJECT_LIST.append(project)
+DISCOVER_IGNORE = args.discover_ignore if args.discover_ignore is not None else repos.DEFAULT_IGNORE_PATTERNS
+try:
+  PROJECT_LIST.extend(repos.read_project_list(args.project, args.discover_depth, DISCOVER_IGNORE))
+except ValueError as e:
+  fatal_error(str(e))
 
 # Validate that each project path is valid.
-for project in PROJECT_LIST:
-  if not os.path.isdir(project):
-    fatal_error("Path `{}` to Compliance as Code repository was not found.".format(project))
-  if not os.path.isfile(os.path.join(project, 'opencontrol.yaml')):
-    fatal_error("Path `{}` to Compliance as Code repository does not contain a file named opencontrol.yaml.".format(project))
+for error in repos.validate_project_paths(PROJECT_LIST):
+  if error:
+    fatal_error(error)
+
+# Open the index database, if one is given.
+if args.index_db:
+  from . import indexdb
+  try:
+    indexdb.open_db(args.index_db)
+  except ValueError as e:
+    fatal_error(str(e))
 
 # Define the basic HTTP server request handler which is called
 # on each HTTP request.
@@ -115,6 +121,27 @@ class Handler(http.server.SimpleHTTPRequestHandler):
       # key's value isn't multi-valued.
       self.form = { key: value[0] if len(value) == 1 else value for key, value in self.form.items() }
       return True
+    elif content_type[0] == "application/json":
+      # Read the body stream and parse it as JSON. Routes that accept JSON
+      # read it from self.json.
+      import json
+      body = self.rfile.read(content_length)
+      try:
+        self.json = json.loads(body.decode(content_type[1].get("charset", "utf-8")))
+      except ValueError:
+        return
+      self.form = { }
+      return True
+    elif content_type[0] == "multipart/form-data":
+      # File uploads aren't read here. Routes that accept uploads stream the
+      # parts of the body from self.multipart as they read them.
+      from .multipart import MultipartReader
+      try:
+        self.multipart = MultipartReader(self.rfile, content_type[1].get("boundary"), content_length)
+      except ValueError:
+        return
+      self.form = { }
+      return True
 
   # Handle a request (for something other than a static file).
   def do_request(self, method):
@@ -124,12 +151,18 @@ class Handler(http.server.SimpleHTTPRequestHandler):
 
     # Find the (first) route that can handle this request. On a match,
     # we get back a dict holding parsed parameters from the request path.
-    # See routes.py's parse_route_path_string.
-    for methods, path, route_function in ROUTES:
-      if method in methods:
-        m = path_matches(path, self.path)
-        if m is not False:
-          break
+    # See routes.py's parse_route_path_string. Some routes match a query
+    # string. If no route matches the whole path, try again without the
+    # query string, which the route function can read from self.path.
+    for request_path in (self.path, self.path.split("?", 1)[0]):
+      for methods, path, route_function in ROUTES:
+        if method in methods:
+          m = path_matches(path, request_path)
+          if m is not False:
+            break
+      else:
+        continue
+      break
     else:
       # No route matched.
       self.send_error(404, "Page not found.")
@@ -170,7 +203,7 @@ def path_matches(route_path, path):
     }
   return False
 
-# Start the HTTP server and simulated project loading
+# Start the HTTP server and load the projects
 try:
   socketserver.TCPServer.allow_reuse_address = True
   httpd = socketserver.TCPServer((BIND_HOST, int(BIND_PORT)), Handler)
@@ -178,17 +211,29 @@ try:
   COLRS2 = "\33[92m"
   COLRE = "\33[0m"
   sys.stdout.write(COLRS+"[hyperGRC] starting...\n"+COLRE)
-  time.sleep(.800)
-  for project in PROJECT_LIST:
-    sys.stdout.write(COLRS+"\r[hyperGRC] loading {}".format(project)+COLRE)
-    time.sleep(.150)
-    if len(PROJECT_LIST) > 1:
-      sys.stdout.write("\r"+(40+len(project))*' ')
-  if len(PROJECT_LIST) > 1:
-    sys.stdout.write(COLRS+"\r[hyperGRC] loading complete\n"+COLRE)
-  else:
-    sys.stdout.write(COLRS+"\n[hyperGRC] loading complete\n"+COLRE)
-  time.sleep(.800)
+
+  # Defer and coalesce writes to data files.
+  if args.write_behind is not None:
+    from . import writebehind
+    writebehind.enable(args.write_behind)
+
+  # Load every project in parallel in the background while the server starts
+  # serving requests. /healthz/ready reports when loading is complete. Then
+  # start the background services that read every project, which are fast
+  # once the projects are loaded: watching the projects' data files for
+  # changes made outside of hyperGRC and the listing files for repositories
+  # being added or removed, and indexing the projects in the index database.
+  from . import warmup
+  def start_services():
+    repos.watch(PROJECT_LIST, args.project, args.discover_depth, DISCOVER_IGNORE)
+    repos.add_listener(warmup.on_projects_changed)
+    watcher.start(PROJECT_LIST, args.watch_interval)
+    if args.index_db:
+      from . import indexdb
+      indexdb.start(PROJECT_LIST)
+      repos.add_listener(indexdb.update_projects)
+  warmup.start(PROJECT_LIST, then=start_services)
+
   sys.stdout.write(COLRS+"[hyperGRC] `Control-C` to stop\n"+COLRE)
   
   url = args.showaddress or "http://{}:{}".format(BIND_HOST, BIND_PORT)
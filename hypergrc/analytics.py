@@ -0,0 +1,304 @@
+# Statistics about the control narratives in all of the loaded projects, for
+# the portfolio dashboard.
+#
+# Each narrative part is a row. The per-row data that the dashboard aggregates
+# is kept in columns (typed arrays) rather than in a dict per narrative: the
+# word count, the implementation status, the control family, and the
+# component, with statuses, families, and components stored as small integer
+# codes. Totals by component, family, and status are kept up to date in a
+# small table as rows are added and removed, so most of the dashboard is read
+# from it directly. Word-count histograms and the list of thin narratives make
+# a single pass over the columns using iterator functions that run in C.
+#
+# When hyperGRC writes to a data file (see opencontrol.notify_file_changed),
+# only the rows for the components read from that file are replaced.
+
+import bisect
+import heapq
+import itertools
+import os.path
+import threading
+from array import array
+from collections import Counter
+
+from . import opencontrol
+from .statistics import count_words
+
+# The lower bounds of the word-count histogram's buckets.
+WORD_COUNT_BUCKETS = (0, 1, 10, 25, 50, 100, 200, 400, 800)
+
+# Narratives with fewer words than this are listed as thin narratives.
+THIN_NARRATIVE_WORDS = 10
+
+_lock = threading.RLock()
+
+# Columns, indexed by row.
+_words = array("L") # word count
+_status = array("L") # implementation status code
+_family = array("L") # family code
+_component = array("L") # component code
+_alive = bytearray() # 1 if the row is current, 0 if it was removed
+_row_info = [] # narrative metadata, for listing thin narratives
+
+# Codes for statuses, families, and components, and what they stand for.
+_status_codes = { }
+_statuses = []
+_family_codes = { }
+_families = [] # family code => (standard ID, family ID, family name)
+_component_codes = { }
+_components = [] # component code => { "key": (project path, component ID), "project": project JSON, "component": component JSON }
+
+_component_rows = { } # component code => [rows]
+_totals = { } # (component code, family code, status code) => [narratives, words]
+_files = { } # source file => set of component codes, or None for project-level files
+_projects = { } # project path => set of source files
+
+def get_code(codes, values, key, value=None):
+  # Return the integer code for key, assigning the next code if key is new.
+  if key not in codes:
+    codes[key] = len(values)
+    values.append(value if value is not None else key)
+  return codes[key]
+
+#############################
+# Indexing
+#############################
+
+def add_row(component_code, controlimpl):
+  # Add a narrative part as a new row. Must be called with _lock held.
+  words = count_words(controlimpl["narrative"])
+  status = get_code(_status_codes, _statuses, controlimpl["implementation_status"] or "")
+  family_key = (controlimpl["standard"]["id"], controlimpl["family"]["id"])
+  family = get_code(_family_codes, _families, family_key, family_key + (controlimpl["family"].get("name") or controlimpl["family"]["id"],))
+
+  _words.append(words)
+  _status.append(status)
+  _family.append(family)
+  _component.append(component_code)
+  _alive.append(1)
+  _row_info.append({
+    "control": {
+      "id": controlimpl["control"]["id"],
+      "number": controlimpl["control"]["number"],
+      "name": controlimpl["control"].get("name"),
+      "url": controlimpl["control"]["url"],
+    },
+    "control_part": controlimpl["control_part"],
+  })
+  totals = _totals.setdefault((component_code, family, status), [0, 0])
+  totals[0] += 1
+  totals[1] += words
+  return len(_words) - 1
+
+def remove_row(row):
+  # Mark a row as removed and take it out of the totals. Must be called with
+  # _lock held.
+  _alive[row] = 0
+  key = (_component[row], _family[row], _status[row])
+  totals = _totals[key]
+  totals[0] -= 1
+  totals[1] -= _words[row]
+  if totals[0] == 0:
+    del _totals[key]
+
+def compact():
+  # Drop removed rows from the columns once they are most of the rows, and
+  # renumber the rows. Must be called with _lock held.
+  global _words, _status, _family, _component, _alive, _row_info
+  if len(_alive) < 1000 or _alive.count(1) * 2 > len(_alive):
+    return
+  renumber = { }
+  for new_row, old_row in enumerate(itertools.compress(range(len(_alive)), _alive)):
+    renumber[old_row] = new_row
+  _words = array("L", itertools.compress(_words, _alive))
+  _status = array("L", itertools.compress(_status, _alive))
+  _family = array("L", itertools.compress(_family, _alive))
+  _component = array("L", itertools.compress(_component, _alive))
+  _row_info = list(itertools.compress(_row_info, _alive))
+  _alive = bytearray(b"\1" * len(_words))
+  for component_code, rows in _component_rows.items():
+    _component_rows[component_code] = [renumber[row] for row in rows]
+
+def index_component(project, component, standards):
+  # Replace the rows for a component. Must be called with _lock held.
+  key = (project["path"], component["id"])
+  component_code = get_code(_component_codes, _components, key, { })
+  _components[component_code] = {
+    "key": key,
+    "project": opencontrol.get_project_json(project),
+    "component": opencontrol.get_component_json(component),
+  }
+  for row in _component_rows.get(component_code, []):
+    remove_row(row)
+  _component_rows[component_code] = [
+    add_row(component_code, controlimpl)
+    for controlimpl in opencontrol.load_project_component_controls(component, standards)
+  ]
+  for fn in opencontrol.get_component_source_files(component):
+    _files.setdefault(fn, set()).add(component_code)
+    _projects[project["path"]].add(fn)
+  return component_code
+
+def index_project(project_dir):
+  # Add all of the narratives in a project, replacing any that are already
+  # indexed. Must be called with _lock held.
+  remove_project(project_dir)
+  project = opencontrol.load_project_from_path(project_dir)
+  standards = opencontrol.load_project_standards(project)
+  source_files = _projects[project_dir] = set()
+
+  # Changes to the system file or the standards re-index the whole project.
+  for fn in [os.path.join(project_dir, "opencontrol.yaml")] + opencontrol.get_project_standard_files(project):
+    fn = os.path.normpath(fn)
+    _files[fn] = None
+    source_files.add(fn)
+
+  for component in opencontrol.load_project_components(project):
+    index_component(project, component, standards)
+  compact()
+
+def remove_project(project_dir):
+  # Remove a project's narratives. Must be called with _lock held.
+  for (project_path, component_id), component_code in _component_codes.items():
+    if project_path == project_dir:
+      for row in _component_rows.pop(component_code, []):
+        remove_row(row)
+  for fn in _projects.pop(project_dir, []):
+    _files.pop(fn, None)
+
+def reindex_file(fn):
+  # Replace the rows for the components read from a source file that has
+  # changed. This is registered as an opencontrol change listener.
+  with _lock:
+    if _files.get(fn):
+      for component_code in list(_files[fn]):
+        project_dir, component_id = _components[component_code]["key"]
+        project = opencontrol.load_project_from_path(project_dir)
+        try:
+          component = opencontrol.load_project_component(project, component_id)
+        except ValueError:
+          # The component is gone. Re-index the whole project.
+          index_project(project_dir)
+          return
+        index_component(project, component, opencontrol.load_project_standards(project))
+      compact()
+      return
+
+    # This is a project-level file or a file we don't know about, like a new
+    # component. Re-index the project that contains it, if any.
+    for project_dir in list(_projects):
+      if fn in _projects[project_dir] \
+        or os.path.abspath(fn).startswith(os.path.join(os.path.abspath(project_dir), "")):
+        index_project(project_dir)
+
+opencontrol.add_change_listener(reindex_file)
+
+def ensure_projects(project_dirs):
+  # Make the index hold exactly the given projects, indexing projects that
+  # haven't been indexed yet. Projects that fail to load are skipped.
+  with _lock:
+    for project_dir in set(_projects) - set(project_dirs):
+      remove_project(project_dir)
+    for project_dir in project_dirs:
+      if project_dir not in _projects:
+        try:
+          index_project(project_dir)
+        except ValueError:
+          import traceback
+          traceback.print_exc()
+
+#############################
+# Aggregates
+#############################
+
+def get_status_counts(counts):
+  # Turn a Counter of status codes into a dict of status names, labeling
+  # the empty status "Not specified" like the component statistics do.
+  return {
+    (_statuses[status] or "Not specified"): count
+    for status, count in sorted(counts.items(), key = lambda item : -item[1])
+  }
+
+def get_group_json(totals):
+  # totals is [narratives, words, Counter of status codes].
+  narratives, words, status_counts = totals
+  return {
+    "narratives": narratives,
+    "words": words,
+    "average_words": round(words / narratives, 1) if narratives else 0,
+    "implementation_status_counts": get_status_counts(status_counts),
+  }
+
+def get_dashboard(thin_words=THIN_NARRATIVE_WORDS, limit=100):
+  # Return the portfolio statistics: status counts and word counts overall and
+  # by project, component, and family, a histogram of narrative word counts,
+  # and the narratives with fewer than thin_words words (at most limit of them,
+  # shortest first).
+  import time
+  start_time = time.time()
+  with _lock:
+    # Roll up the totals table by project, component, and family.
+    overall = [0, 0, Counter()]
+    by_project = { }
+    by_component = { }
+    by_family = { }
+    for (component_code, family_code, status_code), (narratives, words) in _totals.items():
+      info = _components[component_code]
+      for groups, key in ((None, None), (by_project, info["key"][0]), (by_component, component_code), (by_family, family_code)):
+        group = overall if groups is None else groups.setdefault(key, [0, 0, Counter()])
+        group[0] += narratives
+        group[1] += words
+        group[2][status_code] += narratives
+
+    # Make a histogram of word counts in one pass over the word count column.
+    bucket_counts = Counter(map(
+      lambda words : bisect.bisect_right(WORD_COUNT_BUCKETS, words) - 1,
+      itertools.compress(_words, _alive)))
+    histogram = [
+      {
+        "min": low,
+        "max": (WORD_COUNT_BUCKETS[i+1] - 1) if i + 1 < len(WORD_COUNT_BUCKETS) else None,
+        "count": bucket_counts.get(i, 0),
+      }
+      for i, low in enumerate(WORD_COUNT_BUCKETS)
+    ]
+
+    # Find the shortest narratives.
+    thin = [
+      (words, row)
+      for words, row in heapq.nsmallest(limit, itertools.compress(zip(_words, range(len(_words))), _alive))
+      if words < thin_words
+    ]
+    thin_narratives = [
+      dict(_row_info[row],
+           words=words,
+           project=_components[_component[row]]["project"],
+           component=_components[_component[row]]["component"],
+           implementation_status=_statuses[_status[row]])
+      for words, row in thin
+    ]
+
+    projects = {
+      info["key"][0]: info["project"]
+      for component_code, info in enumerate(_components)
+      if component_code in by_component
+    }
+    return {
+      "totals": get_group_json(overall),
+      "word_count_histogram": histogram,
+      "projects": sorted([
+        dict(get_group_json(totals), project=projects[project_path])
+        for project_path, totals in by_project.items()
+      ], key = lambda item : item["project"]["title"]),
+      "components": sorted([
+        dict(get_group_json(totals), project=_components[component_code]["project"], component=_components[component_code]["component"])
+        for component_code, totals in by_component.items()
+      ], key = lambda item : (item["project"]["title"], item["component"]["name"])),
+      "families": sorted([
+        dict(get_group_json(totals), standard=_families[family_code][0], id=_families[family_code][1], name=_families[family_code][2])
+        for family_code, totals in by_family.items()
+      ], key = lambda item : (item["standard"], item["id"])),
+      "thin_narratives": thin_narratives,
+      "thin_narrative_words": thin_words,
+      "seconds": round(time.time() - start_time, 4),
+    }
@@ -1,53 +1,91 @@
-# Construct govready-q compliance app.yaml file 
+# Construct govready-q compliance app.yaml file
+#
+# The export lists the metadata for each project and component once, and then
+# has one compact entry per control narrative part that refers to its project
+# and component by key. (Control implementations hold the whole component,
+# which holds the whole project, so dumping them directly repeats that
+# metadata for every narrative part.) The output is generated as a stream of
+# text chunks, which the app.json route writes to the response as they are
+# generated. build_app joins the chunks for callers that need the whole
+# export, such as the app.yaml page, which shows it in a template.
+
+import json
 
-from . import opencontrol
 import rtyaml
 
-def build_app(component, options):
-
-  # create buffer for output
-  from io import StringIO
-  buf = StringIO()
-
-  # Load the standards in use by this project.
-  # standards = opencontrol.load_project_standards(project)
-
-  # Collect all of the control narratives.
-  # narratives = []
-  # for component in opencontrol.load_project_components(project):
-  #   # Iterate over its controls...
-  #   for controlimpl in opencontrol.load_project_component_controls(component, standards):
-  #     # If only one control family is requested, then skip others.
-  #     if options.get("only-family"):
-  #       if controlimpl["family"]["abbrev"] != options["only-family"]:
-  #         continue
-
-  #     # Add the narrative to the list of narratives to output.
-  #     narratives.append(controlimpl)
-
-  # # Sort the narratives by standard, family, control, part, and then by component.
-  # narratives.sort(key = lambda narrative : (
-  #   narrative["standard"]["name"],
-  #   narrative["family"]["sort_key"],
-  #   narrative["control"]["sort_key"],
-  #   narrative["control_part"] is not None, # narratives for the null part go first
-  #   narrative["control_part"],
-  #   narrative["component"]["name"] )
-  # )
-
-  # Dump the component information to app.yaml
-#   import csv
-#   csvwriter = csv.writer(buf, delimiter=',',quotechar='"', quoting=csv.QUOTE_MINIMAL)
-#   csvwriter.writerow(["Control", "Control Part", "Standard Name", "Component Name", "Control Narrative"])
-#   for narrative in narratives:
-# #    if narrative["control_part"] is not None:
-#       csvwriter.writerow([narrative["control"]["id"],
-#                           narrative["control_part"],
-#                           narrative["standard"]["name"],
-#                           narrative["component"]["name"],
-#                           narrative["narrative"].strip()
-#                           ])
-  # buf.write(component)
-  # return buf.getvalue()
-  # print("componenyaml\n", rtyaml.dump(component))
-  return rtyaml.dump(component)
\ No newline at end of file
+def get_project_metadata(project):
+  # The project fields that are useful outside of hyperGRC. We leave out
+  # local disk paths.
+  return {
+    "title": project["title"],
+    "description": project["description"],
+    "organization": {
+      "name": project["organization"]["name"],
+      "abbreviation": project["organization"]["abbreviation"],
+    },
+    "authorization_id": project["authorization_id"],
+    "source_repository": project["source_repository"],
+  }
+
+def get_component_metadata(component):
+  return {
+    "name": component["name"],
+    "project": component["project"]["id"],
+  }
+
+def get_control_entry(controlimpl):
+  return {
+    "component": controlimpl["component"]["id"],
+    "standard": controlimpl["standard"]["id"],
+    "control": controlimpl["control"]["id"],
+    "control_name": controlimpl["control"].get("name") or None,
+    "family": controlimpl["family"]["id"],
+    "control_part": controlimpl["control_part"],
+    "implementation_status": controlimpl["implementation_status"] or None,
+    "narrative": controlimpl["narrative"],
+  }
+
+def get_metadata(controlimpls):
+  # Collect the distinct projects and components of the control implementations,
+  # keyed by their IDs, in the order that they first appear.
+  from collections import OrderedDict
+  projects = OrderedDict()
+  components = OrderedDict()
+  for controlimpl in controlimpls:
+    component = controlimpl["component"]
+    projects.setdefault(component["project"]["id"], get_project_metadata(component["project"]))
+    components.setdefault(component["id"], get_component_metadata(component))
+  return projects, components
+
+def iter_app_yaml(controlimpls):
+  # Yield the YAML export in chunks. Each control entry is dumped as a one-item
+  # list so that the chunks concatenate into a single YAML list.
+  from collections import OrderedDict
+  projects, components = get_metadata(controlimpls)
+  yield rtyaml.dump(OrderedDict([
+    ("projects", projects),
+    ("components", components),
+  ]))
+  if not controlimpls:
+    yield "controls: []\n"
+    return
+  yield "controls:\n"
+  for controlimpl in controlimpls:
+    yield rtyaml.dump([get_control_entry(controlimpl)])
+
+def iter_app_json(controlimpls):
+  # Yield the compact JSON export in chunks.
+  projects, components = get_metadata(controlimpls)
+  yield '{"projects":' + json.dumps(projects, separators=(',', ':'))
+  yield ',"components":' + json.dumps(components, separators=(',', ':'))
+  yield ',"controls":['
+  for i, controlimpl in enumerate(controlimpls):
+    yield ("," if i > 0 else "") + json.dumps(get_control_entry(controlimpl), separators=(',', ':'))
+  yield ']}'
+
+def build_app(controlimpls, options):
+  # Return the export as a string. options may set "format" to "yaml" (the
+  # default) or "json".
+  if (options or {}).get("format") == "json":
+    return "".join(iter_app_json(controlimpls))
+  return "".join(iter_app_yaml(controlimpls))
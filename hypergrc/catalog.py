@@ -0,0 +1,141 @@
+# Indexes over the controls defined in standards, for choosing a control when
+# adding a control implementation to a component.
+#
+# Standards are large (NIST SP 800-53 has about 900 controls) but rarely
+# change, so the indexes are built once per standard file and rebuilt only
+# when the file's content hash changes.
+
+import os.path
+import re
+import threading
+
+from . import opencontrol
+
+_lock = threading.Lock()
+
+# Indexes for each standard file, keyed by the file's path. Each value is a
+# dict holding the file's content hash, the loaded standard, and the indexes.
+_standard_indexes = { }
+
+def get_standard_index(standard_fn):
+  # Return the indexes for a standard file, loading the standard and building
+  # the indexes if the file has changed since they were last built.
+  standard_fn = os.path.normpath(standard_fn)
+  digest = opencontrol.get_file_digest(standard_fn)
+  with _lock:
+    if standard_fn not in _standard_indexes or _standard_indexes[standard_fn]["digest"] != digest:
+      standards = { }
+      opencontrol.load_standard(standard_fn, "1.0.0", standards)
+      standard = list(standards.values())[0]
+      _standard_indexes[standard_fn] = {
+        "digest": digest,
+        "standard": standard,
+        "trie": build_trie(standard),
+        "catalog_json": build_catalog_json(standard),
+      }
+    return _standard_indexes[standard_fn]
+
+def get_project_standard_indexes(project):
+  # Return the indexes for each of the standards used by a project.
+  return [
+    get_standard_index(fn)
+    for fn in opencontrol.get_project_standard_files(project)
+  ]
+
+def find_standard(project, standard_key):
+  # Return the indexes for the standard with the given key used by a project.
+  # Different projects may have different standards with the same key, so
+  # standards are always looked up within a project.
+  for fn in opencontrol.get_project_standard_files(project):
+    index = get_standard_index(fn)
+    if index["standard"]["id"] == standard_key:
+      return index
+  raise ValueError("Standard {} not found in project {}.".format(standard_key, project["id"]))
+
+#############################
+# Prefix trie
+#############################
+
+# A trie node is a dict mapping characters to child nodes. The key "" holds
+# the set of the IDs of the controls with a key that starts with the prefix
+# that leads to the node, so that looking up a prefix doesn't have to walk
+# the subtree below it.
+
+def build_trie(standard):
+  # Build a trie over each control's number and name and each word in its name,
+  # all lowercased, so that e.g. "ac-2", "account", and "management" all find
+  # AC-2 Account Management.
+  root = { "": set() }
+  for control in standard["controls"].values():
+    keys = { control["number"].lower() }
+    if control.get("name"):
+      keys.add(control["name"].lower())
+      keys.update(word.lower() for word in re.findall(r"\w+", control["name"]))
+    for key in keys:
+      node = root
+      node[""].add(control["id"])
+      for c in key:
+        node = node.setdefault(c, { "": set() })
+        node[""].add(control["id"])
+  return root
+
+def find_controls(project, standard_key, prefix, family=None, limit=50):
+  # Return the controls in a standard whose number, name, or a word in whose
+  # name starts with prefix (case-insensitively), in control order, optionally
+  # only those in a control family, and at most limit controls.
+  index = find_standard(project, standard_key)
+  standard = index["standard"]
+  node = index["trie"]
+  for c in prefix.strip().lower():
+    node = node.get(c)
+    if node is None:
+      return []
+
+  controls = [standard["controls"][control_id] for control_id in node[""]]
+  if family:
+    controls = [control for control in controls if control["family"] == family]
+  controls.sort(key = lambda control : control["sort_key"])
+  return [
+    get_control_json(standard, control)
+    for control in controls[:limit]
+  ]
+
+def get_control_json(standard, control):
+  family = standard["families"].get(control["family"])
+  return {
+    "id": control["id"],
+    "number": control["number"],
+    "name": control["name"],
+    "standard": {
+      "id": standard["id"],
+      "name": standard["name"],
+    },
+    "family": {
+      "id": family["id"],
+      "name": family["name"],
+    } if family else None,
+  }
+
+#############################
+# Control catalog
+#############################
+
+def build_catalog_json(standard):
+  # Return the standard's sorted list of controls as compact JSON, encoded
+  # as bytes, ready to be sent as the catalog.json response.
+  import json
+  controls = sorted(standard["controls"].values(), key = lambda control : control["sort_key"])
+  return json.dumps(
+    [get_control_json(standard, control) for control in controls],
+    separators=(',', ':')
+  ).encode("utf8")
+
+def get_standard_api_url(project, index):
+  from urllib.parse import quote_plus
+  return "/api{}/standards/{}".format(project["url"], quote_plus(index["standard"]["id"]))
+
+def get_catalog_url(project, index):
+  # The URL to a standard's catalog.json. The URL includes the standard file's
+  # content hash so that browsers can cache it for a long time and will fetch
+  # it again when the standard changes.
+  return "{}/catalog.json?v={}".format(get_standard_api_url(project, index), index["digest"][:16])
@@ -0,0 +1,126 @@
+# Which controls each component covers, as bitsets, for comparing components.
+#
+# Each (standard, control, control part) that any component has a narrative
+# for is given a small integer ID, and a component's coverage is a Python int
+# with the bits for its controls set. Unions, intersections, and differences
+# across components are then bitwise operations on ints rather than on sets
+# of strings. (This needs no extra libraries. Python ints are arbitrary
+# precision, so a row of a thousand controls is just a thousand-bit int.)
+#
+# Each component's coverage is cached and rebuilt only when one of the files
+# it was read from, its project's system file (which lists the components), or
+# one of its project's standards changes.
+
+import os.path
+import threading
+
+from . import opencontrol
+
+_lock = threading.Lock()
+_control_ids = { } # (standard ID, control ID, control part) => bit index
+_control_keys = [] # bit index => (standard ID, control ID, control part)
+_coverage = { } # (project path, component ID) => { "fingerprint": ..., "bits": int, "controlimpls": { bit index => controlimpl } }
+
+def get_control_bit(controlimpl):
+  # Return the bit index for a control implementation's control and part,
+  # assigning a new one if the control hasn't been seen before. Must be called
+  # with _lock held.
+  key = (controlimpl["standard"]["id"], controlimpl["control"]["id"], controlimpl["control_part"])
+  if key not in _control_ids:
+    _control_ids[key] = len(_control_keys)
+    _control_keys.append(key)
+  return _control_ids[key]
+
+def get_control_key(bit):
+  return _control_keys[bit]
+
+def popcount(bits):
+  return bin(bits).count("1")
+
+def iter_bits(bits):
+  # Yield the indexes of the bits that are set, lowest first.
+  while bits:
+    low_bit = bits & -bits
+    yield low_bit.bit_length() - 1
+    bits ^= low_bit
+
+def get_component_coverage(component, standards):
+  # Return a component's coverage, a dict with "bits", the bitset of the
+  # controls it has narratives for, and "controlimpls", mapping each bit index
+  # to the component's control implementation for that control.
+  fingerprint = tuple(
+    (fn, opencontrol.get_file_digest(fn))
+    for fn in opencontrol.get_component_source_files(component)
+               + [os.path.join(component["project"]["path"], "opencontrol.yaml")]
+               + opencontrol.get_project_standard_files(component["project"])
+  )
+  cache_key = (component["project"]["path"], component["id"])
+  with _lock:
+    coverage = _coverage.get(cache_key)
+    if coverage and coverage["fingerprint"] == fingerprint:
+      return coverage
+
+  controlimpls = list(opencontrol.load_project_component_controls(component, standards))
+  with _lock:
+    coverage = { "fingerprint": fingerprint, "bits": 0, "controlimpls": { } }
+    for controlimpl in controlimpls:
+      bit = get_control_bit(controlimpl)
+      coverage["bits"] |= (1 << bit)
+      coverage["controlimpls"].setdefault(bit, controlimpl)
+    _coverage[cache_key] = coverage
+  return coverage
+
+def compare_components(components):
+  # Compare the coverage of a list of components, each a (component, standards)
+  # pair. Returns a dict with:
+  #   "controls": the bit indexes of the controls covered by any component, in
+  #     control order
+  #   "coverage": each component's coverage (see get_component_coverage)
+  #   "common": the bitset of controls covered by every component
+  #   "unique": for each component, the bitset of the controls that only it covers
+  #   "jaccard": the matrix of the pairwise Jaccard similarities of the components'
+  #     coverage (the number of controls both cover over the number either covers)
+  coverage = [get_component_coverage(component, standards) for component, standards in components]
+  rows = [c["bits"] for c in coverage]
+
+  union = 0
+  common = rows[0] if rows else 0
+  for bits in rows:
+    union |= bits
+    common &= bits
+
+  # A control is unique to a component if no other component covers it. Build
+  # the unions of the rows before and after each row so this is linear.
+  before = [0]
+  for bits in rows:
+    before.append(before[-1] | bits)
+  after = [0]
+  for bits in reversed(rows):
+    after.append(after[-1] | bits)
+  after.reverse()
+  unique = [bits & ~(before[i] | after[i+1]) for i, bits in enumerate(rows)]
+
+  counts = [popcount(bits) for bits in rows]
+  jaccard = [
+    [
+      (popcount(a & b) / (counts[i] + counts[j] - popcount(a & b))) if (a | b) else 1.0
+      for j, b in enumerate(rows)
+    ]
+    for i, a in enumerate(rows)
+  ]
+
+  # Order the controls by the sort order of the first control implementation
+  # found for each.
+  def sort_key(bit):
+    for c in coverage:
+      if bit in c["controlimpls"]:
+        return c["controlimpls"][bit]["sort_key"]
+  controls = sorted(iter_bits(union), key = sort_key)
+
+  return {
+    "controls": controls,
+    "coverage": coverage,
+    "common": common,
+    "unique": unique,
+    "jaccard": jaccard,
+  }
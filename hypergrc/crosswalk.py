@@ -0,0 +1,79 @@
+# Crosswalks between standards, so that a narrative written for a control in
+# one standard can be shown for the controls it maps to in other standards,
+# e.g. a DFARS system's NIST SP 800-171 requirements can be met by narratives
+# written for NIST SP 800-53 controls.
+#
+# A crosswalk is a YAML file listed in the "crosswalks" key of a project's
+# opencontrol.yaml file (see ref/crosswalks for an example):
+#
+#   name: ...
+#   from: standard key
+#   to: standard key
+#   mappings:
+#     control ID: [control ID, ...]
+#
+# Each crosswalk file is compiled into a list of control pairs once per content
+# hash. A project's crosswalks are combined into an index that maps each
+# (standard key, control ID) to the controls it is mapped to, in both
+# directions, so that lookups are a single dict lookup.
+
+import os.path
+import threading
+
+from . import opencontrol
+
+_lock = threading.Lock()
+_compiled = { } # crosswalk file => { "digest": content hash, "pairs": [((standard, control), (standard, control))] }
+_project_indexes = { } # project path => { "fingerprint": crosswalk file hashes, "index": index }
+
+def compile_crosswalk(fn):
+  # Return the list of control pairs in a crosswalk file, from the cache if the
+  # file hasn't changed.
+  fn = os.path.normpath(fn)
+  digest = opencontrol.get_file_digest(fn)
+  with _lock:
+    if fn in _compiled and _compiled[fn]["digest"] == digest:
+      return _compiled[fn]["pairs"]
+
+  data = opencontrol.load_opencontrol_yaml(fn, "crosswalk", None) # no schema_version is present in this file
+  if not data.get("from") or not data.get("to") or not isinstance(data.get("mappings"), dict):
+    raise ValueError("The crosswalk file {} must have 'from', 'to', and 'mappings' keys.".format(fn))
+  pairs = []
+  for from_control, to_controls in data["mappings"].items():
+    if isinstance(to_controls, str):
+      to_controls = [to_controls]
+    for to_control in (to_controls or []):
+      pairs.append(((data["from"], str(from_control)), (data["to"], str(to_control))))
+
+  with _lock:
+    _compiled[fn] = { "digest": digest, "pairs": pairs }
+  return pairs
+
+def get_project_crosswalk(project):
+  # Return the index of a project's crosswalks, a dict mapping each (standard
+  # key, control ID) that is mapped to anything to a sorted tuple of the
+  # (standard key, control ID)s it is mapped to.
+  crosswalk_files = [os.path.normpath(fn) for fn in opencontrol.get_project_crosswalk_files(project)]
+  fingerprint = tuple((fn, opencontrol.get_file_digest(fn)) for fn in crosswalk_files)
+  with _lock:
+    cached = _project_indexes.get(project["path"])
+    if cached and cached["fingerprint"] == fingerprint:
+      return cached["index"]
+
+  index = { }
+  for fn in crosswalk_files:
+    for a, b in compile_crosswalk(fn):
+      index.setdefault(a, set()).add(b)
+      index.setdefault(b, set()).add(a)
+  index = {
+    control: tuple(sorted(mapped, key = lambda c : (c[0], opencontrol.make_control_number_sort_key(c[1]))))
+    for control, mapped in index.items()
+  }
+
+  with _lock:
+    _project_indexes[project["path"]] = { "fingerprint": fingerprint, "index": index }
+  return index
+
+def get_mapped_controls(project, standard_key, control_id):
+  # Return the (standard key, control ID)s that a control is mapped to.
+  return get_project_crosswalk(project).get((standard_key, control_id), ())
@@ -1,43 +1,22 @@
 # Construct system security plans from project data in csv
 
-from . import opencontrol
+from .ssp import load_family_narratives, get_family_fingerprint, get_cached_section
 
-def build_csv(project, options):
+import threading
 
-  # create buffer for output
-  from io import StringIO
-  buf = StringIO()
+# The columns of the CSV export, which are also the columns read on import.
+CSV_COLUMNS = ["Control", "Control Part", "Standard Name", "Component Name", "Control Narrative"]
 
-  # Load the standards in use by this project.
-  standards = opencontrol.load_project_standards(project)
+# The number of dry-run imports to keep waiting to be committed. Older ones
+# are forgotten and must be uploaded again.
+MAX_PENDING_IMPORTS = 20
 
-  # Collect all of the control narratives.
-  narratives = []
-  for component in opencontrol.load_project_components(project):
-    # Iterate over its controls...
-    for controlimpl in opencontrol.load_project_component_controls(component, standards):
-      # If only one control family is requested, then skip others.
-      if options.get("only-family"):
-        if controlimpl["family"]["abbrev"] != options["only-family"]:
-          continue
-
-      # Add the narrative to the list of narratives to output.
-      narratives.append(controlimpl)
-
-  # Sort the narratives by standard, family, control, part, and then by component.
-  narratives.sort(key = lambda narrative : (
-    narrative["standard"]["name"],
-    narrative["family"]["sort_key"],
-    narrative["control"]["sort_key"],
-    narrative["control_part"] is not None, # narratives for the null part go first
-    narrative["control_part"],
-    narrative["component"]["name"] )
-  )
-
-  # Write the narratives to CSV.
+def render_family_rows(narratives):
+  # Render the CSV rows for the narratives in a single control family.
+  from io import StringIO
+  buf = StringIO()
   import csv
   csvwriter = csv.writer(buf, delimiter=',',quotechar='"', quoting=csv.QUOTE_MINIMAL)
-  csvwriter.writerow(["Control", "Control Part", "Standard Name", "Component Name", "Control Narrative"])
   for narrative in narratives:
 #    if narrative["control_part"] is not None:
       csvwriter.writerow([narrative["control"]["id"],
@@ -46,5 +25,193 @@ def build_csv(project, options):
                           narrative["component"]["name"],
                           narrative["narrative"].strip()
                           ])
+  return buf.getvalue()
+
+def build_csv(project, options):
+
+  # create buffer for output
+  from io import StringIO
+  buf = StringIO()
+
+  # Write the narratives to CSV. The rows for each control family come from
+  # the same per-family cache that the SSP uses, so only families whose source
+  # files changed are re-rendered.
+  import csv
+  csvwriter = csv.writer(buf, delimiter=',',quotechar='"', quoting=csv.QUOTE_MINIMAL)
+  csvwriter.writerow(CSV_COLUMNS)
+  families = load_family_narratives(project, options)
+  for i, (standard, family, narratives) in enumerate(families):
+    cache_key = ("csv", project["path"], standard["id"], family["id"])
+    buf.write(get_cached_section(
+      cache_key,
+      get_family_fingerprint(project, narratives),
+      lambda : render_family_rows(narratives)))
+    if options.get("progress"):
+      options["progress"](i + 1, len(families))
 
   return buf.getvalue()
+
+#############################
+# Import
+#############################
+
+_imports_lock = threading.Lock()
+_imports = { } # import ID => import
+
+def read_csv_import(project, lines):
+  # Read edited narratives from a CSV file in the format written by build_csv
+  # and work out what importing it would change, without changing anything.
+  # lines is an iterable of the file's lines (as str), which is read row by
+  # row, so the file is never held in memory. Rows are matched to control
+  # implementations through indexes by component name and by (standard,
+  # control, control part), and a component's control implementations are only
+  # loaded if a row names it. Returns an import holding the changes, which
+  # is kept until it is committed with commit_csv_import.
+  import csv, difflib, uuid
+  from . import opencontrol
+
+  reader = csv.reader(lines)
+  def read_rows():
+    try:
+      yield from reader
+    except csv.Error as e:
+      # E.g. a cell longer than csv.field_size_limit().
+      raise ValueError("Line {} of the CSV file could not be read: {}.".format(reader.line_num, e))
+  rows_iter = read_rows()
+  header = next(rows_iter, None)
+  if header is None:
+    raise ValueError("The CSV file is empty.")
+  header = [column.strip() for column in header]
+  missing = [column for column in CSV_COLUMNS if column not in header]
+  if missing:
+    raise ValueError("The CSV file is missing the column(s) {}. The first row must have the column names {}.".format(
+      ", ".join(missing), ", ".join(CSV_COLUMNS)))
+  columns = { column: header.index(column) for column in CSV_COLUMNS }
+
+  standards = opencontrol.load_project_standards(project)
+  components = { }
+  for component in opencontrol.load_project_components(project):
+    components.setdefault(component["name"], component)
+  controlimpls = { } # component name => { (standard name, control, control part) => controlimpl }
+  def get_controlimpls(component):
+    if component["name"] not in controlimpls:
+      # Index by standard name, as exported, and by standard key.
+      index = { }
+      for controlimpl in opencontrol.load_project_component_controls(component, standards):
+        for standard in (controlimpl["standard"]["name"], controlimpl["standard"]["id"]):
+          index.setdefault((standard, controlimpl["control"]["id"], controlimpl.get("control_part")), controlimpl)
+      controlimpls[component["name"]] = index
+    return controlimpls[component["name"]]
+
+  changes = { } # (component name, standard key, control, control part) => change
+  errors = []
+  rows = 0
+  unchanged = 0
+  next_line = reader.line_num + 1
+  for row in rows_iter:
+    # Report the line a row starts on. Narratives may span lines.
+    row_number, next_line = next_line, reader.line_num + 1
+    if not any(cell.strip() for cell in row):
+      continue
+    rows += 1
+    if len(row) < len(header):
+      row += [""] * (len(header) - len(row))
+    control_id, control_part, standard_name, component_name, narrative = [
+      row[columns[column]] for column in CSV_COLUMNS]
+    control_id = control_id.strip()
+    control_part = control_part.strip() or None
+    # Quoted cells keep the line endings of the program that saved the file.
+    narrative = narrative.replace("\r\n", "\n").replace("\r", "\n")
+
+    component = components.get(component_name.strip())
+    if component is None:
+      errors.append({ "row": row_number, "error": "Component {} does not exist in project {}.".format(component_name, project["id"]) })
+      continue
+    controlimpl = get_controlimpls(component).get((standard_name.strip(), control_id, control_part))
+    if controlimpl is None:
+      errors.append({ "row": row_number, "error": "{} {}{} has no narrative for component {}. Add it in hyperGRC first.".format(
+        standard_name, control_id, " part " + control_part if control_part else "", component_name) })
+      continue
+    if not narrative.strip():
+      errors.append({ "row": row_number, "error": "Narrative cannot be empty." })
+      continue
+
+    # Narratives are exported stripped, so compare them the way they'd be saved.
+    key = (component["name"], controlimpl["standard"]["id"], control_id, control_part)
+    if opencontrol.clean_text(narrative) == opencontrol.clean_text(controlimpl["narrative"] or ""):
+      unchanged += 1
+      changes.pop(key, None) # a later row undoes an earlier change
+      continue
+    changes[key] = {
+      "row": row_number,
+      "component": component["name"],
+      "standard": controlimpl["standard"]["name"],
+      "control": control_id,
+      "control_part": control_part,
+      "source_file": controlimpl["source_file"],
+      "diff": list(difflib.unified_diff(
+        (controlimpl["narrative"] or "").strip().split("\n"),
+        narrative.strip().split("\n"),
+        "current", "imported", lineterm="")),
+      # The controlimpl carries the source_file_digest of its file as read
+      # here, so the commit fails if the file changes after the dry run.
+      "controlimpl": dict(controlimpl, narrative=narrative),
+    }
+
+  csv_import = {
+    "id": uuid.uuid4().hex[:16],
+    "project": project["path"],
+    "rows": rows,
+    "unchanged": unchanged,
+    "changes": sorted(changes.values(), key=lambda change: change["row"]),
+    "errors": errors,
+    "files": sorted(set(change["source_file"] for change in changes.values())),
+    "status": "dry-run",
+  }
+  with _imports_lock:
+    _imports[csv_import["id"]] = csv_import
+    while len(_imports) > MAX_PENDING_IMPORTS:
+      del _imports[next(iter(_imports))]
+  return csv_import
+
+def get_csv_import(project, import_id):
+  with _imports_lock:
+    csv_import = _imports.get(import_id)
+  if csv_import is None or csv_import["project"] != project["path"]:
+    raise ValueError("Import {} was not found. Upload the CSV file again.".format(import_id))
+  return csv_import
+
+def commit_csv_import(csv_import):
+  # Save the changes of a dry-run import, reading and writing each source file
+  # once. The changes to a file are made only if the file hasn't changed since
+  # the dry run. Returns the import with each source file's outcome.
+  from . import opencontrol
+  with _imports_lock:
+    if csv_import["status"] != "dry-run":
+      raise ValueError("Import {} has already been committed.".format(csv_import["id"]))
+    csv_import["status"] = "committing"
+  try:
+    saved = opencontrol.update_component_controls([change["controlimpl"] for change in csv_import["changes"]])
+  except:
+    # Let the import be committed again. Files that were saved will be
+    # reported as conflicts because they changed since the dry run.
+    with _imports_lock:
+      csv_import["status"] = "dry-run"
+    raise
+  csv_import["results"] = [
+    { "source_file": source_file, "status": "ok" if outcome is True else "conflict" if isinstance(outcome, opencontrol.ConflictError) else "error",
+      "error": None if outcome is True else str(outcome) }
+    for source_file, outcome in saved.items()
+  ]
+  csv_import["status"] = "committed"
+  return csv_import
+
+def get_csv_import_json(csv_import):
+  return {
+    key: value if key != "changes" else [
+      { k: v for k, v in change.items() if k != "controlimpl" }
+      for change in value
+    ]
+    for key, value in csv_import.items()
+    if key != "project"
+  }
@@ -0,0 +1,141 @@
+# An index of the documents in each project's documents directory (currently
+# always `outputs`), so that listing documents doesn't walk the whole
+# directory tree on every request.
+#
+# The index holds each directory's files with their sizes and modification
+# times and its subdirectories. It is refreshed incrementally: each
+# directory's modification time is checked, which changes when entries are
+# added to, removed from or renamed in it, and only directories that changed
+# are listed again. A refresh stats each directory but not each file. A file
+# that is rewritten in place keeps its directory's modification time, so its
+# size and modification time in the index can be out of date until its
+# directory changes. A project's index is refreshed at most once every
+# REFRESH_INTERVAL seconds.
+
+import os
+import threading
+import time
+
+DOCUMENTS_DIR = "outputs"
+
+# Seconds between checks of a project's documents directory for changes.
+REFRESH_INTERVAL = 2.0
+
+# The document file extensions that can be downloaded.
+DOCUMENT_EXTENSIONS = [".txt", ".conf", ".csv", ".md",
+                       ".xls", ".xlsx", ".doc", ".docx", ".jpeg", ".jpg", ".png", ".gif", ".pdf"]
+
+# The ways the document list can be sorted.
+SORT_KEYS = {
+  "name": lambda doc : doc["rel_file_path"].lower(),
+  "size": lambda doc : doc["size"],
+  "modified": lambda doc : doc["mtime"],
+}
+
+_lock = threading.Lock() # guards _indexes; each index has its own lock
+_indexes = { } # project path => index
+
+def get_documents_dir(project):
+  return os.path.join(project["path"], DOCUMENTS_DIR)
+
+def scan_directory(path, rel_path):
+  # List a directory's documents and subdirectories. Returns the list of
+  # document entries and the list of subdirectory paths.
+  files = []
+  subdirs = []
+  try:
+    with os.scandir(path) as entries:
+      for entry in entries:
+        # Skip hidden files and commonly found MS Word document temp files.
+        if entry.name.startswith(".") or "~$" in entry.name:
+          continue
+        if entry.is_dir(follow_symlinks=False):
+          subdirs.append(entry.path)
+        elif entry.is_file():
+          stat = entry.stat()
+          files.append({
+            "name": entry.name,
+            "file_path": entry.path,
+            "rel_file_path": rel_path + entry.name,
+            "size": stat.st_size,
+            "mtime": stat.st_mtime,
+          })
+  except OSError:
+    pass # the directory was removed or can't be read
+  return files, subdirs
+
+def refresh_directory(index, path, rel_path, seen):
+  # Bring the index of a directory and its subdirectories up to date.
+  seen.add(path)
+  try:
+    signature = os.stat(path).st_mtime_ns
+  except OSError:
+    return
+  entry = index["dirs"].get(path)
+  if entry is None or entry["signature"] != signature:
+    files, subdirs = scan_directory(path, rel_path)
+    # A directory changed within the clock's resolution of being listed
+    # could change again without its modification time changing, so don't
+    # trust it until it's older.
+    if time.time() - signature / 1e9 < 1.0:
+      signature = None
+    entry = { "signature": signature, "files": files, "subdirs": subdirs }
+    index["dirs"][path] = entry
+    index["documents"] = None
+  for subdir in entry["subdirs"]:
+    refresh_directory(index, subdir, rel_path + os.path.basename(subdir) + "/", seen)
+
+def get_index(project):
+  # Return the project's document index, refreshed if it's due.
+  now = time.time()
+  with _lock:
+    index = _indexes.setdefault(project["path"], { "lock": threading.Lock(), "dirs": { }, "documents": None, "sorted": { }, "checked": None })
+  with index["lock"]:
+    if index["checked"] is None or now - index["checked"] >= REFRESH_INTERVAL:
+      seen = set()
+      refresh_directory(index, get_documents_dir(project), "", seen)
+      for path in set(index["dirs"]) - seen:
+        del index["dirs"][path]
+        index["documents"] = None
+      index["checked"] = now
+    if index["documents"] is None:
+      index["documents"] = {
+        doc["rel_file_path"]: doc
+        for entry in index["dirs"].values()
+        for doc in entry["files"]
+      }
+      index["sorted"] = { }
+    return index
+
+def get_documents(project):
+  # Return a dict mapping the relative path (with forward slashes) of each
+  # document in the project's documents directory to its entry.
+  return get_index(project)["documents"]
+
+def list_documents(project, sort="name", reverse=False, offset=0, limit=None):
+  # Return one page of the project's documents, sorted, and the total number
+  # of documents. Sorted lists are kept until the documents change.
+  if sort not in SORT_KEYS:
+    raise ValueError("Documents can't be sorted by {}.".format(sort))
+  index = get_index(project)
+  with index["lock"]:
+    if sort not in index["sorted"]:
+      index["sorted"][sort] = sorted(index["documents"].values(), key=SORT_KEYS[sort])
+    docs = index["sorted"][sort]
+  total = len(docs)
+  end = total if limit is None else min(total, offset + limit)
+  if reverse:
+    # Take the page from the end of the list without copying the whole list.
+    return docs[max(total - end, 0):max(total - offset, 0)][::-1], total
+  return docs[offset:end], total
+
+def get_document(project, rel_file_path):
+  # Return the entry for a document that can be downloaded. Raises ValueError
+  # if the path isn't a document in the index or isn't a document type.
+  doc = get_documents(project).get(rel_file_path)
+  if doc is None:
+    raise ValueError("Document '{}' was not found.".format(rel_file_path))
+  extension = os.path.splitext(doc["name"])[1]
+  if extension.lower() not in DOCUMENT_EXTENSIONS:
+    raise ValueError("Document type '{}' of document '{}' not supported.".format(extension, rel_file_path))
+  return doc
@@ -0,0 +1,212 @@
+# Find near-duplicate control narratives across all of the loaded projects,
+# e.g. boilerplate that was copied between components and has since drifted.
+#
+# Each narrative part is split into overlapping three-word "shingles". Two
+# narratives are near-duplicates if the Jaccard similarity of their shingle
+# sets (the size of the intersection divided by the size of the union) is at
+# least a threshold. Comparing every pair of narratives would take quadratic
+# time, so each narrative gets a MinHash signature, and the signatures are
+# split into bands. Narratives that have an identical band are candidates,
+# and only candidate pairs are compared.
+#
+# Shingles and signatures are cached per source file and are recomputed only
+# when the file's content hash changes, so re-running the report after a small
+# edit only re-hashes the narratives in the edited file.
+
+import os.path
+import random
+import re
+import threading
+import zlib
+
+from . import opencontrol
+
+# MinHash parameters. With 16 bands of 4 rows, a pair of narratives with a
+# similarity of 0.8 becomes a candidate with probability over 99.9%, and a
+# pair with a similarity of 0.6 with probability about 88%.
+NUM_HASHES = 64
+BANDS = 16
+ROWS = NUM_HASHES // BANDS
+
+# The words per shingle, and the minimum number of words in a narrative for
+# it to be compared. Very short narratives like "Not applicable." are
+# expected to repeat and would form huge clusters.
+SHINGLE_SIZE = 3
+MIN_WORDS = 8
+
+DEFAULT_THRESHOLD = 0.8
+MIN_THRESHOLD = 0.6
+
+# The hash functions are of the form (a*x + b) mod p. They are seeded so that
+# signatures are the same from run to run.
+_PRIME = (1 << 61) - 1
+_random = random.Random(0)
+_hash_params = [
+  (_random.randrange(1, _PRIME), _random.randrange(0, _PRIME))
+  for i in range(NUM_HASHES)
+]
+
+_lock = threading.Lock()
+_file_signatures = { } # source file => { "digest": content hash, "narratives": [(shingles, signature)] }
+_last_report = { } # (fingerprint, threshold) => report, holding only the most recent report
+
+def get_shingles(text):
+  # Return the set of hashes of the overlapping word n-grams in text, or None
+  # if text is too short to compare.
+  words = [word.lower() for word in re.findall(r"\w+", text or "")]
+  if len(words) < MIN_WORDS:
+    return None
+  return frozenset(
+    zlib.crc32(" ".join(words[i:i+SHINGLE_SIZE]).encode("utf8"))
+    for i in range(len(words) - SHINGLE_SIZE + 1)
+  )
+
+def get_signature(shingles):
+  # The MinHash signature of a set of shingles: for each hash function, the
+  # minimum hash of any shingle.
+  return tuple(
+    min((a * x + b) % _PRIME for x in shingles)
+    for a, b in _hash_params
+  )
+
+def jaccard(a, b):
+  return len(a & b) / len(a | b)
+
+def get_file_narratives(fn, controlimpls):
+  # Return a (shingles, signature) pair for each of the control implementations
+  # read from source file fn, from the cache if the file hasn't changed.
+  # Narratives that are too short have None for both.
+  digest = opencontrol.get_file_digest(fn)
+  with _lock:
+    cached = _file_signatures.get(fn)
+    if cached and cached["digest"] == digest and len(cached["narratives"]) == len(controlimpls):
+      return cached["narratives"]
+  narratives = []
+  for controlimpl in controlimpls:
+    shingles = get_shingles(controlimpl["narrative"])
+    narratives.append((shingles, get_signature(shingles) if shingles else None))
+  with _lock:
+    _file_signatures[fn] = { "digest": digest, "narratives": narratives }
+  return narratives
+
+def get_narrative_json(controlimpl):
+  return {
+    "project": opencontrol.get_project_json(controlimpl["component"]["project"]),
+    "component": opencontrol.get_component_json(controlimpl["component"]),
+    "standard": controlimpl["standard"]["id"],
+    "family": controlimpl["family"]["id"],
+    "control": {
+      "id": controlimpl["control"]["id"],
+      "number": controlimpl["control"]["number"],
+      "name": controlimpl["control"].get("name"),
+      "url": controlimpl["control"]["url"],
+    },
+    "control_part": controlimpl["control_part"],
+    "implementation_status": controlimpl["implementation_status"],
+    "narrative": controlimpl["narrative"],
+  }
+
+def load_narratives(project_dirs):
+  # Return a list of (controlimpl, shingles, signature) for every narrative
+  # long enough to compare, and a fingerprint of the source files and standards
+  # they were read from. Projects that fail to load are skipped.
+  narratives = []
+  fingerprint = []
+  for project_dir in project_dirs:
+    try:
+      project = opencontrol.load_project_from_path(project_dir)
+      standards = opencontrol.load_project_standards(project)
+      components = list(opencontrol.load_project_components(project))
+    except ValueError:
+      continue
+    fingerprint.extend(
+      (fn, opencontrol.get_file_digest(fn))
+      for fn in opencontrol.get_project_standard_files(project))
+    for component in components:
+      # Group the component's narratives by the file they were read from.
+      by_file = { }
+      for controlimpl in opencontrol.load_project_component_controls(component, standards):
+        by_file.setdefault(os.path.normpath(controlimpl["source_file"]), []).append(controlimpl)
+      for fn, controlimpls in by_file.items():
+        fingerprint.append((fn, opencontrol.get_file_digest(fn)))
+        for controlimpl, (shingles, signature) in zip(controlimpls, get_file_narratives(fn, controlimpls)):
+          if shingles:
+            narratives.append((controlimpl, shingles, signature))
+  return narratives, tuple(fingerprint)
+
+def find_clusters(narratives, threshold):
+  # Group the narratives into clusters of near-duplicates. Returns a list of
+  # clusters, each a pair of a list of indexes into narratives and a list of
+  # the similarities of the pairs in the cluster that met the threshold.
+
+  # Narratives whose signatures are identical in any band are candidates.
+  buckets = { }
+  for i, (controlimpl, shingles, signature) in enumerate(narratives):
+    for band in range(BANDS):
+      key = (band, signature[band*ROWS:(band+1)*ROWS])
+      buckets.setdefault(key, []).append(i)
+
+  # Compare the candidate pairs and join the similar ones with union-find.
+  parent = list(range(len(narratives)))
+  def find(i):
+    while parent[i] != i:
+      parent[i] = parent[parent[i]]
+      i = parent[i]
+    return i
+  similarities = { }
+  compared = set()
+  for bucket in buckets.values():
+    for j in range(1, len(bucket)):
+      for i in bucket[:j]:
+        if (i, bucket[j]) in compared:
+          continue
+        compared.add((i, bucket[j]))
+        similarity = jaccard(narratives[i][1], narratives[bucket[j]][1])
+        if similarity >= threshold:
+          similarities[(i, bucket[j])] = similarity
+          parent[find(i)] = find(bucket[j])
+
+  clusters = { }
+  for (i, j), similarity in similarities.items():
+    members, cluster_similarities = clusters.setdefault(find(i), (set(), []))
+    members.update((i, j))
+    cluster_similarities.append(similarity)
+  return [(sorted(members), cluster_similarities) for members, cluster_similarities in clusters.values()]
+
+def find_duplicates(project_dirs, threshold=DEFAULT_THRESHOLD):
+  # Return a report of the clusters of near-duplicate narratives, largest
+  # first. threshold is the minimum Jaccard similarity of two narratives'
+  # shingles for them to be considered near-duplicates.
+  import time
+  start_time = time.time()
+  threshold = max(MIN_THRESHOLD, min(threshold, 1.0))
+  narratives, fingerprint = load_narratives(project_dirs)
+
+  # Reuse the last report if nothing has changed.
+  with _lock:
+    if (fingerprint, threshold) in _last_report:
+      return _last_report[(fingerprint, threshold)]
+
+  report_clusters = []
+  for cluster, similarities in find_clusters(narratives, threshold):
+    members = [get_narrative_json(narratives[i][0]) for i in cluster]
+    members.sort(key = lambda member : (member["project"]["title"], member["component"]["name"], member["control"]["id"], member["control_part"] or ""))
+    report_clusters.append({
+      "size": len(members),
+      "components": len({ (member["project"]["id"], member["component"]["id"]) for member in members }),
+      "min_similarity": round(min(similarities), 4),
+      "max_similarity": round(max(similarities), 4),
+      "narratives": members,
+    })
+  report_clusters.sort(key = lambda cluster : (-cluster["size"], -cluster["max_similarity"]))
+
+  report = {
+    "threshold": threshold,
+    "narratives": len(narratives),
+    "clusters": report_clusters,
+    "seconds": round(time.time() - start_time, 4),
+  }
+  with _lock:
+    _last_report.clear()
+    _last_report[(fingerprint, threshold)] = report
+  return report
@@ -0,0 +1,157 @@
+# An index of each project's evidence (what OpenControl calls verifications)
+# and a background verifier that checks that evidence files exist and haven't
+# changed.
+#
+# The index maps each (component, verification key) to the evidence defined
+# with that key and each control to the evidence that covers it (its
+# covered_by keys), so both can be looked up directly. A project's index is
+# kept until one of its data files changes.
+#
+# The verifier stats and hashes (SHA-256) evidence files on a pool of worker
+# threads. Hashes are cached by file path, modification time, and size, so a
+# file is only read again when it changes. Evidence is "missing" if its file
+# doesn't exist, and "changed" if its content doesn't match the sha256 given
+# in its verification entry (a hyperGRC extension to OpenControl) or, if none
+# is given, the content hyperGRC saw the first time it checked the file.
+# Verification runs in the background when a project's evidence is listed,
+# at most once every VERIFY_INTERVAL seconds per file.
+
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+from . import opencontrol
+
+# The number of evidence files to check at once.
+MAX_WORKERS = 4
+
+# Seconds before a file is checked again.
+VERIFY_INTERVAL = 60.0
+
+_lock = threading.Lock()
+_indexes = { } # project path => index
+_hashes = { } # file path => ((modification time, size), hex SHA-256 digest)
+_first_hashes = { } # file path => the first digest seen, for evidence without a sha256
+_checks = { } # file path => check result
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+
+#############################
+# Index
+#############################
+
+def build_index(project):
+  # Load the evidence of each component and the evidence keys of each control.
+  index = {
+    "evidence": [],
+    "by_key": defaultdict(list), # (component id, verification key) => [evidence]
+    "by_control": defaultdict(list), # (component id, standard key, control key) => [evidence]
+  }
+  for component in opencontrol.load_project_components(project):
+    for item in opencontrol.load_project_component_evidence(component):
+      item["controls"] = []
+      index["evidence"].append(item)
+      index["by_key"][(component["id"], item["key"])].append(item)
+
+    # Link controls and evidence. covered_by is on the control, so it's
+    # repeated on each of the control's parts.
+    seen = set()
+    for controlimpl in opencontrol.load_project_component_controls(component, { }):
+      control = (component["id"], controlimpl["standard"]["id"], controlimpl["control"]["id"])
+      if control in seen:
+        continue
+      seen.add(control)
+      for key in controlimpl["evidence"]:
+        for item in index["by_key"].get((component["id"], key), []):
+          index["by_control"][control].append(item)
+          item["controls"].append(controlimpl["control"])
+
+  index["evidence"].sort(key = lambda item : (item["component"]["name"], item["name"]))
+  index["by_key"] = dict(index["by_key"])
+  index["by_control"] = dict(index["by_control"])
+  return index
+
+def get_index(project):
+  with _lock:
+    index = _indexes.get(project["path"])
+  if index is None:
+    index = build_index(project)
+    with _lock:
+      _indexes[project["path"]] = index
+  return index
+
+def forget_index(fn):
+  # Drop the index of the project containing a changed file. This is registered
+  # as an opencontrol change listener.
+  fn = os.path.abspath(fn)
+  with _lock:
+    for project_dir in list(_indexes):
+      if fn.startswith(os.path.join(os.path.abspath(project_dir), "")):
+        del _indexes[project_dir]
+
+opencontrol.add_change_listener(forget_index)
+
+def get_control_evidence(project, controlimpl):
+  # Return the evidence that covers a control implementation's control.
+  return get_index(project)["by_control"].get(
+    (controlimpl["component"]["id"], controlimpl["standard"]["id"], controlimpl["control"]["id"]), [])
+
+#############################
+# Verification
+#############################
+
+def get_file_hash(fn):
+  # Return the SHA-256 digest of a file's content and its signature, reading
+  # the file only if its modification time or size changed since it was last
+  # hashed. Raises OSError if the file can't be read.
+  stat = os.stat(fn)
+  signature = (stat.st_mtime_ns, stat.st_size)
+  with _lock:
+    cached = _hashes.get(fn)
+  if cached and cached[0] == signature:
+    return cached[1]
+  hasher = hashlib.sha256()
+  with open(fn, "rb") as f:
+    for chunk in iter(lambda : f.read(1 << 20), b""):
+      hasher.update(chunk)
+  with _lock:
+    _hashes[fn] = (signature, hasher.hexdigest())
+  return hasher.hexdigest()
+
+def check_file(fn, expected_digest):
+  # Check an evidence file and record the result.
+  result = { "checked": time.time(), "sha256": None }
+  if not os.path.isfile(fn):
+    result["status"] = "missing"
+  else:
+    try:
+      result["sha256"] = get_file_hash(fn)
+    except OSError as e:
+      result.update(status="error", error=str(e))
+    else:
+      with _lock:
+        if not expected_digest:
+          expected_digest = _first_hashes.setdefault(fn, result["sha256"])
+      result["status"] = "ok" if result["sha256"] == expected_digest.lower() else "changed"
+  with _lock:
+    _checks[fn] = result
+
+def verify(evidence, force=False):
+  # Queue the evidence files that haven't been checked recently to be checked
+  # in the background.
+  now = time.time()
+  with _lock:
+    for item in evidence:
+      fn = os.path.abspath(item["path"])
+      check = _checks.get(fn)
+      if check is None or (check["status"] != "pending" and (force or now - check["checked"] >= VERIFY_INTERVAL)):
+        _checks[fn] = dict(check or { "sha256": None, "checked": None }, status="pending")
+        _executor.submit(check_file, fn, item.get("sha256"))
+
+def get_check(item):
+  # Return the latest check result for an evidence item, or None if it
+  # hasn't been queued.
+  with _lock:
+    return _checks.get(os.path.abspath(item["path"]))
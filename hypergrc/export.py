@@ -0,0 +1,154 @@
+# Export system security plans and other documents for many projects at
+# once without running the HTTP server, e.g.:
+#
+#   python -m hypergrc export @repos.conf
+#
+# Projects are exported in parallel in separate processes. The documents are
+# written to an "exports" directory within each project's "outputs" directory,
+# along with a manifest recording a hash of the project's data files so that
+# projects that haven't changed since the last export are skipped.
+
+import os
+import re
+import sys
+import json
+import time
+
+from . import opencontrol
+
+EXPORT_FORMATS = ("md", "csv", "app.yaml")
+
+# The manifest file name starts with a dot so that it is not listed on the
+# project's documents page.
+MANIFEST_FILE = ".export-manifest.json"
+
+def get_export_dir(project):
+  return os.path.join(project["path"], "outputs", "exports")
+
+def build_exports(project, formats, progress=None):
+  # Build the documents for a project in the given formats and return a
+  # dict mapping file names, relative to the export directory, to file
+  # content as bytes. If progress is given, it is called with the format
+  # being built, the number of control families (or, for app.yaml, components)
+  # done, and the total number of them.
+  exports = { }
+
+  def format_progress(format):
+    if progress:
+      return lambda done, total : progress(format, done, total)
+
+  if "md" in formats:
+    from .ssp import build_ssp
+    exports["ssp.md"] = build_ssp(project, { "progress": format_progress("md") }).encode("utf8")
+
+  if "csv" in formats:
+    from .csv import build_csv
+    exports["ssp.csv"] = build_csv(project, { "progress": format_progress("csv") }).encode("utf8")
+
+  if "app.yaml" in formats:
+    # One GovReady-Q app.yaml file per component, like the component
+    # app.yaml page.
+    from .app_yaml import build_app
+    standards = opencontrol.load_project_standards(project)
+    components = list(opencontrol.load_project_components(project))
+    for i, component in enumerate(components):
+      controlimpls = list(opencontrol.load_project_component_controls(component, standards))
+      fn = re.sub(r"[^\w.-]+", "_", component["id"]) + ".yaml"
+      exports[os.path.join("app-yaml", fn)] = build_app(controlimpls, None).encode("utf8")
+      if progress:
+        progress("app.yaml", i + 1, len(components))
+
+  return exports
+
+def read_manifest(project):
+  try:
+    with open(os.path.join(get_export_dir(project), MANIFEST_FILE), encoding="utf8") as f:
+      return json.load(f)
+  except (IOError, ValueError):
+    return { }
+
+def export_project(project_dir, formats, force=False):
+  # Export one project. This runs in a worker process, so it returns a simple
+  # tuple of (project_dir, status, seconds, message) and never raises. status
+  # is "exported", "unchanged", or "error".
+  start_time = time.time()
+  try:
+    project = opencontrol.load_project_from_path(project_dir)
+
+    # Skip the project if its data files and the requested formats are the same
+    # as the last time it was exported.
+    digest = opencontrol.get_project_digest(project)
+    manifest = read_manifest(project)
+    if not force and manifest.get("digest") == digest and set(manifest.get("formats", [])) >= set(formats):
+      return (project_dir, "unchanged", time.time() - start_time, None)
+
+    # Build and write out the documents.
+    exports = build_exports(project, formats)
+    export_dir = get_export_dir(project)
+    for fn, data in exports.items():
+      fn = os.path.join(export_dir, fn)
+      os.makedirs(os.path.dirname(fn), exist_ok=True)
+      with open(fn, "wb") as f:
+        f.write(data)
+
+    # Write the manifest last so that an interrupted export is redone next time.
+    with open(os.path.join(export_dir, MANIFEST_FILE), "w", encoding="utf8") as f:
+      json.dump({
+        "digest": digest,
+        "formats": sorted(formats),
+        "files": sorted(exports),
+      }, f, indent=2)
+
+    return (project_dir, "exported", time.time() - start_time, "{} files".format(len(exports)))
+  except Exception as e:
+    return (project_dir, "error", time.time() - start_time, str(e))
+
+def main(argv):
+  import argparse
+  from concurrent.futures import ProcessPoolExecutor, as_completed
+  from .repos import read_project_list, validate_project_paths
+
+  parser = argparse.ArgumentParser(prog='hypergrc export', description='Export documents for hyperGRC projects.')
+  parser.add_argument('--format', action='append', choices=EXPORT_FORMATS, dest='formats', help='Export format. Specify more than once for more than one format. Defaults to all formats.')
+  parser.add_argument('--jobs', type=int, default=None, help='Number of projects to export in parallel. Defaults to the number of CPUs.')
+  parser.add_argument('--force', action='store_true', help='Export projects even if they have not changed since the last export.')
+  parser.add_argument('project', nargs="*", default=["@repos.conf"], help='Path to a directory containing an opencontrol.yaml file for a system. Precede with an @-sign to read a list of directories from a newline-delimited text file. End with /** to use every directory containing an opencontrol.yaml file within a directory.')
+  args = parser.parse_args(argv)
+  formats = args.formats or list(EXPORT_FORMATS)
+
+  # Read and validate the list of projects. Invalid project paths are reported
+  # but don't stop the other projects from being exported.
+  try:
+    projects = read_project_list(args.project)
+  except ValueError as e:
+    sys.stderr.write(str(e) + "\n")
+    return 1
+  failures = 0
+  valid_projects = []
+  for project, error in zip(projects, validate_project_paths(projects)):
+    if error:
+      sys.stderr.write("[hyperGRC] {}\n".format(error))
+      failures += 1
+    else:
+      valid_projects.append(project)
+
+  # Export the projects in parallel, printing each project's timing as it finishes.
+  start_time = time.time()
+  with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+    futures = [
+      executor.submit(export_project, project, formats, args.force)
+      for project in valid_projects
+    ]
+    for future in as_completed(futures):
+      project_dir, status, seconds, message = future.result()
+      if status == "error":
+        failures += 1
+      sys.stdout.write("[hyperGRC] {} {} in {:.2f}s{}\n".format(
+        status, project_dir, seconds, (" (" + message + ")") if message else ""))
+
+  sys.stdout.write("[hyperGRC] finished {} projects in {:.2f}s, {} failed\n".format(
+    len(valid_projects), time.time() - start_time, failures))
+  return 1 if failures else 0
+
+if __name__ == "__main__":
+  sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,164 @@
+# Certification gap analysis: which of the controls selected by a project's
+# certifications have no narrative, or have narratives that aren't in place.
+#
+# Like the component comparison (see coverage.py), coverage is computed with
+# bitsets. Each certified control in a project gets a bit, and each component
+# has a bitset of the certified controls it has a narrative for and a bitset
+# of those that are in place. Per-family, per-component, and per-project
+# coverage are then popcounts of bitwise ANDs with family masks.
+#
+# The analysis of each project is cached until the project's data changes
+# (see opencontrol.get_project_digest), so the portfolio-wide report only
+# re-analyzes the projects that changed.
+
+import threading
+
+from . import opencontrol
+from .coverage import popcount, iter_bits
+
+# Implementation statuses that count as implemented.
+IMPLEMENTED_STATUSES = ("In Place", "Implemented")
+
+_lock = threading.Lock()
+_project_gaps = { } # project path => { "digest": project digest, "analysis": analysis }
+
+def percent(count, total):
+  return round(100 * count / total, 1) if total else None
+
+def get_coverage_json(total, documented, implemented):
+  return {
+    "total": total,
+    "documented": documented,
+    "implemented": implemented,
+    "documented_percent": percent(documented, total),
+    "implemented_percent": percent(implemented, total),
+  }
+
+def analyze_project(project):
+  # Return the gap analysis for a project, from the cache if the project's
+  # data hasn't changed.
+  digest = opencontrol.get_project_digest(project)
+  with _lock:
+    cached = _project_gaps.get(project["path"])
+    if cached and cached["digest"] == digest:
+      return cached["analysis"]
+  analysis = build_project_analysis(project)
+  with _lock:
+    _project_gaps[project["path"]] = { "digest": digest, "analysis": analysis }
+  return analysis
+
+def build_project_analysis(project):
+  from urllib.parse import quote_plus
+  standards = opencontrol.load_project_standards(project)
+
+  # Assign each certified control a bit, in control order, and make a mask
+  # of the bits for each control family.
+  controls = sorted(
+    opencontrol.load_project_certified_controls(project),
+    key = lambda control : (control[0], opencontrol.make_control_number_sort_key(control[1])))
+  control_bits = { control: i for i, control in enumerate(controls) }
+  all_bits = (1 << len(controls)) - 1
+  family_masks = { }
+  control_info = []
+  for i, (standard_id, control_id) in enumerate(controls):
+    standard = standards.get(standard_id, { "controls": { }, "families": { } })
+    control = standard["controls"].get(control_id, { })
+    family_id = control.get("family") or control_id.split("-")[0]
+    family = standard["families"].get(family_id, { })
+    family_masks.setdefault((standard_id, family_id, family.get("name") or family_id), 0)
+    family_masks[(standard_id, family_id, family.get("name") or family_id)] |= (1 << i)
+    control_info.append({
+      "standard": standard_id,
+      "id": control_id,
+      "number": control.get("number", control_id),
+      "name": control.get("name"),
+      "family": family_id,
+      "url": "{}/controls/{}/{}".format(project["url"], quote_plus(standard_id), quote_plus(control_id)),
+    })
+
+  # Set the bits for the certified controls that each component has a narrative
+  # for and that each component has in place. A control with several narrative
+  # parts is in place for the component only if every part is.
+  components = []
+  statuses = { } # bit => [(component, implementation status)]
+  for component in opencontrol.load_project_components(project):
+    documented = 0
+    not_implemented = 0
+    for controlimpl in opencontrol.load_project_component_controls(component, standards):
+      bit = control_bits.get((controlimpl["standard"]["id"], controlimpl["control"]["id"]))
+      if bit is None:
+        continue
+      documented |= (1 << bit)
+      if controlimpl["implementation_status"] not in IMPLEMENTED_STATUSES:
+        not_implemented |= (1 << bit)
+      statuses.setdefault(bit, []).append((component, controlimpl["implementation_status"]))
+    components.append((component, documented, documented & ~not_implemented))
+
+  # A control is documented for the project if any component documents it and
+  # in place if any component has it in place.
+  project_documented = 0
+  project_implemented = 0
+  for component, documented, implemented in components:
+    project_documented |= documented
+    project_implemented |= implemented
+
+  # List the gaps: certified controls that aren't in place.
+  gaps = []
+  for bit in iter_bits(all_bits & ~project_implemented):
+    gap = dict(control_info[bit])
+    gap["gap"] = "not in place" if (project_documented >> bit) & 1 else "no narrative"
+    gap["components"] = [
+      {
+        "component": opencontrol.get_component_json(component),
+        "implementation_status": status,
+      }
+      for component, status in statuses.get(bit, [])
+    ]
+    gaps.append(gap)
+  gaps.sort(key = lambda gap : (gap["standard"], opencontrol.make_control_number_sort_key(gap["id"])))
+
+  return {
+    "project": opencontrol.get_project_json(project),
+    "coverage": get_coverage_json(len(controls), popcount(project_documented), popcount(project_implemented)),
+    "families": [
+      dict(
+        { "standard": standard_id, "id": family_id, "name": family_name },
+        **get_coverage_json(popcount(mask), popcount(project_documented & mask), popcount(project_implemented & mask)))
+      for (standard_id, family_id, family_name), mask in sorted(family_masks.items())
+    ],
+    "components": [
+      dict(
+        { "component": opencontrol.get_component_json(component) },
+        **get_coverage_json(len(controls), popcount(documented), popcount(implemented)))
+      for component, documented, implemented in components
+    ],
+    "gaps": gaps,
+  }
+
+def analyze_portfolio(project_dirs):
+  # Return a summary of the gap analysis of every project. Projects that fail
+  # to load are skipped.
+  import time
+  start_time = time.time()
+  projects = []
+  total = documented = implemented = 0
+  for project_dir in project_dirs:
+    try:
+      project = opencontrol.load_project_from_path(project_dir)
+      analysis = analyze_project(project)
+    except ValueError:
+      continue
+    projects.append({
+      "project": analysis["project"],
+      "coverage": analysis["coverage"],
+      "gaps": len(analysis["gaps"]),
+    })
+    total += analysis["coverage"]["total"]
+    documented += analysis["coverage"]["documented"]
+    implemented += analysis["coverage"]["implemented"]
+  projects.sort(key = lambda project : project["project"]["title"])
+  return {
+    "coverage": get_coverage_json(total, documented, implemented),
+    "projects": projects,
+    "seconds": round(time.time() - start_time, 4),
+  }
@@ -0,0 +1,434 @@
+# An optional persistent index of the loaded projects in a local SQLite
+# database, enabled with `--index-db PATH`.
+#
+# A background thread mirrors every project, component, control
+# implementation, evidence item, and certified control into the database, and
+# narratives go into an FTS5 full-text table. The YAML data files remain the
+# source of truth: the database is only a cache of them and can be deleted at
+# any time.
+#
+# The index is updated incrementally. The database remembers each data file's
+# signature (see opencontrol.get_file_signature) and content hash, and each
+# project and component remembers a fingerprint over the hashes of the files it
+# was read from, so after a restart only the projects and components whose
+# files actually changed are read again. When hyperGRC writes to a data file
+# or the file watcher sees a change (see opencontrol.notify_file_changed), the
+# project containing the file is queued to be synced again.
+#
+# While the first sync is running, is_ready() returns False and routes fall
+# back to the in-memory indexes.
+
+import hashlib
+import json
+import os.path
+import threading
+
+from . import opencontrol
+
+# Bump this when the tables change to rebuild the index from scratch.
+SCHEMA_VERSION = 1
+
+SCHEMA = """
+CREATE TABLE files (
+  path TEXT PRIMARY KEY,
+  mtime_ns INTEGER,
+  size INTEGER,
+  digest TEXT
+);
+CREATE TABLE projects (
+  path TEXT PRIMARY KEY,
+  id TEXT,
+  title TEXT,
+  url TEXT,
+  organization_id TEXT,
+  organization_name TEXT,
+  fingerprint TEXT
+);
+CREATE TABLE components (
+  project_path TEXT,
+  id TEXT,
+  name TEXT,
+  url TEXT,
+  source_files TEXT, -- JSON list of paths
+  fingerprint TEXT,
+  PRIMARY KEY (project_path, id)
+);
+CREATE TABLE controlimpls (
+  id INTEGER PRIMARY KEY,
+  project_path TEXT,
+  component_id TEXT,
+  standard TEXT,
+  family TEXT,
+  control_id TEXT,
+  control_number TEXT,
+  control_name TEXT,
+  control_url TEXT,
+  control_part TEXT,
+  implementation_status TEXT,
+  narrative TEXT,
+  source_file TEXT
+);
+CREATE INDEX controlimpls_component ON controlimpls (project_path, component_id);
+CREATE VIRTUAL TABLE controlimpls_fts USING fts5(narrative, control_name, control_description); -- rowid is controlimpls.id
+CREATE TABLE evidence (
+  project_path TEXT,
+  component_id TEXT,
+  key TEXT,
+  name TEXT,
+  path TEXT,
+  type TEXT,
+  source_file TEXT
+);
+CREATE INDEX evidence_component ON evidence (project_path, component_id);
+CREATE TABLE certified_controls (
+  project_path TEXT,
+  standard TEXT,
+  control_id TEXT
+);
+CREATE INDEX certified_controls_project ON certified_controls (project_path);
+"""
+
+_lock = threading.RLock() # guards _db
+_db = None
+_ready = threading.Event()
+_pending = set() # project paths waiting to be synced
+_pending_changed = threading.Condition()
+_thread = None
+
+def open_db(path):
+  # Open (creating if necessary) the index database. Raises ValueError if
+  # this build of SQLite can't be used.
+  global _db
+  import sqlite3
+  try:
+    db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+    db.row_factory = sqlite3.Row
+    db.execute("PRAGMA journal_mode=WAL")
+    if db.execute("PRAGMA user_version").fetchone()[0] != SCHEMA_VERSION:
+      with transaction(db):
+        for (name,) in db.execute("SELECT name FROM sqlite_master WHERE type IN ('table', 'view') AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '%fts_%'").fetchall():
+          db.execute("DROP TABLE IF EXISTS \"{}\"".format(name))
+        for statement in SCHEMA.split(";"):
+          if statement.strip():
+            db.execute(statement)
+        db.execute("PRAGMA user_version={}".format(SCHEMA_VERSION))
+  except sqlite3.Error as e:
+    raise ValueError("The index database {} could not be opened: {}. Full-text search requires SQLite with FTS5.".format(path, e))
+  _db = db
+
+def is_enabled():
+  return _db is not None
+
+def is_ready():
+  # Has the first sync of every project finished?
+  return _db is not None and _ready.is_set()
+
+class transaction:
+  # A context manager for a write transaction on a connection opened in
+  # autocommit mode.
+  def __init__(self, db):
+    self.db = db
+  def __enter__(self):
+    self.db.execute("BEGIN IMMEDIATE")
+    return self.db
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.db.execute("COMMIT" if exc_type is None else "ROLLBACK")
+
+#############################
+# Syncing
+#############################
+
+def get_digest(fn):
+  # Return the content hash of a file, re-hashing it only if its signature
+  # differs from the one in the database. Must be called with _lock held.
+  fn = os.path.normpath(fn)
+  if opencontrol.is_unflushed(fn):
+    # The content waiting in the write-behind queue isn't on disk yet, so
+    # don't record its hash under the signature of the file on disk.
+    return opencontrol.get_file_digest(fn)
+  try:
+    mtime_ns, size = opencontrol.get_file_signature(fn)
+  except OSError:
+    return None
+  row = _db.execute("SELECT mtime_ns, size, digest FROM files WHERE path=?", (fn,)).fetchone()
+  if row and (row["mtime_ns"], row["size"]) == (mtime_ns, size):
+    return row["digest"]
+  digest = opencontrol.get_file_digest(fn)
+  _db.execute("INSERT OR REPLACE INTO files (path, mtime_ns, size, digest) VALUES (?, ?, ?, ?)", (fn, mtime_ns, size, digest))
+  return digest
+
+def get_fingerprint(files):
+  # Return a hash over the paths and content hashes of files. Must be called
+  # with _lock held.
+  hasher = hashlib.sha256()
+  for fn in files:
+    hasher.update(fn.encode("utf8"))
+    hasher.update((get_digest(fn) or "missing").encode("ascii"))
+  return hasher.hexdigest()
+
+def get_project_level_files(project):
+  # The files whose changes affect every component in a project: the system
+  # file, its standards (which have control names and descriptions), and its
+  # certifications.
+  fn = os.path.join(project["path"], "opencontrol.yaml")
+  system_opencontrol = opencontrol.load_opencontrol_yaml(fn, "system", ("1.0.0",))
+  files = [fn] + opencontrol.get_project_standard_files(project) + [
+    os.path.join(project["path"], certification_fn)
+    for certification_fn in system_opencontrol.get("certifications", [])
+  ]
+  return [os.path.normpath(fn) for fn in files]
+
+def delete_component_rows(project_path, component_id=None):
+  # Delete the rows for one or all components of a project. Must be called
+  # with _lock held in a transaction.
+  where = "project_path=?" + (" AND component_id=?" if component_id is not None else "")
+  params = (project_path,) + ((component_id,) if component_id is not None else ())
+  _db.execute("DELETE FROM controlimpls_fts WHERE rowid IN (SELECT id FROM controlimpls WHERE {})".format(where), params)
+  _db.execute("DELETE FROM controlimpls WHERE {}".format(where), params)
+  _db.execute("DELETE FROM evidence WHERE {}".format(where), params)
+  if component_id is None:
+    _db.execute("DELETE FROM components WHERE project_path=?", params)
+  else:
+    _db.execute("DELETE FROM components WHERE project_path=? AND id=?", params)
+
+def index_component(project_path, component, standards, source_files, fingerprint):
+  # Replace the rows for a component. Must be called with _lock held in a
+  # transaction.
+  delete_component_rows(project_path, component["id"])
+  _db.execute("INSERT INTO components (project_path, id, name, url, source_files, fingerprint) VALUES (?, ?, ?, ?, ?, ?)",
+    (project_path, component["id"], component["name"], component["url"], json.dumps(source_files), fingerprint))
+  for controlimpl in opencontrol.load_project_component_controls(component, standards):
+    control = controlimpl["control"]
+    cursor = _db.execute("""INSERT INTO controlimpls (project_path, component_id, standard, family, control_id, control_number,
+        control_name, control_url, control_part, implementation_status, narrative, source_file)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+      (project_path, component["id"], controlimpl["standard"]["id"], controlimpl["family"]["id"], control["id"], control["number"],
+       control.get("name"), control["url"], controlimpl["control_part"], controlimpl["implementation_status"] or "",
+       controlimpl["narrative"], os.path.normpath(controlimpl["source_file"])))
+    _db.execute("INSERT INTO controlimpls_fts (rowid, narrative, control_name, control_description) VALUES (?, ?, ?, ?)",
+      (cursor.lastrowid, controlimpl["narrative"], control.get("name"), control.get("description")))
+  for evidence in opencontrol.load_project_component_evidence(component):
+    _db.execute("INSERT INTO evidence (project_path, component_id, key, name, path, type, source_file) VALUES (?, ?, ?, ?, ?, ?, ?)",
+      (project_path, component["id"], evidence["key"], evidence["name"], evidence["path"], evidence["type"], os.path.normpath(evidence["source_file"])))
+
+def sync_project(project_dir):
+  # Bring a project's rows up to date with its data files. Components whose
+  # files haven't changed are skipped unless a project-level file changed.
+  # Returns the number of components that were re-indexed.
+  project = opencontrol.load_project_from_path(project_dir)
+  reindexed = 0
+  with _lock, transaction(_db):
+    project_fingerprint = get_fingerprint(get_project_level_files(project))
+    row = _db.execute("SELECT fingerprint FROM projects WHERE path=?", (project_dir,)).fetchone()
+    full = row is None or row["fingerprint"] != project_fingerprint
+
+    _db.execute("""INSERT OR REPLACE INTO projects (path, id, title, url, organization_id, organization_name, fingerprint)
+        VALUES (?, ?, ?, ?, ?, ?, ?)""",
+      (project_dir, project["id"], project["title"], project["url"],
+       project["organization"]["id"], project["organization"]["name"], project_fingerprint))
+    if full:
+      delete_component_rows(project_dir)
+      _db.execute("DELETE FROM certified_controls WHERE project_path=?", (project_dir,))
+      _db.executemany("INSERT INTO certified_controls (project_path, standard, control_id) VALUES (?, ?, ?)",
+        [(project_dir, standard_id, control_id) for standard_id, control_id in opencontrol.load_project_certified_controls(project)])
+
+    standards = None
+    component_ids = set()
+    for component in opencontrol.load_project_components(project):
+      component_ids.add(component["id"])
+      row = _db.execute("SELECT name, url, source_files, fingerprint FROM components WHERE project_path=? AND id=?",
+        (project_dir, component["id"])).fetchone()
+      if row and (row["name"], row["url"]) == (component["name"], component["url"]) \
+        and get_fingerprint(json.loads(row["source_files"])) == row["fingerprint"]:
+        continue
+
+      # Load standards only if something needs to be re-indexed.
+      if standards is None:
+        standards = opencontrol.load_project_standards(project)
+      source_files = opencontrol.get_component_source_files(component)
+      index_component(project_dir, component, standards, source_files, get_fingerprint(source_files))
+      reindexed += 1
+
+    # Remove components that are no longer in the project.
+    for (component_id,) in _db.execute("SELECT id FROM components WHERE project_path=?", (project_dir,)).fetchall():
+      if component_id not in component_ids:
+        delete_component_rows(project_dir, component_id)
+  return reindexed
+
+def remove_project(project_dir):
+  with _lock, transaction(_db):
+    delete_component_rows(project_dir)
+    _db.execute("DELETE FROM certified_controls WHERE project_path=?", (project_dir,))
+    _db.execute("DELETE FROM projects WHERE path=?", (project_dir,))
+
+def sync(project_dirs):
+  # Make the index hold exactly the given projects. Projects that fail to
+  # load are left out.
+  with _lock:
+    indexed = { row["path"] for row in _db.execute("SELECT path FROM projects").fetchall() }
+  for project_dir in indexed - set(project_dirs):
+    remove_project(project_dir)
+  for project_dir in project_dirs:
+    try:
+      sync_project(project_dir)
+    except ValueError:
+      import traceback
+      traceback.print_exc()
+      remove_project(project_dir)
+
+def queue_file(fn):
+  # Queue the project containing a changed file to be synced. This is
+  # registered as an opencontrol change listener.
+  if _db is None:
+    return
+  with _lock:
+    project_dirs = [row["path"] for row in _db.execute("SELECT path FROM projects").fetchall()]
+  with _pending_changed:
+    for project_dir in project_dirs:
+      if os.path.abspath(fn).startswith(os.path.join(os.path.abspath(project_dir), "")):
+        _pending.add(project_dir)
+    _pending_changed.notify()
+
+opencontrol.add_change_listener(queue_file)
+
+def update_projects(added, removed):
+  # Remove projects that are no longer listed and queue new ones to be
+  # synced. This is registered as a repos listener.
+  if _db is None:
+    return
+  for project_dir in removed:
+    remove_project(project_dir)
+  with _pending_changed:
+    _pending.update(added)
+    _pending.difference_update(removed)
+    _pending_changed.notify()
+
+def start(project_dirs):
+  # Sync every project and then keep the index up to date in a background
+  # thread.
+  global _thread
+  if _thread is not None:
+    return
+
+  def run():
+    import time
+    start_time = time.time()
+    sync(project_dirs)
+    _ready.set()
+    print("[hyperGRC] index database synced in {:.1f} seconds".format(time.time() - start_time))
+    while True:
+      with _pending_changed:
+        while not _pending:
+          _pending_changed.wait()
+        project_dir = _pending.pop()
+      try:
+        sync_project(project_dir)
+      except Exception:
+        import traceback
+        traceback.print_exc()
+
+  _thread = threading.Thread(target=run, name="hypergrc-indexdb", daemon=True)
+  _thread.start()
+
+#############################
+# Queries
+#############################
+
+def get_fts_query(query):
+  # Convert a search query (see search.parse_query) into an FTS5 query in
+  # which every term and phrase must match. Returns the query and the set of
+  # all of the terms, for making snippets.
+  from .search import parse_query
+  terms, phrases = parse_query(query)
+  all_terms = set(terms) | { term for phrase in phrases for term in phrase }
+  fts_query = " AND ".join(
+    ['"{}"'.format(term) for term in terms]
+    + ['"{}"'.format(" ".join(phrase)) for phrase in phrases])
+  return fts_query, all_terms
+
+def search(query, filters={}, limit=50):
+  # Search narratives like search.search does, returning the total number of
+  # matches and the top-ranked results in the same format.
+  from .search import make_snippet
+  fts_query, all_terms = get_fts_query(query)
+  if not fts_query:
+    return 0, []
+
+  where = ["controlimpls_fts MATCH ?"]
+  params = [fts_query]
+  if filters.get("project"):
+    where.append("p.id = ?")
+    params.append(filters["project"])
+  if filters.get("component"):
+    where.append("(c.component_id = ? OR k.name = ?)")
+    params.extend([filters["component"], filters["component"]])
+  if filters.get("family"):
+    where.append("lower(c.family) = lower(?)")
+    params.append(filters["family"])
+  if filters.get("implementation_status"):
+    where.append("lower(c.implementation_status) = lower(?)")
+    params.append(filters["implementation_status"])
+  tables = """controlimpls_fts
+    JOIN controlimpls c ON c.id = controlimpls_fts.rowid
+    JOIN projects p ON p.path = c.project_path
+    JOIN components k ON k.project_path = c.project_path AND k.id = c.component_id"""
+  where = " AND ".join(where)
+
+  with _lock:
+    total = _db.execute("SELECT count(*) FROM {} WHERE {}".format(tables, where), params).fetchone()[0]
+    rows = _db.execute("""SELECT c.*, bm25(controlimpls_fts) AS rank,
+        p.id AS p_id, p.title AS p_title, p.url AS p_url, p.organization_id, p.organization_name,
+        k.name AS k_name, k.url AS k_url
+        FROM {} WHERE {} ORDER BY rank LIMIT ?""".format(tables, where), params + [limit]).fetchall()
+
+  results = []
+  for row in rows:
+    results.append({
+      "project": {
+        "id": row["p_id"],
+        "title": row["p_title"],
+        "url": row["p_url"],
+        "organization": {
+          "id": row["organization_id"],
+          "name": row["organization_name"],
+        },
+      },
+      "component": {
+        "id": row["component_id"],
+        "name": row["k_name"],
+        "url": row["k_url"],
+        "project": row["p_id"],
+      },
+      "standard": row["standard"],
+      "family": row["family"],
+      "control": {
+        "id": row["control_id"],
+        "number": row["control_number"],
+        "name": row["control_name"],
+        "url": row["control_url"],
+      },
+      "control_part": row["control_part"],
+      "implementation_status": row["implementation_status"],
+      "narrative": row["narrative"],
+      "source_file": row["source_file"],
+      "score": round(-row["rank"], 4), # bm25() is lower for better matches
+      "snippet": make_snippet(row["narrative"], all_terms),
+    })
+  return total, results
+
+def list_components():
+  # Return every indexed component, sorted by name, with enough of its
+  # project for the all-components page.
+  with _lock:
+    rows = _db.execute("""SELECT k.id, k.name, k.url, p.id AS p_id, p.title AS p_title, p.url AS p_url
+        FROM components k JOIN projects p ON p.path = k.project_path
+        ORDER BY k.name""").fetchall()
+  return [
+    {
+      "id": row["id"],
+      "name": row["name"],
+      "url": row["url"],
+      "project": { "id": row["p_id"], "title": row["p_title"], "url": row["p_url"] },
+    }
+    for row in rows
+  ]
@@ -0,0 +1,133 @@
+# Run document exports in the background so that large SSP and CSV builds
+# don't block the HTTP request that asked for them.
+#
+# Export jobs run on a small pool of worker threads. Each job is identified
+# by the project, the export format, and a hash of the project's data files
+# (see opencontrol.get_project_digest). A request for an export that is already
+# queued, running, or finished for the same data is given the existing job,
+# so duplicate requests are coalesced and finished exports are served from
+# memory until the project's data changes.
+
+import os.path
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from . import opencontrol
+
+# The export formats a job can build. "all" builds every format.
+JOB_FORMATS = ("md", "csv", "app.yaml", "all")
+
+# The number of exports that can run at once.
+MAX_WORKERS = 2
+
+# The number of finished jobs to keep in memory. Older finished jobs are
+# forgotten, and their exports are rebuilt if requested again.
+MAX_FINISHED_JOBS = 50
+
+_executor = ThreadPoolExecutor(max_workers=MAX_WORKERS)
+_lock = threading.Lock()
+_jobs = { } # job ID => job
+_jobs_by_key = { } # (project path, format, project digest) => job
+
+def submit_export(project, format):
+  # Start an export of a project in one of JOB_FORMATS and return the job, or
+  # return an existing job for the same export of the same project data.
+  if format not in JOB_FORMATS:
+    raise ValueError("Export format {} is not supported.".format(format))
+  key = (project["path"], format, opencontrol.get_project_digest(project))
+
+  with _lock:
+    job = _jobs_by_key.get(key)
+    if job and job["status"] != "error":
+      return job
+
+    job = {
+      "id": uuid.uuid4().hex[:16],
+      "key": key,
+      "project": project,
+      "format": format,
+      "status": "queued",
+      "progress": { "format": None, "done": 0, "total": 0 },
+      "error": None,
+      "files": None,
+      "submitted": time.time(),
+      "finished": None,
+    }
+    _jobs[job["id"]] = job
+    _jobs_by_key[key] = job
+    forget_old_jobs()
+
+  _executor.submit(run_export, job)
+  return job
+
+def run_export(job):
+  from .export import EXPORT_FORMATS, build_exports
+
+  def progress(format, done, total):
+    job["progress"] = { "format": format, "done": done, "total": total }
+
+  job["status"] = "running"
+  try:
+    formats = EXPORT_FORMATS if job["format"] == "all" else (job["format"],)
+    job["files"] = build_exports(job["project"], formats, progress=progress)
+    job["status"] = "done"
+  except Exception as e:
+    import traceback
+    traceback.print_exc()
+    job["error"] = str(e)
+    job["status"] = "error"
+  job["finished"] = time.time()
+
+def forget_old_jobs():
+  # Drop the oldest finished jobs beyond MAX_FINISHED_JOBS. Must be called
+  # with _lock held.
+  finished = sorted(
+    (job for job in _jobs.values() if job["status"] in ("done", "error")),
+    key = lambda job : job["finished"])
+  for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+    del _jobs[job["id"]]
+    if _jobs_by_key.get(job["key"]) is job:
+      del _jobs_by_key[job["key"]]
+
+def get_job(project, job_id):
+  # Return a project's export job. Jobs of other projects are not found.
+  job = _jobs.get(job_id)
+  if not job or os.path.abspath(job["project"]["path"]) != os.path.abspath(project["path"]):
+    raise ValueError("Export job {} not found.".format(job_id))
+  return job
+
+def get_job_status(job):
+  # Return a JSON-able summary of a job.
+  return {
+    "id": job["id"],
+    "format": job["format"],
+    "status": job["status"],
+    "progress": job["progress"],
+    "error": job["error"],
+    "files": sorted(job["files"]) if job["files"] else None,
+    "url": "{}/exports/{}".format(job["project"]["url"], job["id"]),
+    "download_url": "{}/exports/{}/download".format(job["project"]["url"], job["id"])
+      if job["status"] == "done" else None,
+  }
+
+def get_job_download(job):
+  # Return a (file name, data, content type) tuple for a finished job's
+  # export. Exports with a single file are sent as is, and exports with
+  # more than one file are sent as a ZIP file.
+  files = job["files"]
+  if len(files) == 1:
+    fn, data = list(files.items())[0]
+    content_type = {
+      "ssp.md": "text/markdown",
+      "ssp.csv": "text/csv",
+    }.get(fn, "application/x-yaml")
+    return (fn, data, content_type)
+
+  import io, zipfile
+  buf = io.BytesIO()
+  with zipfile.ZipFile(buf, "w", zipfile.ZIP_DEFLATED) as z:
+    for fn, data in sorted(files.items()):
+      z.writestr(fn, data)
+  return ("exports-{}.zip".format(job["format"].replace(".", "-")), buf.getvalue(), "application/zip")
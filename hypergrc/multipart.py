@@ -0,0 +1,106 @@
+# A streaming reader for multipart/form-data request bodies, so that large
+# uploads can be processed line by line as they are received rather than read
+# into memory first.
+#
+# Usage:
+#
+#   for part in MultipartReader(request.rfile, boundary, content_length):
+#     part.name, part.filename    # from the Content-Disposition header
+#     for line in part:           # bytes, including line endings
+#       ...
+#
+# Each part must be read (or skipped by moving on to the next part) before
+# the next one.
+
+class MultipartReader:
+  def __init__(self, stream, boundary, content_length):
+    if not boundary:
+      raise ValueError("The multipart/form-data request has no boundary.")
+    self.stream = stream
+    self.remaining = content_length
+    self.delimiter = b"--" + boundary.encode("ascii")
+    self.done = False
+
+    # Skip the preamble up to the first delimiter.
+    while True:
+      line = self.readline()
+      if not line:
+        raise ValueError("The multipart/form-data request body is empty.")
+      if self.is_delimiter(line) is not None:
+        self.done = self.is_delimiter(line)
+        break
+
+  def readline(self):
+    # Read a line without reading past the end of the request body.
+    if self.remaining <= 0:
+      return b""
+    line = self.stream.readline(self.remaining)
+    self.remaining -= len(line)
+    return line
+
+  def is_delimiter(self, line):
+    # Returns None if the line isn't a delimiter, False if it starts another
+    # part, and True if it ends the body.
+    if not line.startswith(self.delimiter):
+      return None
+    rest = line[len(self.delimiter):].rstrip(b"\r\n")
+    if rest == b"--":
+      return True
+    if rest.strip() == b"":
+      return False
+    return None
+
+  def __iter__(self):
+    while not self.done:
+      # Read the part's headers.
+      headers = { }
+      while True:
+        line = self.readline()
+        if not line:
+          raise ValueError("The multipart/form-data request body ended unexpectedly.")
+        if line in (b"\r\n", b"\n"):
+          break
+        name, _, value = line.decode("utf8", "replace").partition(":")
+        headers[name.strip().lower()] = value.strip()
+      part = Part(self, headers)
+      yield part
+      for line in part:
+        pass # skip whatever the caller didn't read
+
+class Part:
+  def __init__(self, reader, headers):
+    import cgi
+    self.reader = reader
+    self.headers = headers
+    disposition, params = cgi.parse_header(headers.get("content-disposition", ""))
+    self.name = params.get("name")
+    self.filename = params.get("filename")
+    self.finished = False
+
+  def __iter__(self):
+    # Yield the lines of the part's body. The line break before the next
+    # delimiter belongs to the delimiter, so each line is held back until we
+    # know whether the next line is a delimiter.
+    previous = None
+    while not self.finished:
+      line = self.reader.readline()
+      if not line:
+        raise ValueError("The multipart/form-data request body ended unexpectedly.")
+      delimiter = self.reader.is_delimiter(line) if (previous is None or previous.endswith(b"\n")) else None
+      if delimiter is not None:
+        self.finished = True
+        self.reader.done = delimiter
+        if previous is not None:
+          if previous.endswith(b"\r\n"):
+            previous = previous[:-2]
+          elif previous.endswith(b"\n"):
+            previous = previous[:-1]
+          if previous:
+            yield previous
+        return
+      if previous is not None:
+        yield previous
+      previous = line
+
+  def read(self):
+    return b"".join(self)
@@ -3,11 +3,226 @@
 import os.path
 import re
 import shutil
+import threading
 from urllib.parse import quote_plus
 from collections import OrderedDict
 
 import rtyaml
 
+# Parsed YAML files are cached in memory so that pages and exports that touch
+# every file in a project only re-parse the files that actually changed. Each
+# entry is keyed on the file's path and remembers the file's signature (see
+# get_file_signature) at the time it was parsed. The cached data is shared
+# between callers, so callers must not modify what load_opencontrol_yaml returns.
+_yaml_cache = { }
+
+# SHA-256 digests of file contents, also keyed on path and file signature.
+_digest_cache = { }
+
+# Content that write_file has deferred writing to disk because the write-behind
+# queue is enabled (see writebehind.py), keyed on path, as (content, SHA-256
+# digest). Reads of these files see this content instead of what's on disk.
+_unflushed = { }
+
+# When the write-behind queue is enabled, a function that write_file calls
+# with a file's path after putting its new content in _unflushed.
+defer_write = None
+
+def get_file_signature(fn):
+    # Return a cheap fingerprint of a file's current state, its modification
+    # time and size, which changes whenever the file is rewritten.
+    st = os.stat(fn)
+    return (st.st_mtime_ns, st.st_size)
+
+def get_file_digest(fn):
+    # Return a hex SHA-256 hash of a file's content. The hash is cached and
+    # only recomputed when the file's signature changes.
+    unflushed = _unflushed.get(os.path.normpath(fn))
+    if unflushed is not None:
+        return unflushed[1]
+    signature = get_file_signature(fn)
+    fn = os.path.normpath(fn)
+    if fn in _digest_cache and _digest_cache[fn][0] == signature:
+        return _digest_cache[fn][1]
+    import hashlib
+    hasher = hashlib.sha256()
+    with open(fn, "rb") as f:
+        for chunk in iter(lambda : f.read(65536), b""):
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+    _digest_cache[fn] = (signature, digest)
+    return digest
+
+def invalidate_file_cache(fn):
+    # Forget cached data for a file. hyperGRC calls this after writing a file
+    # so that the next read sees the new content even if the file's modification
+    # time did not visibly change.
+    fn = os.path.normpath(fn)
+    _yaml_cache.pop(fn, None)
+    _digest_cache.pop(fn, None)
+
+# Functions to call when a data file changes. hyperGRC's writers call
+# notify_file_changed after writing a file, and in-memory indexes built from
+# the data files register listeners here to update themselves. Listeners are
+# called with the path to the changed file.
+_change_listeners = [ ]
+
+def add_change_listener(listener):
+    _change_listeners.append(listener)
+
+def notify_file_changed(fn):
+    invalidate_file_cache(fn)
+    for listener in _change_listeners:
+        try:
+            listener(os.path.normpath(fn))
+        except Exception:
+            # A broken index shouldn't stop the write from completing.
+            import traceback
+            traceback.print_exc()
+
+# Functions to call when hyperGRC adds or updates a control narrative part,
+# with the component and the part's old and new values (see get_part_change),
+# so that running totals can be adjusted without re-reading the component.
+# old is None when a part is added.
+_control_listeners = [ ]
+
+def add_control_listener(listener):
+    _control_listeners.append(listener)
+
+def notify_control_changed(component, old, new):
+    for listener in _control_listeners:
+        try:
+            listener(component, old, new)
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+def get_part_change(controlimpl, narrative, implementation_status):
+    return {
+        "standard": controlimpl["standard"]["id"],
+        "control": controlimpl["control"]["id"],
+        "control_part": controlimpl.get("control_part") or None,
+        "narrative": narrative,
+        "implementation_status": implementation_status or "",
+    }
+
+# hyperGRC's writers lock each data file they change (see get_file_lock) from
+# reading the file until their change listeners have run, so that two writers
+# never interleave their read-modify-write cycles and the file watcher (see
+# watcher.py) never mistakes hyperGRC's own writes for changes made outside of
+# hyperGRC.
+class FileLock:
+    # An exclusive lock on a file path. Threads of this process serialize on
+    # thread_lock, and other processes on an advisory lock on a lock file in
+    # the system's temporary directory, where fcntl is available. The lock is
+    # re-entrant within a thread.
+    def __init__(self, fn):
+        self.fn = fn
+        self.thread_lock = threading.RLock()
+        self.depth = 0
+        self.lock_file = None
+
+    def __enter__(self):
+        self.thread_lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            try:
+                import fcntl
+            except ImportError:
+                return self # e.g. on Windows
+            import tempfile
+            lock_dir = os.path.join(tempfile.gettempdir(), "hypergrc-locks")
+            os.makedirs(lock_dir, exist_ok=True)
+            self.lock_file = open(os.path.join(lock_dir, short_hash(self.fn, 32) + ".lock"), "a")
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0 and self.lock_file is not None:
+            self.lock_file.close() # releases the advisory lock
+            self.lock_file = None
+        self.thread_lock.release()
+
+_file_locks = { }
+_file_locks_lock = threading.Lock()
+
+def get_file_lock(fn):
+    fn = os.path.abspath(fn)
+    with _file_locks_lock:
+        if fn not in _file_locks:
+            _file_locks[fn] = FileLock(fn)
+        return _file_locks[fn]
+
+class ConflictError(ValueError):
+    # Raised when a writer is given the content hash of a file as the caller
+    # last read it and the file has changed since then, e.g. because a
+    # teammate saved a narrative in the same file.
+    pass
+
+def read_file_for_update(fn, expected_digest=None):
+    # Read a file that is about to be changed. The caller must hold the file's
+    # lock. If expected_digest is given and the file's content no longer has
+    # that hash, raise ConflictError rather than let the caller overwrite a
+    # change it hasn't seen.
+    import hashlib
+    unflushed = _unflushed.get(os.path.normpath(fn))
+    if unflushed is not None:
+        content, digest = unflushed
+    else:
+        with open(fn, "rb") as f:
+            content = f.read()
+        digest = hashlib.sha256(content).hexdigest()
+        content = content.decode("utf8")
+    if expected_digest and digest != expected_digest:
+        raise ConflictError("{} was changed by someone else after you opened it. Reload the page to see the latest version before saving.".format(fn))
+    return content
+
+def write_file(fn, content):
+    # Replace a file's content. The caller should hold the file's lock. If the
+    # write-behind queue is enabled, existing files are written later (see
+    # flush_file) and reads see the new content in the meanwhile.
+    if defer_write is not None and os.path.exists(fn):
+        import hashlib
+        _unflushed[os.path.normpath(fn)] = (content, hashlib.sha256(content.encode("utf8")).hexdigest())
+        defer_write(os.path.normpath(fn))
+        return
+    write_file_now(fn, content)
+
+def is_unflushed(fn):
+    # Is there content for the file that write_file hasn't written yet?
+    return os.path.normpath(fn) in _unflushed
+
+def flush_file(fn):
+    # Write the content that write_file deferred writing for a file, if any.
+    # Returns True if the file was written.
+    fn = os.path.normpath(fn)
+    with get_file_lock(fn):
+        if fn not in _unflushed:
+            return False
+        write_file_now(fn, _unflushed[fn][0])
+        del _unflushed[fn]
+        notify_file_changed(fn)
+        return True
+
+def write_file_now(fn, content):
+    # Replace a file's content atomically: write the new content to a temporary
+    # file in the same directory, flush it to disk, and rename it over the file,
+    # so that a crash never leaves a partially written file behind.
+    import tempfile
+    fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(fn) or ".", prefix="." + os.path.basename(fn) + ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "w", encoding="utf8", newline="") as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        if os.path.exists(fn):
+            shutil.copymode(fn, temp_fn)
+        os.replace(temp_fn, fn)
+    except:
+        os.unlink(temp_fn)
+        raise
+
 def load_opencontrol_yaml(fn, schema_type, expected_schema_versions):
     # Load a YAML file holding a mapping, and check that its schema_version is recognized.
     # Specify the encoding explicitly because YAML files are always(?) UTF-8 encoded and
@@ -15,25 +230,39 @@ def load_opencontrol_yaml(fn, schema_type, expected_schema_versions):
     # the system locale). schema_type holds e.g. "system", "standards", or "component," a
     # string to display to the user describing the type of file expected in error messages.
     try:
-        with open(fn, encoding="utf8") as f:
-            try:
-                opencontrol = rtyaml.load(f)
-            except Exception as e:
-                raise ValueError("OpenControl {} file {} has invalid data (is not valid YAML: {}).".format(
-                    schema_type,
-                    fn,
-                    str(e) ))
-            if not isinstance(opencontrol, dict):
-                raise ValueError("OpenControl {} file {} has invalid data (should be a mapping, is a {}).".format(
-                    schema_type,
-                    fn,
-                    type(opencontrol) ))
-            if expected_schema_versions and opencontrol.get("schema_version") not in expected_schema_versions:
-                raise ValueError("Don't know how to read OpenControl {} file {} which has unsupported schema_version {}.".format(
-                    schema_type,
-                    fn,
-                    repr(opencontrol.get("schema_version"))))
-            return opencontrol
+        cache_key = os.path.normpath(fn)
+        unflushed = _unflushed.get(cache_key)
+        if unflushed is not None:
+            # Read the content that's waiting to be written to the file.
+            import io
+            signature = ("unflushed", unflushed[1])
+            open_file = lambda : io.StringIO(unflushed[0])
+        else:
+            signature = get_file_signature(fn)
+            open_file = lambda : open(fn, encoding="utf8")
+        if cache_key in _yaml_cache and _yaml_cache[cache_key][0] == signature:
+            opencontrol = _yaml_cache[cache_key][1]
+        else:
+            with open_file() as f:
+                try:
+                    opencontrol = rtyaml.load(f)
+                except Exception as e:
+                    raise ValueError("OpenControl {} file {} has invalid data (is not valid YAML: {}).".format(
+                        schema_type,
+                        fn,
+                        str(e) ))
+            _yaml_cache[cache_key] = (signature, opencontrol)
+        if not isinstance(opencontrol, dict):
+            raise ValueError("OpenControl {} file {} has invalid data (should be a mapping, is a {}).".format(
+                schema_type,
+                fn,
+                type(opencontrol) ))
+        if expected_schema_versions and opencontrol.get("schema_version") not in expected_schema_versions:
+            raise ValueError("Don't know how to read OpenControl {} file {} which has unsupported schema_version {}.".format(
+                schema_type,
+                fn,
+                repr(opencontrol.get("schema_version"))))
+        return opencontrol
     except IOError as e:
         raise ValueError("OpenControl {} file {} could not be loaded: {}.".format(
             schema_type,
@@ -222,21 +451,40 @@ def make_control_number_sort_key(s):
     import re
     return tuple(intify(part) for part in re.split(r"(\d+)", s or ""))
 
-def load_project_standards(project):
-    # Return a mapping from standard_keys to parsed standard data.
-
-    standards = { }
+def get_project_standard_files(project):
+    # Return the paths to the standard files used by a project.
 
     # Open the OpenControl system file (the project) and check that its schema_version
     # is something we recognize...
     fn1 = os.path.join(project["path"], "opencontrol.yaml")
     system_opencontrol = load_opencontrol_yaml(fn1, "system", ("1.0.0",))
 
+    # The system has a list of standards. The paths are relative to the
+    # opencontrol.yaml directory.
+    return [
+        os.path.join(project["path"], standard_fn)
+        for standard_fn in system_opencontrol["standards"]
+    ]
+
+def get_project_crosswalk_files(project):
+    # Return the paths to the crosswalk files used by a project. Crosswalks map
+    # the controls of one standard to the controls of another (see crosswalk.py).
+    # They are a hyperGRC extension to OpenControl, listed in an optional
+    # "crosswalks" key in the system opencontrol.yaml file.
+    fn1 = os.path.join(project["path"], "opencontrol.yaml")
+    system_opencontrol = load_opencontrol_yaml(fn1, "system", ("1.0.0",))
+    return [
+        os.path.join(project["path"], crosswalk_fn)
+        for crosswalk_fn in system_opencontrol.get("crosswalks", [])
+    ]
+
+def load_project_standards(project):
+    # Return a mapping from standard_keys to parsed standard data.
+
+    standards = { }
+
     # The system has a list of standards. Load all of them.
-    for standard_fn in system_opencontrol["standards"]:
-        # The path is relative to the opencontrol.yaml directory.
-        standard_fn = os.path.join(project["path"], standard_fn)
-        
+    for standard_fn in get_project_standard_files(project):
         # Each standard file contains a standard. The schema version for the
         # standard isn't specified, so we'll assume it's the current schema
         # version.
@@ -345,6 +593,17 @@ def get_matched_control(control_id, standard):
     # Control isn't found at all. Return the original control_id unchanged.
     return control_id
 
+def get_control_family_id(standard_id, control_id, standards):
+    # Return the ID of the family of a control, the same way that
+    # load_project_component_controls determines it.
+    standard = standards.get(standard_id)
+    if standard:
+        control = standard["controls"].get(control_id) \
+               or standard["controls"].get(get_matched_control(control_id, standard))
+        if control and control.get("family") in standard["families"]:
+            return standard["families"][control["family"]]["id"]
+    return control_id.split("-")[0]
+
 def transform_list(array, source_file, file_loader, transformer):
     # Loop over the elements.
     for item in array:
@@ -376,7 +635,11 @@ def load_project_component_controls(component, standards):
     # by the component listed in a particular source file.
     def file_loader(fn):
         return load_opencontrol_yaml(fn, "component", None).get("satisfies", [])
+    source_file_digests = { }
     def transformer(control, source_file):
+        if source_file not in source_file_digests:
+            source_file_digests[source_file] = get_file_digest(source_file)
+
         # This record holds a control number and narrative.
         #
         # Actually it holds a list of narratives for one or more control *parts*.
@@ -437,6 +700,10 @@ def load_project_component_controls(component, standards):
             # The local path to the YAML file containing this data --- which we use for finding
             # the file we need when we want to edit the control implementation.
             "source_file": os.path.normpath(source_file),
+
+            # The hash of the file's content, which editors send back when saving so
+            # that they don't overwrite changes they haven't seen.
+            "source_file_digest": source_file_digests[source_file],
         }
 
         # Augment the control information from the standards if the control is found in the
@@ -507,6 +774,7 @@ def load_project_component_evidence(component):
             "name": verification.get("name") or verification["key"],
             "path": os.path.join(component["path"], verification["path"]),
             "type": verification.get("type"),
+            "sha256": verification.get("sha256"), # not in OpenControl spec
             "component": component,
             "source_file": source_file,
         }
@@ -514,6 +782,144 @@ def load_project_component_evidence(component):
     # Yield the evidence in the "verifications" key.
     yield from transform_list(component_opencontrol.get("verifications", []), fn, file_loader=file_loader, transformer=transformer)
 
+def get_project_team_file(project):
+    return os.path.join(project["path"], "team", "team.yaml")
+
+def load_project_teams(project):
+    # Return a list of the project's teams, each holding its name and its
+    # members, and the list of the team files that were read.
+    #
+    # team/team.yaml lists the members of the project's team. Like component
+    # files, it may also list the names of other files, relative to the file
+    # they are listed in, which contain more members. Each of those files is
+    # a team of its own with its own name (by default the name of the top-level
+    # team and the file's path), and may list further files. Files with no
+    # members of their own, such as a team.yaml that only lists other files,
+    # aren't returned as teams. This isn't part of OpenControl.
+    fn = get_project_team_file(project)
+    team_data = load_opencontrol_yaml(fn, "team", None)
+    teams = OrderedDict() # normalized source file => team
+
+    def add_team(data, source_file, default_name):
+        teams[os.path.normpath(source_file)] = {
+            "name": data.get("name") or default_name,
+            "source_file": os.path.normpath(source_file),
+            "members": [],
+        }
+    add_team(team_data, fn, "Team")
+
+    # Read each file that is listed, and a file listed more than once only once.
+    def file_loader(inner_fn):
+        if os.path.normpath(inner_fn) in teams:
+            return []
+        inner_team = load_opencontrol_yaml(inner_fn, "team", None)
+        add_team(inner_team, inner_fn, "{}-{}".format(
+            teams[os.path.normpath(fn)]["name"],
+            os.path.relpath(inner_fn, os.path.dirname(fn))))
+        return inner_team.get("team", [])
+    def transformer(member, source_file):
+        yield member, source_file
+    for member, source_file in transform_list(team_data.get("team", []), fn, file_loader=file_loader, transformer=transformer):
+        if isinstance(member, dict):
+            teams[os.path.normpath(source_file)]["members"].append(member)
+
+    return [team for team in teams.values() if team["members"]], list(teams)
+
+def get_component_source_files(component):
+    # Return the paths to the YAML files that define a component: its component.yaml
+    # file and any files it lists (recursively) in its "satisfies" and "verifications"
+    # keys. See transform_list.
+    fn = os.path.join(component["path"], "component.yaml")
+    source_files = [os.path.normpath(fn)]
+    def walk(array, source_file, key):
+        for item in array:
+            if isinstance(item, str):
+                inner_fn = os.path.join(os.path.dirname(source_file), item)
+                if os.path.normpath(inner_fn) not in source_files:
+                    source_files.append(os.path.normpath(inner_fn))
+                    walk(load_opencontrol_yaml(inner_fn, "component", None).get(key, []), inner_fn, key)
+    component_opencontrol = load_opencontrol_yaml(fn, "component", ("3.0.0",))
+    walk(component_opencontrol.get("satisfies", []), fn, "satisfies")
+    walk(component_opencontrol.get("verifications", []), fn, "verifications")
+    return source_files
+
+def get_project_source_files(project):
+    # Return the paths to all of the YAML files that hyperGRC reads for a project:
+    # the system opencontrol.yaml file, its standards, certifications, and
+    # crosswalks, and the files that define each component.
+    fn1 = os.path.join(project["path"], "opencontrol.yaml")
+    system_opencontrol = load_opencontrol_yaml(fn1, "system", ("1.0.0",))
+    source_files = [os.path.normpath(fn1)]
+    source_files.extend(os.path.normpath(fn) for fn in get_project_standard_files(project))
+    for certification_fn in system_opencontrol.get("certifications", []):
+        source_files.append(os.path.normpath(os.path.join(project["path"], certification_fn)))
+    source_files.extend(os.path.normpath(fn) for fn in get_project_crosswalk_files(project))
+    for component in load_project_components(project):
+        source_files.extend(get_component_source_files(component))
+    return source_files
+
+def get_project_digest(project):
+    # Return a hex SHA-256 hash over the content of every file that hyperGRC reads
+    # for a project, which changes whenever any of the project's data changes.
+    import hashlib
+    hasher = hashlib.sha256()
+    for fn in get_project_source_files(project):
+        hasher.update(os.path.relpath(fn, start=project["path"]).encode("utf8"))
+        hasher.update(get_file_digest(fn).encode("ascii"))
+    return hasher.hexdigest()
+
+# JSON projections of the data structures above. The data structures link to
+# each other (a control implementation holds its component, which holds its
+# project), so rather than serializing the whole graph, JSON responses use
+# these shallow projections which refer to linked objects by ID and URL.
+
+def get_project_json(project):
+    return {
+        "id": project["id"],
+        "title": project["title"],
+        "url": project["url"],
+        "organization": {
+            "id": project["organization"]["id"],
+            "name": project["organization"]["name"],
+        },
+    }
+
+def get_component_json(component):
+    return {
+        "id": component["id"],
+        "name": component["name"],
+        "url": component["url"],
+        "project": component["project"]["id"],
+    }
+
+def get_controlimpl_json(controlimpl):
+    # Control implementations that are being created from form fields only
+    # have some of these fields, so we use .get() for the optional ones.
+    control = controlimpl["control"]
+    return {
+        "component": get_component_json(controlimpl["component"]) if controlimpl.get("component") else None,
+        "standard": {
+            "id": controlimpl["standard"]["id"],
+            "name": controlimpl["standard"].get("name"),
+        },
+        "family": {
+            "id": controlimpl["family"]["id"],
+            "name": controlimpl["family"]["name"],
+        } if controlimpl.get("family") else None,
+        "control": {
+            "id": control["id"],
+            "number": control.get("number"),
+            "name": control.get("name"),
+            "url": control.get("url"),
+        },
+        "control_part": controlimpl.get("control_part"),
+        "narrative": controlimpl["narrative"],
+        "implementation_status": controlimpl.get("implementation_status"),
+        "evidence": controlimpl.get("evidence", []),
+        "source_file": controlimpl.get("source_file"),
+        "source_file_digest": controlimpl.get("source_file_digest"),
+    }
+
 def get_new_system_defaults():
 
     organization_name = "My Organization"
@@ -646,13 +1052,16 @@ def create_component(project, component_path, component_name):
     os.makedirs(os.path.join(project['path'], component_path))
 
     # Write the component.yaml file.
-    with open(os.path.join(project['path'], component_path, 'component.yaml'), 'w', encoding="utf8") as f:
-        f.write(rtyaml.dump(component_opencontrol))
+    fn = os.path.join(project['path'], component_path, 'component.yaml')
+    with get_file_lock(fn):
+        write_file(fn, rtyaml.dump(component_opencontrol))
+        notify_file_changed(fn)
 
     # Add the path to the project's opencontrol.yaml file.
-    with open(os.path.join(project["path"], 'opencontrol.yaml'), "r+", encoding="utf8") as f:
+    fn = os.path.join(project["path"], 'opencontrol.yaml')
+    with get_file_lock(fn):
         # Parse the content.
-        data = rtyaml.load(f)
+        data = rtyaml.load(read_file_for_update(fn))
 
         # Create the "components" array if it does not exist.
         if not isinstance(data.get("components"), list):
@@ -662,9 +1071,8 @@ def create_component(project, component_path, component_name):
         data["components"].append(component_path)
 
         # Write back out to the data files.
-        f.seek(0);
-        f.truncate()
-        rtyaml.dump(data, f)
+        write_file(fn, rtyaml.dump(data))
+        notify_file_changed(fn)
 
     # Read the component back and return it.
     for component in load_project_components(project):
@@ -682,6 +1090,7 @@ def clean_text(text):
   # newline at the end of each line, including the last
   # line.
   import re
+  text = text.replace("\r\n", "\n").replace("\r", "\n")
   text = text.strip()
   text = re.sub(r"[ \t]+\n", "\n", text)
   if not text: # empty
@@ -690,51 +1099,123 @@ def clean_text(text):
     text += "\n"
   return text
 
-def update_component_control(controlimpl):
-    # Clean the inputs. Update controlimpl so the caller has the actual values we saved here.
-    controlimpl["narrative"] = clean_text(controlimpl["narrative"])
-    if controlimpl["implementation_status"]:
-        controlimpl["implementation_status"] = clean_text(controlimpl["implementation_status"])
-
-    # The control is defined in the component.yaml file given in controlimpl["source_file"].
-    # Open that file for editing, find the control record, update it, and return.
-    with open(controlimpl["source_file"], "r+", encoding="utf8") as f:
-        # Parse the content.
-        data = rtyaml.load(f)
-
-        # Look for a matching control entry.
-        for control in data["satisfies"]:
-            # Skip over entries that are strings -- they hold (OpenControl non-conformant) filenames.
-            if not isinstance(control, dict):
-                continue
-
-            if control["standard_key"] == controlimpl["standard"]["id"] \
-              and control["control_key"] == controlimpl["control"]["id"]:
-
-                for narrative_part in control.get("narrative", []):
-                    if narrative_part.get("key") == controlimpl.get("control_part"):
-                        
-                        # Found the right entry. Update the fields.
-
-                        narrative_part["text"] = controlimpl["narrative"]
-
-                        # Store implementation_status here. In OpenControl there is
-                        # a `implementation_statuses` on the control. But our data
-                        # model has a single implementation_status per control *part*.
-                        # If the implementation status is cleared, remove the key.
-                        if controlimpl["implementation_status"]:
-                            narrative_part["implementation_status"] = controlimpl["implementation_status"]
-                        elif "implementation_status" in narrative_part:
-                            del narrative_part["implementation_status"]
-
-                        # Write back out to the data files.
-                        f.seek(0);
-                        f.truncate()
-                        rtyaml.dump(data, f)
+def index_narrative_parts(data):
+    # Map each (standard key, control key, control part) in the parsed content
+    # of a component file to its narrative part. If a narrative part occurs
+    # more than once, the first one is used.
+    index = { }
+    for control in data.get("satisfies", []):
+        # Skip over entries that are strings -- they hold (OpenControl non-conformant) filenames.
+        if not isinstance(control, dict):
+            continue
+        for narrative_part in control.get("narrative", []):
+            index.setdefault((control["standard_key"], control["control_key"], narrative_part.get("key")), narrative_part)
+    return index
 
-                        return True
+def update_component_control(controlimpl):
+    # Update a control implementation's narrative part. Returns True if the
+    # part was found in its source file and updated. Raises ConflictError if
+    # controlimpl has a source_file_digest and the file has changed since,
+    # and raises the error if the file couldn't be read or written.
+    result = update_component_controls([controlimpl])[controlimpl["source_file"]]
+    if isinstance(result, ConflictError) or (isinstance(result, Exception) and not isinstance(result, ValueError)):
+        raise result
+    return result is True
+
+def update_component_controls(controlimpls):
+    # Update the narrative parts of many control implementations, reading and
+    # writing each source file once. The changes to a file are made together
+    # or not at all. If a narrative part is given more than once, the last
+    # change wins. If a controlimpl has a source_file_digest, the content hash
+    # of its source file when the caller read it, the file must not have
+    # changed since. Returns a dict mapping each source file to True if its
+    # changes were made, or else to the exception saying why not: a ValueError
+    # (a ConflictError if the file changed), or another error if the file
+    # couldn't be read, parsed, or written, so that the outcome of every file is
+    # reported even if one fails after others were saved. Each saved
+    # controlimpl's source_file_digest is updated to the file's new content hash.
+    changes = OrderedDict() # source file => { (standard, control, control part) => controlimpl }
+    for controlimpl in controlimpls:
+        # Clean the inputs. Update controlimpl so the caller has the actual values we saved here.
+        controlimpl["narrative"] = clean_text(controlimpl["narrative"])
+        if controlimpl["implementation_status"]:
+            controlimpl["implementation_status"] = clean_text(controlimpl["implementation_status"])
+        key = (controlimpl["standard"]["id"], controlimpl["control"]["id"], controlimpl.get("control_part") or None)
+        changes.setdefault(controlimpl["source_file"], OrderedDict())[key] = controlimpl
+
+    results = { }
+    for source_file, file_changes in changes.items():
+        try:
+            with get_file_lock(source_file):
+                update_narrative_parts(source_file, file_changes)
+            results[source_file] = True
+        except ValueError as e:
+            results[source_file] = e
+        except Exception as e:
+            import traceback
+            traceback.print_exc()
+            results[source_file] = e
+    return results
+
+def update_narrative_parts(source_file, changes):
+    # Apply changes, a dict mapping (standard, control, control part) to a
+    # controlimpl with new values, to a component file. Must be called with
+    # the file's lock held. Raises ValueError if a narrative part isn't found.
+    expected_digests = { controlimpl.get("source_file_digest") for controlimpl in changes.values() } - { None }
+    if len(expected_digests) > 1:
+        raise ConflictError("The changes to {} were made to different versions of the file.".format(source_file))
+    content = read_file_for_update(source_file, expected_digests.pop() if expected_digests else None)
+
+    # Most edits only replace narrative parts' text and status, so splice the
+    # new values into the file in place of the old ones (see yamlpatch.py).
+    from . import yamlpatch
+    patch = yamlpatch.patch_narrative_parts(content, [
+        key + (controlimpl["narrative"], controlimpl["implementation_status"])
+        for key, controlimpl in changes.items()
+    ])
+    if patch is not None:
+        new_content, old_values = patch
 
-    return False
+    else:
+        # The edits change the file's structure, so parse the whole file, find
+        # the control records, update them, and dump the whole file.
+        data = rtyaml.load(content)
+        narrative_parts = index_narrative_parts(data)
+        if any(key not in narrative_parts for key in changes):
+            raise ValueError("No changes were made to {} because a control being updated is missing from it.".format(source_file))
+
+        old_values = []
+        for key, controlimpl in changes.items():
+            narrative_part = narrative_parts[key]
+            old_values.append((narrative_part.get("text"), narrative_part.get("implementation_status")))
+            narrative_part["text"] = controlimpl["narrative"]
+
+            # Store implementation_status here. In OpenControl there is
+            # a `implementation_statuses` on the control. But our data
+            # model has a single implementation_status per control *part*.
+            # If the implementation status is cleared, remove the key.
+            if controlimpl["implementation_status"]:
+                narrative_part["implementation_status"] = controlimpl["implementation_status"]
+            elif "implementation_status" in narrative_part:
+                del narrative_part["implementation_status"]
+
+        new_content = rtyaml.dump(data)
+        if "\r\n" in content:
+            # Keep the file's Windows line endings.
+            new_content = new_content.replace("\n", "\r\n")
+
+    # Write back out to the data file, unless nothing changed.
+    if new_content != content:
+        write_file(source_file, new_content)
+        notify_file_changed(source_file)
+        for controlimpl, (old_narrative, old_implementation_status) in zip(changes.values(), old_values):
+            notify_control_changed(controlimpl["component"],
+                get_part_change(controlimpl, old_narrative, old_implementation_status),
+                get_part_change(controlimpl, controlimpl["narrative"], controlimpl["implementation_status"]))
+
+    digest = get_file_digest(source_file)
+    for controlimpl in changes.values():
+        controlimpl["source_file_digest"] = digest
 
 def add_component_control(component, controlimpl):
     # Append the control to the component. controlimpl must have
@@ -748,10 +1229,10 @@ def add_component_control(component, controlimpl):
     if controlimpl["implementation_status"]:
         controlimpl["implementation_status"] = clean_text(controlimpl["implementation_status"])
 
-    # Open the source file.
-    with open(controlimpl["source_file"], "r+", encoding="utf8") as f:
+    # Lock the source file.
+    with get_file_lock(controlimpl["source_file"]):
         # Parse the content.
-        data = rtyaml.load(f)
+        data = rtyaml.load(read_file_for_update(controlimpl["source_file"], controlimpl.get("source_file_digest")))
 
         # Create the 'satisfies' key if it doesn't exist.
         data.setdefault("satisfies", [])
@@ -801,7 +1282,9 @@ def add_component_control(component, controlimpl):
         control["narrative"].append(narrative_part)
 
         # Write back out to the data files.
-        f.seek(0);
-        f.truncate()
-        rtyaml.dump(data, f)
+        write_file(controlimpl["source_file"], rtyaml.dump(data))
+        notify_file_changed(controlimpl["source_file"])
+        notify_control_changed(component, None,
+            get_part_change(controlimpl, controlimpl["narrative"], controlimpl["implementation_status"]))
+        controlimpl["source_file_digest"] = get_file_digest(controlimpl["source_file"])
 
@@ -36,6 +36,12 @@ def blockquote(s):
   return "\n".join((" " + line) for line in s.strip().split("\n")) + "\n"
 jinja_env.filters['blockquote'] = blockquote
 
+def format_timestamp(t):
+  # Format a Unix timestamp, e.g. a file modification time, in local time.
+  import datetime
+  return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M")
+jinja_env.filters['timestamp'] = format_timestamp
+
 def render_template(request, template_fn, **contextvars):
 	try:
 		template = jinja_env.get_template(template_fn)
@@ -56,6 +62,16 @@ def render_template(request, template_fn, **contextvars):
 
 def send_file_response(request, file_path, data, content_type="application/octet-stream"):
     # Form and send the response
+	send_file_response_headers(request, file_path, content_type)
+	request.wfile.write(data)
+
+def send_file_chunks_response(request, file_path, chunks, content_type="application/octet-stream"):
+	# Send a file download whose content is an iterator over text chunks,
+	# writing the chunks as they are generated.
+	send_file_response_headers(request, file_path, content_type)
+	write_chunks(request, chunks)
+
+def send_file_response_headers(request, file_path, content_type):
 	request.send_response(200)
 	request.send_header("Content-Type", content_type)
 	request.send_header('Content-Disposition', 'attachment; filename=' + os.path.basename(file_path))
@@ -70,7 +86,6 @@ def send_file_response(request, file_path, data, content_type="application/octet
 
 	# mimetype
 	request.end_headers()
-	request.wfile.write(data)
 
 def send_file(request, file_path):
 	"""Send a text or binary file"""
@@ -89,14 +104,66 @@ def send_file(request, file_path):
 		return
 	send_file_response(request, file_path, data)
 
+def send_cacheable_response(request, data, content_type, etag, max_age):
+	# Send data with an ETag header (a quoted string identifying this version
+	# of the data) and allow browsers to cache it for max_age seconds. If the
+	# browser already has this version, just tell it so.
+	if etag in [tag.strip() for tag in (request.headers.get("If-None-Match") or "").split(",")]:
+		request.send_response(304)
+		request.send_header("ETag", etag)
+		request.send_header("Cache-Control", "public, max-age={}".format(max_age))
+		request.end_headers()
+		return
+
+	request.send_response(200)
+	request.send_header("Content-Type", content_type)
+	request.send_header("Content-Length", str(len(data)))
+	request.send_header("ETag", etag)
+	request.send_header("Cache-Control", "public, max-age={}".format(max_age))
+	request.end_headers()
+	request.wfile.write(data)
+
 def redirect(request, url):
 	request.send_response(301)
 	request.send_header("Location", url)
 	request.end_headers()
 
-def send_json_response(request, data):
+def wants_pretty_json(request):
+	# Did the request ask for indented JSON with a ?pretty=1 query string?
+	query = urllib.parse.parse_qs(urllib.parse.urlsplit(request.path).query)
+	return query.get("pretty", [""])[0].lower() in ("1", "true", "yes")
+
+def iter_json(data, encoder):
+	# Yield the JSON encoding of data in chunks. Top-level lists are encoded
+	# one element at a time so that long lists are streamed without building
+	# the whole response in memory. Indented output is only for people reading
+	# the response, so it just uses the encoder's (slower) iterencode.
+	if encoder.indent is None and isinstance(data, (list, tuple)):
+		yield "["
+		for i, item in enumerate(data):
+			yield ("," if i > 0 else "") + encoder.encode(item)
+		yield "]"
+	elif encoder.indent is None:
+		yield encoder.encode(data)
+	else:
+		yield from encoder.iterencode(data)
+
+def send_json_response(request, data, status=200):
+	# Send data as JSON with the given HTTP status code. The JSON is compact
+	# unless the request has a ?pretty=1 query string. Callers should pass JSON-ready projections of the
+	# application's data structures (see e.g. opencontrol.get_controlimpl_json)
+	# rather than the data structures themselves, which embed their components
+	# and projects.
+	if wants_pretty_json(request):
+		encoder = json.JSONEncoder(indent=2)
+	else:
+		encoder = json.JSONEncoder(separators=(',', ':'))
+
+	# Encode the first chunk before sending the response headers so that
+	# errors in the common case of a single chunk still produce an error page.
+	chunks = iter_json(data, encoder)
 	try:
-		body = json.dumps(data, indent=2)
+		first_chunk = next(chunks, "")
 	except Exception as e:
 		import traceback
 		traceback.print_exc()
@@ -106,7 +173,21 @@ def send_json_response(request, data):
 		request.wfile.write(b"Ooops! Something went wrong.")
 		return
 
-	request.send_response(200)
+	request.send_response(status)
 	request.send_header("Content-Type", "application/json")
 	request.end_headers()
-	request.wfile.write(body.encode("utf8"))
+
+	write_chunks(request, chunks, first_chunk)
+
+def write_chunks(request, chunks, first_chunk=""):
+	# Write out text chunks as UTF-8, grouping small chunks into larger writes.
+	buf = [first_chunk]
+	buf_size = len(first_chunk)
+	for chunk in chunks:
+		buf.append(chunk)
+		buf_size += len(chunk)
+		if buf_size >= 65536:
+			request.wfile.write("".join(buf).encode("utf8"))
+			buf = []
+			buf_size = 0
+	request.wfile.write("".join(buf).encode("utf8"))
@@ -0,0 +1,186 @@
+# Routines for reading the list of compliance-as-code repositories
+# that hyperGRC opens.
+#
+# Repositories are listed on the command line and in listing files named
+# with an @-sign. A path ending in /** is a root directory that is scanned
+# for repositories, i.e. directories containing an opencontrol.yaml file,
+# down to a maximum depth. Repository paths are checked and root directories
+# are scanned in parallel because these checks spend most of their time
+# waiting on the file system, especially on network file systems.
+#
+# While the server is running, the listing files are watched (see watch), and
+# repositories added to or removed from them are opened or closed without a
+# restart.
+
+import fnmatch
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# The number of directories to check or scan at once.
+MAX_WORKERS = 32
+
+# How many directories below a root directory to look for repositories.
+DEFAULT_DISCOVER_DEPTH = 3
+
+# Directory names not to look in when scanning root directories.
+DEFAULT_IGNORE_PATTERNS = [".*", "node_modules", "__pycache__"]
+
+_lock = threading.Lock()
+_watching = None # (project list, args, discovery options) while watching
+_listeners = [ ]
+
+def read_project_list(args, max_depth=DEFAULT_DISCOVER_DEPTH, ignore_patterns=DEFAULT_IGNORE_PATTERNS):
+  # Return a list of paths to projects given command-line arguments. '@'
+  # prefixes are the Unixy-way of saying read a list from a file and use
+  # the contents of the listing file as if they were command-line arguments.
+  # Paths ending in /** are replaced with the projects found by scanning them.
+  projects = []
+  for project in args:
+    if project.startswith("@"):
+      # Read the listing file.
+      if not os.path.isfile(project[1:]):
+        raise ValueError("File `{}` listing Compliance as Code repositories was not found.".format(project[1:]))
+      with open(project[1:], 'r') as f:
+        for line in f:
+          line = line.strip()
+          if line and not line.startswith("#"):
+            projects.append(line)
+    else:
+      # Append this argument.
+      projects.append(project)
+
+  # Scan the root directories all together, and put the projects found in
+  # each in its place in the list.
+  roots = [project[:-3] or "/" for project in projects if project.endswith("/**")]
+  if roots:
+    found = discover_projects(roots, max_depth, ignore_patterns)
+    projects = [
+      path
+      for project in projects
+      for path in (found[project[:-3] or "/"] if project.endswith("/**") else [project])
+    ]
+
+  # Remove duplicates, such as a project listed and also found in a root directory.
+  seen = set()
+  unique_projects = []
+  for project in projects:
+    if os.path.abspath(project) not in seen:
+      seen.add(os.path.abspath(project))
+      unique_projects.append(project)
+  return unique_projects
+
+def discover_projects(roots, max_depth=DEFAULT_DISCOVER_DEPTH, ignore_patterns=DEFAULT_IGNORE_PATTERNS):
+  # Scan root directories for projects. Returns a dict mapping each root to
+  # the sorted list of project directories found within it. Directories are
+  # scanned level by level with each level's directories scanned in parallel.
+  # Directories within a project and symbolic links to directories are not
+  # looked in.
+  for root in roots:
+    if not os.path.isdir(root):
+      raise ValueError("Directory `{}` to search for Compliance as Code repositories was not found.".format(root))
+
+  def scan(path):
+    # Return whether path is a project and the subdirectories to look in.
+    # Entry types usually come from the directory listing itself, so this
+    # doesn't stat each entry.
+    is_project = False
+    subdirs = []
+    try:
+      with os.scandir(path) as entries:
+        for entry in entries:
+          if entry.name == "opencontrol.yaml" and entry.is_file():
+            is_project = True
+          elif entry.is_dir(follow_symlinks=False) \
+            and not any(fnmatch.fnmatch(entry.name, pattern) for pattern in ignore_patterns):
+            subdirs.append(entry.path)
+    except OSError as e:
+      print("[hyperGRC] could not scan {}: {}".format(path, e))
+    return is_project, subdirs
+
+  found = { root: [] for root in roots }
+  level = [(root, root) for root in found]
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    for depth in range(max_depth + 1):
+      next_level = []
+      for (root, path), (is_project, subdirs) in zip(level, executor.map(lambda item : scan(item[1]), level)):
+        if is_project:
+          found[root].append(path)
+        elif depth < max_depth:
+          next_level.extend((root, subdir) for subdir in subdirs)
+      level = next_level
+  return { root: sorted(projects) for root, projects in found.items() }
+
+def validate_project_path(project):
+  # Return an error message if the path is not a project directory, or
+  # None if it is. The common case takes one file system check.
+  if os.path.isfile(os.path.join(project, 'opencontrol.yaml')):
+    return None
+  if not os.path.isdir(project):
+    return "Path `{}` to Compliance as Code repository was not found.".format(project)
+  return "Path `{}` to Compliance as Code repository does not contain a file named opencontrol.yaml.".format(project)
+
+def validate_project_paths(projects):
+  # Check many project paths in parallel. Returns validate_project_path's
+  # result for each path.
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    return list(executor.map(validate_project_path, projects))
+
+#############################
+# Reloading
+#############################
+
+def add_listener(listener):
+  # Register a function to call with the lists of added and removed project
+  # paths when the project list is reloaded.
+  _listeners.append(listener)
+
+def watch(project_list, args, max_depth=DEFAULT_DISCOVER_DEPTH, ignore_patterns=DEFAULT_IGNORE_PATTERNS):
+  # Keep project_list, which was read from args, up to date as the listing
+  # files in args change, as reported by the file watcher.
+  global _watching
+  from . import watcher
+  _watching = (project_list, args, (max_depth, ignore_patterns))
+  for fn in get_listing_files(args):
+    watcher.watch_file(fn)
+  watcher.add_listener(on_file_changed)
+
+def get_listing_files(args):
+  return [os.path.normpath(arg[1:]) for arg in args if arg.startswith("@")]
+
+def on_file_changed(fn):
+  if _watching and fn in get_listing_files(_watching[1]):
+    reload()
+
+def reload():
+  # Read the project list again, replacing the list in place, and tell the
+  # listeners which projects were added and removed. Projects whose paths are
+  # not valid are left out rather than stopping the server. Does nothing if
+  # the project list isn't being watched.
+  if not _watching:
+    return
+  project_list, args, (max_depth, ignore_patterns) = _watching
+  with _lock:
+    try:
+      projects = read_project_list(args, max_depth, ignore_patterns)
+    except ValueError as e:
+      print("[hyperGRC] could not reload the list of repositories:", e)
+      return
+    errors = validate_project_paths(projects)
+    for error in errors:
+      if error:
+        print("[hyperGRC]", error)
+    projects = [project for project, error in zip(projects, errors) if not error]
+
+    added = [project for project in projects if project not in project_list]
+    removed = [project for project in project_list if project not in projects]
+    project_list[:] = projects
+
+  if added or removed:
+    print("[hyperGRC] reloaded the list of repositories: {} added, {} removed".format(len(added), len(removed)))
+  for listener in _listeners:
+    try:
+      listener(added, removed)
+    except Exception:
+      import traceback
+      traceback.print_exc()
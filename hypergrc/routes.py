@@ -1,11 +1,10 @@
 # This module contains hyperGRC's routes, i.e. handlers for
 # virtual paths.
 
-from .render import render_template, redirect, send_file, send_file_response, send_json_response
+from .render import render_template, redirect, send_file, send_file_response, send_file_chunks_response, send_json_response
 from . import opencontrol
+from . import search
 import os
-import glob
-import rtyaml
 
 PROJECT_LIST = []
 ROUTES = []
@@ -72,8 +71,9 @@ def route(path, methods=["GET"]):
 
 def load_projects():
     # Yield a dict of information for each project by reading the opencontrol.yaml
-    # file in each project directory.
-    for project_dir in PROJECT_LIST:
+    # file in each project directory. The list may be reloaded while we're
+    # iterating, so iterate over a copy.
+    for project_dir in list(PROJECT_LIST):
         yield opencontrol.load_project_from_path(project_dir)
 
 def load_project(organization_id, project_id):
@@ -86,14 +86,15 @@ def load_project(organization_id, project_id):
             return project
     raise ValueError("Project {} not found.".format(project_id))
 
-# Helper to retrive all document directories, included nested sub-directories
-def get_document_directories(project):
+def get_query_params(request):
+  # Return a dict of the query string parameters in the request path. For
+  # parameters given more than once, only the first value is returned.
+  import urllib.parse
+  query = urllib.parse.parse_qs(urllib.parse.urlsplit(request.path).query)
+  return { key: values[0] for key, values in query.items() }
 
-  # Temporarily hardcode the documents directory to "outputs".
-  # We are hardcoding the directory until we modify the opencontrol.yaml
-  # file to include a list of directories.
-  dir_list = [x[0] for x in os.walk(os.path.join(project["path"], "outputs"))]
-  return dir_list
+# The number of documents to list on each page of the documents page.
+DOCUMENTS_PER_PAGE = 100
 
 implementation_status_css_classes = {
   "In Place": "glyphicon glyphicon-ok-circle color-green",
@@ -183,35 +184,20 @@ def documents(request, organization, project):
     edit_dir = os.path.join(project["path"], "outputs")
     modify_msg = "To modify listed documents, change files in document directories of `{}`".format(edit_dir)
 
-    # Create variables for documents and message
-    docs = []
-    message = ""
-
-    # We want to be able to store documents in our repo.
-    # If document directories exists, read all the documents and append
-    # information on each document to the list of doc objects to pass to
-    # the page to be rendered.
-    document_dirs = get_document_directories(project)
-    for doc_dir_path in document_dirs:
-      # Skip anything that is not really a directory
-      if not os.path.isdir(doc_dir_path):
-        continue
-      else:
-        # Get the files from within the directory
-        docs_glob = doc_dir_path.rstrip('/') + "/*"
-        for doc in glob.glob(docs_glob):
-          # Skip any commonly found files that are MS Word document temp files 
-          if "~$" in os.path.basename(doc):
-            continue
-          if os.path.isfile(doc):
-            # Append found document file paths to our list of documents
-            docs.append({'name': os.path.basename(doc),
-                         'file_path': doc,
-                         'rel_file_path': doc.replace(os.path.join(project["path"], "outputs/"), "")
-                        })
+    # List one page of the documents from the project's document index.
+    from .docindex import list_documents, SORT_KEYS
+    params = get_query_params(request)
+    sort = params.get("sort") if params.get("sort") in SORT_KEYS else "name"
+    reverse = params.get("order") == "desc"
+    try:
+      page = max(int(params.get("page", 1)), 1)
+    except ValueError:
+      page = 1
+    docs, total = list_documents(project, sort, reverse, (page - 1) * DOCUMENTS_PER_PAGE, DOCUMENTS_PER_PAGE)
 
     # What? No documents found? Generate a message to display.
-    if len(docs) == 0:
+    message = ""
+    if total == 0:
       message += "No documents are listed in your repository."
 
     return render_template(request, 'documents.html',
@@ -219,6 +205,11 @@ def documents(request, organization, project):
                             organization=organization,
                             message=message,
                             documents=docs,
+                            total=total,
+                            page=page,
+                            pages=max((total + DOCUMENTS_PER_PAGE - 1) // DOCUMENTS_PER_PAGE, 1),
+                            sort=sort,
+                            order="desc" if reverse else "asc",
                             modify_msg=modify_msg
                           )
 
@@ -232,24 +223,14 @@ def document(request, organization, project, doc_file_path):
     except ValueError:
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
-    # Compute file path to file within project directory
-    # Currently, assume documents directory is 'outputs'
-    project_doc_dir = "outputs"
-    doc = os.path.join(project["path"], project_doc_dir, *doc_file_path.split(">"))
-
-    # TODO: Make sure this file exists and has no relative paths or goes to system directory
-    # We aren't too worried about security when user is running on their own workstation.
-    if os.path.isfile(doc):
-      fn, fe = os.path.splitext(doc)
-      if fe.lower() not in [".txt", ".conf", ".csv", ".md",
-                            ".xls", ".xlsx", ".doc", ".docx", ".jpeg", ".jpg", ".png", "gif", ".pdf"]:
-        message="Document type '{}'' of computed file request '{}' not supported.".format(fe, doc)
-        return message
-      else:
-        send_file(request, doc)
-    else:
-      message="Computed file request '{}' not found or is not a file.".format(doc)
-      return message
+    # Only documents in the project's document index can be downloaded, which
+    # also keeps the path within the documents directory.
+    from .docindex import get_document
+    try:
+      doc = get_document(project, doc_file_path.replace(">", "/"))
+    except ValueError as e:
+      return str(e)
+    send_file(request, doc["file_path"])
 
 @route('/organizations/<organization>/projects/<project>/team')
 def team(request, organization, project):
@@ -261,35 +242,14 @@ def team(request, organization, project):
     except ValueError:
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
-    teams = {}
-    # Read the team file
+    # Get the teams from the project's team index.
+    from .team import get_team_index
     try:
-      with open(os.path.join(project["path"], "team", "team.yaml"), encoding="utf8") as f:
-        team_data = rtyaml.load(f)
-        # Follow the code pattern from opencontrol.transform list
-        # to parse a team file that references other team file
-        # so we can refactor and combine in the future
-        source_file = os.path.join(project["path"], "team")
-        array = team_data["team"]
-        for item in array:
-        # If an entry is a string rather than a dict, then it names a file
-        # that we should read that contains more items of the same type.
-          if isinstance(item, str):
-            # Construct the path to the file, which is relative to the file
-            # it is listed in.
-            fn = os.path.join(os.path.dirname(source_file), "team", item)
-            inner_team = opencontrol.load_opencontrol_yaml(fn, "team", None)
-            inner_team_name = inner_team.get("name", team_data.get("name")+"-"+item)
-            inner_team_team = inner_team.get("team", [])
-            teams[inner_team_name] = inner_team_team
-          else:
-            # Only one team and captured in team.yaml file
-            teams[team_data.get("name")] = team_data.get("team", [])
-
+      teams = { team["name"]: team["members"] for team in get_team_index(project)["teams"] }
       message = None
-    except:
+    except ValueError:
       teams = []
-      message = ("Capture your team information in the file: `{}`.".format(os.path.join(project["path"], "team", "team.yaml")))
+      message = ("Capture your team information in the file: `{}`.".format(opencontrol.get_project_team_file(project)))
 
     # Prepare modify page message
     edit_file = os.path.join(project["path"], "team", "team.yaml")
@@ -302,6 +262,54 @@ def team(request, organization, project):
                           teams=teams
                           )
 
+@route('/api/organizations/<organization>/projects/<project>/team')
+def team_json(request, organization, project):
+    """Return the project's teams and the members with each role as JSON."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    from .team import get_team_index
+    try:
+      index = get_team_index(project)
+    except ValueError as e:
+      return str(e)
+    return send_json_response(request, {
+      "teams": [
+        { "name": team["name"], "members": team["members"] }
+        for team in index["teams"]
+      ],
+      "roles": {
+        role: [index["members"][key]["name"] for key in keys]
+        for role, keys in index["roles"].items()
+      },
+    })
+
+@route('/api/organizations/<organization>/projects/<project>/team/members')
+def team_members_json(request, organization, project):
+    """Look up team members by name, email, role, or team."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    # The query string may have any of name, email, role, and team. Members
+    # matching all of them are returned with all of their roles and teams.
+    from .team import get_team_index, find_members
+    try:
+      index = get_team_index(project)
+    except ValueError as e:
+      return str(e)
+    params = get_query_params(request)
+    return send_json_response(request, {
+      "members": find_members(index, params.get("name"), params.get("email"), params.get("role"), params.get("team")),
+    })
+
 @route('/settings')
 def settings(request):
     """Show settings"""
@@ -439,19 +447,21 @@ def component(request, organization, project, component_name):
     # For editing controls, we offer a list of evidence to attach to each control.
     evidence =  list(opencontrol.load_project_component_evidence(component))
     
-    # Make a sorted list of controls --- the control catalog --- that the user can
-    # draw from when adding new control implementations to the component.
-    control_catalog = []
-    for standard in standards.values():
-      for control in standard["controls"].values():
-          control = dict(control) # clone
-          control['standard'] = {
-            "id": standard["id"],
-            "name": standard["name"],
-          }
-          control['family'] = standard['families'].get(control['family'])
-          control_catalog.append(control)
-    control_catalog.sort(key = lambda control : control['sort_key'])
+    # Make a sorted list of the standards that the user can draw controls from when
+    # adding new control implementations to the component. The controls themselves
+    # are fetched from each standard's catalog.json, which browsers cache, and
+    # are looked up as the user types. See the .../standards/<standard_key> API routes.
+    from . import catalog
+    control_standards = [
+      {
+        "id": index["standard"]["id"],
+        "name": index["standard"]["name"],
+        "catalog_url": catalog.get_catalog_url(project, index),
+        "controls_url": catalog.get_standard_api_url(project, index) + "/controls",
+      }
+      for index in catalog.get_project_standard_indexes(project)
+    ]
+    control_standards.sort(key = lambda standard : standard["name"])
 
     # Also make a sorted list of source files containing control implementation text.
     # In OpenControl, all controls are in component.yaml. But we support breaking the
@@ -466,15 +476,16 @@ def component(request, organization, project, component_name):
     source_files = sorted(source_files, key = lambda s : (not s.endswith("component.yaml"), s))
 
     # Done.
+    from . import statistics
     return render_template(request, 'component.html',
                             project=project,
                             component=component,
                             control_families=control_families,
                             evidence=evidence,
-                            control_catalog=control_catalog, # used for creating a new control in the component
+                            control_standards=control_standards, # used for creating a new control in the component
                             source_files=source_files, # used for creating a new control in the component
                             implementation_status_css_classes=implementation_status_css_classes,
-                            stats=compute_control_implementation_statistics(controlimpls),
+                            stats=statistics.get_component_statistics(component, standards),
                           )
 
 @route('/organizations/<organization>/projects/<project>/components/<component_name>/statistics.json')
@@ -488,60 +499,10 @@ def component(request, organization, project, component_name):
     except ValueError:
       return "Organization `{}`, project `{}`, or component `{}` in URL not found.".format(organization, project, component)
 
-    # Each control's metadata, such as control names and control family names,
-    # is loaded from standards. Load the standards first.
-    standards = opencontrol.load_project_standards(project)
-
-    # Load the component's controls.
-    controlimpls = list(opencontrol.load_project_component_controls(component, standards))
-
-    return send_json_response(request, compute_control_implementation_statistics(controlimpls))
-
-def compute_control_implementation_statistics(controlimpls):
-    # Compute some statistics about how many words are in the controls,
-    # and totals on control implementation status
-
-    import re
-
-    # Get total count of controls and control parts.
-    control_count = len({
-        ( controlimpl["standard"]["name"], controlimpl["control"]["number"] )
-        for controlimpl in controlimpls
-        })
-    control_part_counts = len(controlimpls)
-
-    # Get total count of control families.
-    control_families_count = len(set(controlimpl["family"]["id"] for controlimpl in controlimpls))
-
-    ctl_i7r = {} # Counts by status.
-    words = [] # word counts for each control
-    for controlimpl in controlimpls:
-        # Count up words.
-        wds = len(re.split(r"\W+", controlimpl["narrative"]))
-        words.append(wds)
-
-        # Count implementation status
-        if controlimpl["implementation_status"] in ctl_i7r.keys():
-          ctl_i7r[controlimpl["implementation_status"]] += 1
-        else:
-          ctl_i7r[controlimpl["implementation_status"]] = 1
-    
-    total_words = sum(words)
-    average_words_per_controlpart = total_words / (len(controlimpls) if len(controlimpls) > 0 else 1) # don't err if no controlimpls
-    
-    # Re-label status an empty implementation status key as "Not specified"
-    if "" in ctl_i7r.keys():
-       ctl_i7r["Not specified"] = ctl_i7r[""]
-       del ctl_i7r[""]
-
-    return {
-      "control_count": control_count,
-      "control_part_count": control_part_counts,
-      "control_families_count": control_families_count,
-      "total_words": total_words,
-      "average_words_per_controlpart": average_words_per_controlpart,
-      "implementation_status_counts": ctl_i7r,
-    }
+    # The statistics are kept up to date as control implementations are
+    # edited, so this doesn't need to load the component's controls.
+    from . import statistics
+    return send_json_response(request, statistics.get_component_statistics(component))
 
 @route('/organizations/<organization>/projects/<project>/components/<component_name>/guide')
 def component_guide(request, organization, project, component_name):
@@ -647,6 +608,18 @@ def controls(request, organization, project):
             quote_plus(control["id"]),
           )
 
+    # Count the components that have narratives for the controls that each control
+    # is mapped to by the project's crosswalks, if any.
+    from . import crosswalk
+    crosswalk_index = crosswalk.get_project_crosswalk(project)
+    for standard_key, standard in standards.items():
+      for control_key, control in standard["controls"].items():
+        control["mapped_components"] = set()
+        for mapped_standard_key, mapped_control_key in crosswalk_index.get((standard_key, control_key), ()):
+          mapped_control = standards.get(mapped_standard_key, {}).get("controls", {}).get(mapped_control_key, {})
+          control["mapped_components"] |= mapped_control.get("components", set())
+        control["mapped_components"] -= control.get("components", set())
+
     # Make the standards a sorted list, and sort the controls within it. 'standards'
     # is a dict mapping standard IDs to dicts holding information about it. Going
     # forward we just need the dicts in order --- we no longer need a mapping. Same
@@ -697,14 +670,27 @@ def project_control_grid(request, organization, project, standard_key, control_k
     except KeyError:
       control = None
 
+    # Get the controls in other standards that this control is mapped to by
+    # the project's crosswalks, if any. Narratives for those controls also
+    # help satisfy this control.
+    from . import crosswalk
+    mapped_controls = crosswalk.get_mapped_controls(project, standard_key, control_key)
+
     # Scan all of the components for all contributions to this control.
     # Build up a list of relevant components and relevant control implementations
     # within that component.
     components = []
+    mapped_components = []
     for component in opencontrol.load_project_components(project):
         # Iterate over its controls...
         controlimpls = []
+        mapped_controlimpls = []
         for controlimpl in opencontrol.load_project_component_controls(component, standards):
+            # Keep the narratives for mapped controls separately.
+            if (controlimpl["standard"]["id"], controlimpl["control"]["id"]) in mapped_controls:
+                mapped_controlimpls.append(controlimpl)
+                continue
+
             # Only look at control implementations for the control specified in the URL.
             # Even though we're looking at a single control, multiple control implementations
             # may match because there may be implementations for different *parts* of the
@@ -726,18 +712,25 @@ def project_control_grid(request, organization, project, standard_key, control_k
               "component": component,
               "controls": controlimpls
             })
+        if mapped_controlimpls:
+            mapped_components.append({
+              "component": component,
+              "controls": mapped_controlimpls
+            })
 
     # For the 'grid' view...
     # Sort the components and the controls within each component so that we can display
     # them in columns for each component.
-    components.sort(key = lambda component : component["component"]["name"])
-    for component in components:
-        component["controls"].sort(key = lambda controlimpl : controlimpl["sort_key"])
+    for component_list in (components, mapped_components):
+        component_list.sort(key = lambda component : component["component"]["name"])
+        for component in component_list:
+            component["controls"].sort(key = lambda controlimpl : controlimpl["sort_key"])
 
     # For the 'combined' view...
     # Sort the narratives by part first, then by component. We will have a single text area
     # that shows what this control will look like in a system security plan. Flatten the
     # list of control narratives and then sort.
+    from .evidence import get_control_evidence
     narratives = []
     for component in components:
         for controlimpl in component["controls"]:
@@ -745,9 +738,25 @@ def project_control_grid(request, organization, project, standard_key, control_k
             "part": controlimpl["control_part"],
             "component": component["component"],
             "text": controlimpl["narrative"],
+            "covered_by": get_control_evidence(project, controlimpl),
           })
     narratives.sort(key = lambda narrative : ( narrative["part"] is None, narrative["part"], narrative["component"]["name"] ))
 
+    # Then list the narratives for mapped controls, by control, part, and component.
+    mapped_narratives = []
+    for component in mapped_components:
+        for controlimpl in component["controls"]:
+          mapped_narratives.append({
+            "standard": controlimpl["standard"],
+            "control": controlimpl["control"],
+            "sort_key": controlimpl["sort_key"],
+            "part": controlimpl["control_part"],
+            "component": component["component"],
+            "text": controlimpl["narrative"],
+            "covered_by": get_control_evidence(project, controlimpl),
+          })
+    mapped_narratives.sort(key = lambda narrative : ( narrative["standard"]["id"], narrative["sort_key"], narrative["component"]["name"] ))
+
     # Add URL info to the control --- it might be missing if the metadata
     # came from the standard.
     from urllib.parse import quote_plus
@@ -757,6 +766,20 @@ def project_control_grid(request, organization, project, standard_key, control_k
         quote_plus(control_key),
     )
 
+    # Make a list of the mapped controls with links to the ones in standards
+    # that this project uses.
+    mapped_controls = [
+      {
+        "standard": mapped_standard_key,
+        "id": mapped_control_key,
+        "name": standards[mapped_standard_key]["controls"].get(mapped_control_key, {}).get("name")
+                if mapped_standard_key in standards else None,
+        "url": "{}/controls/{}/{}".format(project["url"], quote_plus(mapped_standard_key), quote_plus(mapped_control_key))
+               if mapped_standard_key in standards else None,
+      }
+      for mapped_standard_key, mapped_control_key in mapped_controls
+    ]
+
     # Done.
     return render_template(request, 'control_{}.html'.format(format),
                             project=project,
@@ -764,6 +787,9 @@ def project_control_grid(request, organization, project, standard_key, control_k
                             control=control,
                             components=components,
                             narratives=narratives,
+                            mapped_narratives=mapped_narratives,
+                            mapped_controls=mapped_controls,
+                            mapped_components=mapped_components,
                             implementation_status_css_classes=implementation_status_css_classes,
                           )
 
@@ -777,20 +803,22 @@ def evidence(request, organization, project):
     except ValueError:
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
-    # Load its components and sort them.
-    components = list(opencontrol.load_project_components(project))
-    components.sort(key = lambda component : component["name"])
-
-    # Load all evidence.
-    evidence = sum([
-      list(opencontrol.load_project_component_evidence(component))
-      for component in components
-    ], [])
-
-    # Show the project's components.
+    # Load all evidence from the project's evidence index, and check the
+    # evidence files in the background. The page shows the latest results.
+    from .evidence import get_index, verify, get_check
+    evidence = get_index(project)["evidence"]
+    verify(evidence, force=get_query_params(request).get("verify") == "1")
+    checks = [get_check(item) for item in evidence]
+    statuses = { }
+    for check in checks:
+      statuses[check["status"]] = statuses.get(check["status"], 0) + 1
+
+    # Show the project's evidence.
     return render_template(request, 'evidence_list.html',
                             project=project,
-                            evidence=evidence)
+                            evidence=evidence,
+                            evidence_checks=list(zip(evidence, checks)),
+                            statuses=statuses)
 
 @route('/organizations/<organization>/projects/<project>/ssp.<format>')
 def ssp(request, organization, project, format):
@@ -820,6 +848,149 @@ def ssp(request, organization, project, format):
         from .csv import build_csv
         send_file_response(request, file_path, build_csv(project, {}).encode('utf-8'), "text/csv")
 
+@route('/organizations/<organization>/projects/<project>/import-csv', methods=["GET", "POST"])
+def import_csv(request, organization, project):
+    """Upload narratives edited in a CSV export and show what importing them would change."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    # On POST, read the uploaded file as it is received and make a dry run of
+    # the import. Nothing is saved until the import is committed.
+    csv_import = None
+    error = None
+    if request.method == "POST":
+      from .csv import read_csv_import
+      import codecs
+      try:
+        if not hasattr(request, "multipart"):
+          raise ValueError("Upload the CSV file as multipart/form-data.")
+        for part in request.multipart:
+          if part.name == "file":
+            # utf-8-sig skips the byte order mark that spreadsheet programs add.
+            csv_import = read_csv_import(project, codecs.iterdecode(part, "utf-8-sig"))
+            break
+        else:
+          raise ValueError("No CSV file was uploaded.")
+      except (ValueError, UnicodeDecodeError) as e:
+        error = str(e)
+
+    return render_csv_import(request, project, csv_import, error)
+
+@route('/organizations/<organization>/projects/<project>/import-csv/<import_id>', methods=["POST"])
+def commit_import_csv(request, organization, project, import_id):
+    """Save the changes of a dry-run CSV import."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    from .csv import get_csv_import, commit_csv_import
+    try:
+      csv_import = get_csv_import(project, import_id)
+    except ValueError as e:
+      return render_csv_import(request, project, None, str(e), status=404)
+    try:
+      csv_import = commit_csv_import(csv_import)
+    except ValueError as e:
+      return render_csv_import(request, project, None, str(e), status=409)
+    return render_csv_import(request, project, csv_import, None)
+
+def render_csv_import(request, project, csv_import, error, status=400):
+  # Show an import as a page, or as JSON for ?format=json. As JSON, an error,
+  # or no import because no file was uploaded, is sent with the given status.
+  if get_query_params(request).get("format") == "json":
+    if csv_import is None:
+      return send_json_response(request, { "error": error or "No CSV file was uploaded." }, status=status)
+    from .csv import get_csv_import_json
+    return send_json_response(request, get_csv_import_json(csv_import))
+  return render_template(request, 'csv_import.html',
+                          project=project,
+                          csv_import=csv_import,
+                          error=error,
+                        )
+
+@route('/organizations/<organization>/projects/<project>/ssp.md?family=<family>')
+def ssp_family(request, organization, project, family):
+    """Output the sections of the system security plan for one control family."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    # Construct the family's sections. A family abbreviation may occur in more
+    # than one standard, so prefix each section with its standard's heading.
+    from .ssp import build_ssp_sections
+    sections = build_ssp_sections(project, { "only-family": family })
+    if not sections:
+      return "Control family `{}` has no narratives in project.".format(family)
+    return "".join(
+      "# " + standard["name"] + "\n\n" + text
+      for standard, family, text in sections
+    )
+
+@route('/organizations/<organization>/projects/<project>/exports', methods=["POST"])
+def start_export(request, organization, project):
+    """Start exporting documents in the background and return the export job as JSON."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    # Start the job, or get an existing job for the same export.
+    from . import jobs
+    try:
+      job = jobs.submit_export(project, request.form.get("format", "all"))
+    except ValueError as e:
+      return str(e)
+    return send_json_response(request, jobs.get_job_status(job))
+
+@route('/organizations/<organization>/projects/<project>/exports/<job_id>')
+def export_status(request, organization, project, job_id):
+    """Return the status of a background export job as JSON."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    from . import jobs
+    try:
+      job = jobs.get_job(project, job_id)
+    except ValueError as e:
+      return str(e)
+    return send_json_response(request, jobs.get_job_status(job))
+
+@route('/organizations/<organization>/projects/<project>/exports/<job_id>/download')
+def export_download(request, organization, project, job_id):
+    """Download the documents built by a finished background export job."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    from . import jobs
+    try:
+      job = jobs.get_job(project, job_id)
+    except ValueError as e:
+      return str(e)
+    if job["status"] != "done":
+      return "Export job `{}` is not finished. Its status is `{}`.".format(job_id, job["status"])
+    file_path, data, content_type = jobs.get_job_download(job)
+    send_file_response(request, file_path, data, content_type)
+
 @route('/organizations/<organization>/projects/<project>/components/<component_name>/app.yaml')
 def component_app_export(request, organization, project, component_name):
     """Export app.yaml file for a component"""
@@ -863,6 +1034,31 @@ def component_app_export(request, organization, project, component_name):
                           )
 
 
+@route('/organizations/<organization>/projects/<project>/components/<component_name>/app.json')
+def component_app_json_export(request, organization, project, component_name):
+    """Export the GovReady-Q app data for a component as compact JSON"""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    # Load the component.
+    try:
+      component = opencontrol.load_project_component(project, component_name)
+    except ValueError:
+      return "Component `{}` in URL not found in project.".format(component_name)
+
+    # Load the component's controls.
+    standards = opencontrol.load_project_standards(project)
+    controlimpls = list(opencontrol.load_project_component_controls(component, standards))
+
+    # Send the JSON as it is generated.
+    from .app_yaml import iter_app_json
+    send_file_chunks_response(request, "app.json", iter_app_json(controlimpls), "application/json")
+
+
 #####################################################
 # Routes for Creating and Updating Compliance Content
 #####################################################
@@ -893,6 +1089,11 @@ def create_system(request):
             # Validation OK. Create the system.
             created_repo_path = opencontrol.create_system(organization_name, system_name, description, repo_path)
             print(created_repo_path)
+
+            # create_system lists the new repository in repos.conf. Open it now
+            # rather than waiting for the watcher to notice.
+            from . import repos
+            repos.reload()
             return render_template(request, 'system_new.html',
                   system_name=system_name,
                   repo_path=created_repo_path,
@@ -977,10 +1178,17 @@ def update_control(request):
        #controlimpl["summary"] = request.form.get("summary", "")
        controlimpl["narrative"] = request.form.get("narrative", "")
        controlimpl["implementation_status"] = request.form.get("implementation_status", "")
-       if opencontrol.update_component_control(controlimpl):
+
+       # Don't overwrite changes to the file made since the editor loaded it.
+       controlimpl["source_file_digest"] = request.form.get("source_file_digest") or None
+       try:
+         updated = opencontrol.update_component_control(controlimpl)
+       except opencontrol.ConflictError as e:
+         return str(e)
+       if updated:
          # If the control was updated, return it back to the user
          # as JSON.
-         return send_json_response(request, controlimpl)
+         return send_json_response(request, opencontrol.get_controlimpl_json(controlimpl))
 
     # The control was not found in the data files.
     if mode == "update":
@@ -1004,7 +1212,113 @@ def update_control(request):
     opencontrol.add_component_control(component, controlimpl)
 
     # Return it back to the client.
-    return send_json_response(request, controlimpl)
+    controlimpl["component"] = component
+    return send_json_response(request, opencontrol.get_controlimpl_json(controlimpl))
+
+@route('/api/organizations/<organization>/projects/<project>/controls:batchUpdate', methods=['POST'])
+def batch_update_controls(request, organization, project):
+    """Update many control narratives at once."""
+
+    # The request body is JSON like:
+    #   { "changes": [ { "component": ..., "standard": ..., "control": ..., "control_part": ...,
+    #                    "narrative": ..., "implementation_status": ... }, ... ] }
+    # A change that omits narrative or implementation_status keeps its current value.
+    # A change may also give the source_file_digest of the control implementation
+    # as the client loaded it, so that changes made to the file since then aren't
+    # overwritten.
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return send_json_response(request, {
+        "error": "Organization `{}` project `{}` in URL not found.".format(organization, project) }, status=404)
+
+    data = getattr(request, "json", None)
+    changes = data.get("changes") if isinstance(data, dict) else None
+    if not isinstance(changes, list) or not all(isinstance(change, dict) for change in changes):
+      return send_json_response(request, {
+        "error": "The request body must be a JSON object with a list of changes." }, status=400)
+
+    # Load each component's control implementations once.
+    standards = opencontrol.load_project_standards(project)
+    components = { component["id"]: component for component in opencontrol.load_project_components(project) }
+    controlimpls = { }
+    def get_controlimpls(component):
+      if component["id"] not in controlimpls:
+        controlimpls[component["id"]] = {
+          (controlimpl["standard"]["id"], controlimpl["control"]["id"], controlimpl.get("control_part")): controlimpl
+          for controlimpl in opencontrol.load_project_component_controls(component, standards)
+        }
+      return controlimpls[component["id"]]
+
+    # Match each change to the control implementation it updates.
+    results = []
+    updates = []
+    failed_files = set()
+    for change in changes:
+      result = { "status": "error" }
+      results.append(result)
+      component = components.get(change.get("component"))
+      if component is None:
+        result["error"] = "Component {} does not exist in project {}.".format(change.get("component"), project["id"])
+        continue
+      controlimpl = get_controlimpls(component).get((change.get("standard"), change.get("control"), change.get("control_part") or None))
+      if controlimpl is None:
+        result["error"] = "Control being updated is missing from the project."
+        continue
+      if not isinstance(change.get("narrative", ""), str) or not isinstance(change.get("implementation_status") or "", str):
+        result["error"] = "Narrative and implementation status must be strings."
+        failed_files.add(controlimpl["source_file"])
+        continue
+      controlimpl = dict(controlimpl)
+      controlimpl["narrative"] = change.get("narrative", controlimpl["narrative"])
+      controlimpl["implementation_status"] = change.get("implementation_status", controlimpl["implementation_status"]) or ""
+      controlimpl["source_file_digest"] = change.get("source_file_digest") or None
+      if not (controlimpl["narrative"] or "").strip():
+        result["error"] = "Narrative cannot be empty."
+        failed_files.add(controlimpl["source_file"])
+        continue
+      updates.append((result, controlimpl))
+
+    # The changes to a file are saved together or not at all.
+    for result, controlimpl in updates:
+      if controlimpl["source_file"] in failed_files:
+        result["error"] = "No changes were made to {} because another change to it failed.".format(controlimpl["source_file"])
+    updates = [(result, controlimpl) for result, controlimpl in updates if controlimpl["source_file"] not in failed_files]
+
+    # Save the changes, writing each source file once.
+    saved = opencontrol.update_component_controls([controlimpl for result, controlimpl in updates])
+    for result, controlimpl in updates:
+      outcome = saved[controlimpl["source_file"]]
+      if outcome is True:
+        result["status"] = "ok"
+        result["controlimpl"] = opencontrol.get_controlimpl_json(controlimpl)
+      else:
+        if isinstance(outcome, opencontrol.ConflictError):
+          result["status"] = "conflict"
+        result["error"] = str(outcome)
+
+    return send_json_response(request, {
+      "updated": sum(1 for result in results if result["status"] == "ok"),
+      "failed": sum(1 for result in results if result["status"] != "ok"),
+      "results": results,
+    })
+
+@route('/healthz/ready')
+def healthz_ready(request):
+    """Report whether hyperGRC has finished loading its projects, for health checks."""
+    # The status is 200 once every project has been loaded (or has failed to
+    # load) and 503 until then. Add ?projects=1 for each project's load time.
+    from . import warmup
+    status = warmup.get_status(include_projects=get_query_params(request).get("projects") == "1")
+    return send_json_response(request, status, status=200 if status["ready"] else 503)
+
+@route('/api/write-behind')
+def write_behind_stats(request):
+    """Show statistics about the write-behind queue."""
+    from . import writebehind
+    return send_json_response(request, writebehind.get_stats())
 
 #####################################################
 # Routes for Component Analysis Across Projects
@@ -1014,14 +1328,20 @@ def update_control(request):
 def all_components(request):
   """Show all components across all projects"""
 
-  # Create an array to store project objects
-  components = [ ]
+  from . import indexdb
+  if indexdb.is_ready():
+    # List the components from the index database.
+    components = indexdb.list_components()
 
-  # Iterate through all of the projects
-  for project in load_projects():
-    components.extend(list(opencontrol.load_project_components(project)))
+  else:
+    # Create an array to store project objects
+    components = [ ]
 
-  components.sort(key = lambda component : component["name"])
+    # Iterate through all of the projects
+    for project in load_projects():
+      components.extend(list(opencontrol.load_project_components(project)))
+
+    components.sort(key = lambda component : component["name"])
 
   # Prepare modify page message
   modify_msg = "Displayed components taken from loaded projects. To modify listed components, change hyperGRC launch parameters to show different projects."
@@ -1034,10 +1354,11 @@ def all_components(request):
 @route('/component-comparison', methods=['POST'])
 def component_comparison(request):
   """Compare the respective controls of components"""
+  from . import coverage
 
-  # Super set of controls
-  super_control_list = set()
-  components = [ ]
+  # Load the selected components. Each project's standards are loaded once.
+  selected = [ ]
+  standards = { }
   if "component_selected" in request.form:
     component_urls = request.form["component_selected"]
     for component_url in component_urls:
@@ -1062,39 +1383,257 @@ def component_comparison(request):
 
       # Each control's metadata, such as control names and control family names,
       # is loaded from standards. Load the standards first.
-      standards = opencontrol.load_project_standards(project)
+      if project["path"] not in standards:
+        standards[project["path"]] = opencontrol.load_project_standards(project)
+
+      selected.append((organization, project, component_name, component))
+
+  # Compare the controls covered by each component.
+  comparison = coverage.compare_components([
+    (component, standards[project["path"]])
+    for organization, project, component_name, component in selected
+  ])
+  components = [
+    {
+      "organization": organization,
+      "project": project,
+      "name": component_name,
+      "controls": component_coverage["controlimpls"],
+      "count": coverage.popcount(component_coverage["bits"]),
+      "unique_count": coverage.popcount(unique),
+    }
+    for (organization, project, component_name, component), component_coverage, unique
+    in zip(selected, comparison["coverage"], comparison["unique"])
+  ]
+  controls = []
+  for bit in comparison["controls"]:
+    standard_id, control_id, control_part = coverage.get_control_key(bit)
+    # Controls with the same ID may be in more than one standard, so show the
+    # standard too.
+    controlimpl = next(c["controlimpls"][bit] for c in comparison["coverage"] if bit in c["controlimpls"])
+    controls.append({
+      "bit": bit,
+      "label": "{}{}".format(control_id, "" if control_part == None else " part "+control_part),
+      "standard": controlimpl["standard"].get("name") or standard_id,
+    })
+
+  return render_template(request, 'component_comparison.html',
+                         components=components,
+                         controls=controls,
+                         common_count=coverage.popcount(comparison["common"]),
+                         jaccard=comparison["jaccard"]
+                        )
 
-      # Load the component's controls.
-      controlimpls = list(opencontrol.load_project_component_controls(component, standards))
+#####################################################
+# Routes for Standards
+#####################################################
 
-      # extract control ids
-      component_control_ids = ["{}{}".format(c["control"]["id"], "" if c["control_part"] == None else " part "+c["control_part"]) for c in controlimpls]
-      super_control_list = super_control_list.union(set(component_control_ids))
+@route('/api/organizations/<organization>/projects/<project>/standards/<standard_key>/controls')
+def standard_controls(request, organization, project, standard_key):
+    """Find controls in a standard by a prefix of their number or name, returned as JSON"""
 
-      # Add key to each control
-      controlimpls_new = {}
-      for c in controlimpls:
-        if c["control_part"] == None:
-          new_id = c["control"]["id"]
-        else:
-          new_id = c["control"]["id"] + " part " + c["control_part"]
-        controlimpls_new[new_id] = c
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    from . import catalog
+    params = get_query_params(request)
+    try:
+      limit = max(1, min(int(params.get("limit", 50)), 1000))
+    except ValueError:
+      limit = 50
+    try:
+      controls = catalog.find_controls(project, standard_key, params.get("prefix", ""),
+                                       family=params.get("family"), limit=limit)
+    except ValueError as e:
+      return str(e)
+    return send_json_response(request, controls)
+
+@route('/api/organizations/<organization>/projects/<project>/standards/<standard_key>/catalog.json')
+def standard_catalog(request, organization, project, standard_key):
+    """Return all of the controls in a standard as JSON"""
 
-      # Update components
-      components.append({ "organization": organization, "project": project, "name": component_name, "controls": controlimpls_new })
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
+    from . import catalog
+    from .render import send_cacheable_response
+    try:
+      index = catalog.find_standard(project, standard_key)
+    except ValueError as e:
+      return str(e)
+
+    # The catalog only changes when the standard file changes. Pages link
+    # to it with a URL that has the file's content hash (see get_catalog_url),
+    # so if the request has the current hash it can be cached for a year.
+    # Otherwise browsers should check back with the ETag.
+    max_age = 0
+    if get_query_params(request).get("v") == index["digest"][:16]:
+      max_age = 365*24*60*60
+    send_cacheable_response(request, index["catalog_json"], "application/json",
+                            '"{}"'.format(index["digest"]), max_age)
+
+#####################################################
+# Routes for Searching Across Projects
+#####################################################
+
+def run_search(request):
+  # Run the search given in the request's query string and return
+  # the query parameters and the search results.
+  import time
+  params = get_query_params(request)
+  filters = {
+    "project": params.get("project"),
+    "component": params.get("component"),
+    "family": params.get("family"),
+    "implementation_status": params.get("status"),
+  }
+  try:
+    limit = max(1, min(int(params.get("limit", 50)), 1000))
+  except ValueError:
+    limit = 50
+
+  start_time = time.time()
+  from . import indexdb
+  if indexdb.is_ready():
+    # Answer from the index database.
+    total, results = indexdb.search(params.get("q", ""), filters, limit)
   else:
-    components = []
-    # Remind people to select components if no components selected.
+    search.ensure_projects(PROJECT_LIST)
+    total, results = search.search(params.get("q", ""), filters, limit)
+  return params, {
+    "query": params.get("q", ""),
+    "filters": filters,
+    "total": total,
+    "results": results,
+    "seconds": round(time.time() - start_time, 4),
+  }
+
+@route('/search')
+def search_page(request):
+  """Search control narratives across all projects"""
+  params, results = run_search(request)
+  return render_template(request, 'search.html',
+                         params=params,
+                         search=results,
+                         projects=sorted(load_projects(), key = lambda project : project["title"]),
+                         implementation_status_css_classes=implementation_status_css_classes,
+                        )
 
-  controls = list(super_control_list)
-  controls.sort()
+@route('/search.json')
+def search_json(request):
+  """Search control narratives across all projects and return the results as JSON"""
+  params, results = run_search(request)
+  return send_json_response(request, results)
 
-  return render_template(request, 'component_comparison.html',
-                         components=components,
-                         controls=controls
+#####################################################
+# Routes for Finding Duplicate Narratives
+#####################################################
+
+def run_duplicates(request):
+  # Find near-duplicate narratives with the threshold given in the request's
+  # query string.
+  from . import duplicates
+  params = get_query_params(request)
+  try:
+    threshold = float(params.get("threshold", duplicates.DEFAULT_THRESHOLD))
+  except ValueError:
+    threshold = duplicates.DEFAULT_THRESHOLD
+  return duplicates.find_duplicates(PROJECT_LIST, threshold)
+
+@route('/duplicates')
+def duplicates_page(request):
+  """Show near-duplicate control narratives across all projects"""
+  return render_template(request, 'duplicates.html',
+                         report=run_duplicates(request),
+                         implementation_status_css_classes=implementation_status_css_classes,
                         )
 
+@route('/duplicates.json')
+def duplicates_json(request):
+  """Return near-duplicate control narratives across all projects as JSON"""
+  return send_json_response(request, run_duplicates(request))
+
+#####################################################
+# Routes for Certification Gap Analysis
+#####################################################
+
+@route('/gaps')
+def gaps_page(request):
+  """Show certification coverage across all projects"""
+  from . import gaps
+  return render_template(request, 'gaps.html',
+                         report=gaps.analyze_portfolio(PROJECT_LIST),
+                        )
+
+@route('/gaps.json')
+def gaps_json(request):
+  """Return certification coverage across all projects as JSON"""
+  from . import gaps
+  return send_json_response(request, gaps.analyze_portfolio(PROJECT_LIST))
+
+@route('/organizations/<organization>/projects/<project>/gaps')
+def project_gaps_page(request, organization, project):
+  """Show the certified controls in a project that are not in place"""
+  from . import gaps
+  try:
+    project = load_project(organization, project)
+  except ValueError:
+    return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+  return render_template(request, 'project_gaps.html',
+                         project=project,
+                         analysis=gaps.analyze_project(project),
+                         implementation_status_css_classes=implementation_status_css_classes,
+                        )
+
+@route('/organizations/<organization>/projects/<project>/gaps.json')
+def project_gaps_json(request, organization, project):
+  """Return the certified controls in a project that are not in place as JSON"""
+  from . import gaps
+  try:
+    project = load_project(organization, project)
+  except ValueError:
+    return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+  return send_json_response(request, gaps.analyze_project(project))
+
+#####################################################
+# Routes for the Portfolio Dashboard
+#####################################################
+
+def run_dashboard(request):
+  # Compute the portfolio statistics with the options given in the request's
+  # query string.
+  from . import analytics
+  params = get_query_params(request)
+  try:
+    thin_words = max(1, int(params.get("thin", analytics.THIN_NARRATIVE_WORDS)))
+  except ValueError:
+    thin_words = analytics.THIN_NARRATIVE_WORDS
+  try:
+    limit = max(1, min(int(params.get("limit", 100)), 1000))
+  except ValueError:
+    limit = 100
+  analytics.ensure_projects(PROJECT_LIST)
+  return analytics.get_dashboard(thin_words, limit)
+
+@route('/dashboard')
+def dashboard_page(request):
+  """Show statistics about control narratives across all projects"""
+  return render_template(request, 'dashboard.html',
+                         dashboard=run_dashboard(request),
+                         implementation_status_css_classes=implementation_status_css_classes,
+                        )
+
+@route('/dashboard.json')
+def dashboard_json(request):
+  """Return statistics about control narratives across all projects as JSON"""
+  return send_json_response(request, run_dashboard(request))
+
 #####################################################
 # Routes for Customization
 #####################################################
@@ -0,0 +1,281 @@
+# Full-text search over control narratives in all of the loaded projects.
+#
+# The search index is an in-memory inverted index. Each narrative part (a
+# "document") is tokenized together with its control's name and description,
+# and each term maps to the documents it occurs in and the positions it occurs
+# at. Positions let us answer "quoted phrase" queries, and term frequencies and
+# document lengths let us rank results with BM25.
+#
+# Documents are grouped by the source file they were read from. When hyperGRC
+# writes to a data file (see opencontrol.notify_file_changed), only the
+# documents from that file are re-indexed.
+
+import math
+import os.path
+import re
+import threading
+
+from . import opencontrol
+
+# BM25 ranking parameters. These are the usual defaults.
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# The gap in token positions between a document's fields (narrative, control
+# name, control description) so that phrases don't match across fields.
+FIELD_GAP = 100
+
+_lock = threading.RLock()
+_docs = { } # document ID => document metadata
+_doc_terms = { } # document ID => set of terms in the document
+_doc_lengths = { } # document ID => number of tokens
+_postings = { } # term => { document ID => [positions] }
+_total_length = [0] # sum of _doc_lengths, in a list so it can be updated in place
+_next_doc_id = [0]
+_files = { } # source file => { "project": project path, "component": component ID or None, "docs": [document IDs] }
+_projects = { } # project path => set of source files
+
+def tokenize(text):
+  # Split text into lowercase terms, e.g. "FIPS 140-2" => ["fips", "140", "2"].
+  return [term.lower() for term in re.findall(r"\w+", text or "")]
+
+#############################
+# Indexing
+#############################
+
+def add_document(controlimpl):
+  # Add a control implementation to the index and return its document ID.
+  # Must be called with _lock held.
+  doc_id = _next_doc_id[0]
+  _next_doc_id[0] += 1
+
+  project = controlimpl["component"]["project"]
+  _docs[doc_id] = {
+    "project": opencontrol.get_project_json(project),
+    "component": opencontrol.get_component_json(controlimpl["component"]),
+    "standard": controlimpl["standard"]["id"],
+    "family": controlimpl["family"]["id"],
+    "control": {
+      "id": controlimpl["control"]["id"],
+      "number": controlimpl["control"]["number"],
+      "name": controlimpl["control"].get("name"),
+      "url": controlimpl["control"]["url"],
+    },
+    "control_part": controlimpl["control_part"],
+    "implementation_status": controlimpl["implementation_status"],
+    "narrative": controlimpl["narrative"],
+    "source_file": controlimpl["source_file"],
+  }
+
+  # Index the terms in each field, leaving a gap in positions between fields.
+  position = 0
+  length = 0
+  terms = set()
+  for field in (controlimpl["narrative"], controlimpl["control"].get("name"), controlimpl["control"].get("description")):
+    field_terms = tokenize(field)
+    for i, term in enumerate(field_terms):
+      _postings.setdefault(term, { }).setdefault(doc_id, []).append(position + i)
+    terms.update(field_terms)
+    position += len(field_terms) + FIELD_GAP
+    length += len(field_terms)
+  _doc_terms[doc_id] = terms
+  _doc_lengths[doc_id] = length
+  _total_length[0] += length
+
+  return doc_id
+
+def remove_document(doc_id):
+  # Remove a document from the index. Must be called with _lock held.
+  del _docs[doc_id]
+  for term in _doc_terms.pop(doc_id):
+    postings = _postings[term]
+    del postings[doc_id]
+    if not postings:
+      del _postings[term]
+  _total_length[0] -= _doc_lengths.pop(doc_id)
+
+def remove_file(fn):
+  # Remove a source file and its documents from the index. Must be called
+  # with _lock held.
+  for doc_id in _files.pop(fn)["docs"]:
+    remove_document(doc_id)
+
+def index_project(project_dir):
+  # Add all of the narratives in a project to the index, replacing any that
+  # are already indexed. Must be called with _lock held.
+  remove_project(project_dir)
+  project = opencontrol.load_project_from_path(project_dir)
+  standards = opencontrol.load_project_standards(project)
+  source_files = _projects[project_dir] = set()
+
+  # Changes to the system file or the standards (which have control names and
+  # descriptions) re-index the whole project. These files have no component.
+  for fn in [os.path.join(project_dir, "opencontrol.yaml")] + opencontrol.get_project_standard_files(project):
+    fn = os.path.normpath(fn)
+    _files[fn] = { "project": project_dir, "component": None, "docs": [] }
+    source_files.add(fn)
+
+  # Register every file that defines a component, even if it has no narratives
+  # yet, so that when narratives are added to it we know which component it
+  # belongs to.
+  for component in opencontrol.load_project_components(project):
+    for fn in opencontrol.get_component_source_files(component):
+      _files.setdefault(fn, { "project": project_dir, "component": component["id"], "docs": [] })
+      source_files.add(fn)
+    for controlimpl in opencontrol.load_project_component_controls(component, standards):
+      fn = os.path.normpath(controlimpl["source_file"])
+      _files[fn]["docs"].append(add_document(controlimpl))
+
+def remove_project(project_dir):
+  # Remove a project's narratives from the index. Must be called with _lock held.
+  for fn in _projects.pop(project_dir, []):
+    if fn in _files:
+      remove_file(fn)
+
+def reindex_file(fn):
+  # Re-index the narratives in a source file that has changed. This is
+  # registered as an opencontrol change listener.
+  with _lock:
+    if fn in _files and _files[fn]["component"] is not None:
+      # Re-read the narratives in this file only.
+      project_dir = _files[fn]["project"]
+      component_id = _files[fn]["component"]
+      for doc_id in _files[fn]["docs"]:
+        remove_document(doc_id)
+      _files[fn]["docs"] = []
+      project = opencontrol.load_project_from_path(project_dir)
+      component = opencontrol.load_project_component(project, component_id)
+      standards = opencontrol.load_project_standards(project)
+      for controlimpl in opencontrol.load_project_component_controls(component, standards):
+        if os.path.normpath(controlimpl["source_file"]) == fn:
+          _files[fn]["docs"].append(add_document(controlimpl))
+      return
+
+    # This is a project-level file or a file we don't know about, like a new
+    # component. Re-index the project that contains it, if any.
+    for project_dir in list(_projects):
+      if fn in _projects[project_dir] \
+        or os.path.abspath(fn).startswith(os.path.join(os.path.abspath(project_dir), "")):
+        index_project(project_dir)
+
+opencontrol.add_change_listener(reindex_file)
+
+def ensure_projects(project_dirs):
+  # Make the index hold exactly the given projects, indexing projects that
+  # haven't been indexed yet. Projects that fail to load are skipped.
+  with _lock:
+    for project_dir in set(_projects) - set(project_dirs):
+      remove_project(project_dir)
+    for project_dir in project_dirs:
+      if project_dir not in _projects:
+        try:
+          index_project(project_dir)
+        except ValueError:
+          import traceback
+          traceback.print_exc()
+
+#############################
+# Searching
+#############################
+
+def parse_query(query):
+  # Split a query into single terms and "quoted phrases". Returns a list of
+  # terms and a list of phrases, each a list of terms.
+  terms = []
+  phrases = []
+  for phrase, word in re.findall(r'"([^"]*)"|(\S+)', query):
+    if phrase:
+      phrase_terms = tokenize(phrase)
+      if len(phrase_terms) > 1:
+        phrases.append(phrase_terms)
+      else:
+        terms.extend(phrase_terms)
+    else:
+      terms.extend(tokenize(word))
+  return terms, phrases
+
+def has_phrase(doc_id, phrase):
+  # Does the phrase (a list of terms) occur in the document? Check each
+  # position of the first term for the following terms at the following
+  # positions.
+  first_positions = _postings[phrase[0]][doc_id]
+  other_positions = [set(_postings[term][doc_id]) for term in phrase[1:]]
+  for position in first_positions:
+    if all((position + i + 1) in positions for i, positions in enumerate(other_positions)):
+      return True
+  return False
+
+def matches_filters(doc, filters):
+  # filters is a dict that may have "project" (a project ID), "component"
+  # (a component ID or name), "family" (a family ID), and "implementation_status".
+  if filters.get("project") and doc["project"]["id"] != filters["project"]:
+    return False
+  if filters.get("component") and filters["component"] not in (doc["component"]["id"], doc["component"]["name"]):
+    return False
+  if filters.get("family") and doc["family"].lower() != filters["family"].lower():
+    return False
+  if filters.get("implementation_status") and (doc["implementation_status"] or "").lower() != filters["implementation_status"].lower():
+    return False
+  return True
+
+def make_snippet(text, terms, length=240):
+  # Return an excerpt of text around the first occurrence of any of the terms.
+  text = " ".join((text or "").split())
+  start = 0
+  for m in re.finditer(r"\w+", text):
+    if m.group(0).lower() in terms:
+      start = max(0, m.start() - length // 3)
+      break
+  snippet = text[start:start+length]
+  return ("..." if start > 0 else "") + snippet + ("..." if start + length < len(text) else "")
+
+def search(query, filters={}, limit=50):
+  # Search the index. Every term and phrase in the query must occur in a
+  # document for it to match. Returns the total number of matching documents
+  # and a list of the top-ranked documents, each a dict of document metadata
+  # plus "score" and "snippet" keys.
+  terms, phrases = parse_query(query)
+  all_terms = set(terms) | { term for phrase in phrases for term in phrase }
+  if not all_terms:
+    return 0, []
+
+  with _lock:
+    # Find the documents that have every term, starting with the rarest term.
+    postings = [_postings.get(term, { }) for term in all_terms]
+    postings.sort(key = len)
+    candidates = set(postings[0])
+    for term_postings in postings[1:]:
+      candidates.intersection_update(term_postings)
+
+    # Apply the phrase and metadata filters.
+    matches = [
+      doc_id for doc_id in candidates
+      if all(has_phrase(doc_id, phrase) for phrase in phrases)
+      and matches_filters(_docs[doc_id], filters)
+    ]
+    if not matches:
+      return 0, []
+
+    # Rank with BM25.
+    doc_count = len(_docs)
+    average_length = (_total_length[0] / doc_count) if doc_count else 1
+    idfs = {
+      term: math.log(1 + (doc_count - len(_postings[term]) + 0.5) / (len(_postings[term]) + 0.5))
+      for term in all_terms
+    }
+    def score(doc_id):
+      length_norm = BM25_K1 * (1 - BM25_B + BM25_B * _doc_lengths[doc_id] / (average_length or 1))
+      total = 0
+      for term in all_terms:
+        tf = len(_postings[term][doc_id])
+        total += idfs[term] * tf * (BM25_K1 + 1) / (tf + length_norm)
+      return total
+    scored = sorted(((score(doc_id), doc_id) for doc_id in matches), key = lambda item : -item[0])
+
+    results = []
+    for doc_score, doc_id in scored[:limit]:
+      result = dict(_docs[doc_id])
+      result["score"] = round(doc_score, 4)
+      result["snippet"] = make_snippet(result["narrative"], all_terms)
+      results.append(result)
+    return len(matches), results
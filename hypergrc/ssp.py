@@ -6,12 +6,17 @@ def blockquote(s):
   # Prepend "> " to the start of each line in s.
   return "".join(("> " + line + "\n") for line in s.strip().split("\n"))
 
-def build_ssp(project, options):
-  # Create the introduction of the SSP.
-
-  from io import StringIO
-  buf = StringIO()
-  buf.write("# " + project['title'] + " System Security Plan\n\n")
+# Rendered output is cached per (project, standard, control family) so that
+# rebuilding a document after an edit only re-renders the families whose
+# source files changed. Each entry maps a cache key to a tuple of the
+# family's fingerprint (see get_family_fingerprint) and the rendered text.
+_section_cache = { }
+
+def load_family_narratives(project, options):
+  # Load the control narratives in the project, sorted, and grouped by standard
+  # and control family. Returns a list of (standard, family, narratives) tuples
+  # in document order, where standard and family are the data structures attached
+  # to the narratives.
 
   # Load the standards in use by this project.
   standards = opencontrol.load_project_standards(project)
@@ -39,8 +44,51 @@ def build_ssp(project, options):
     narrative["component"]["name"] )
   )
 
+  # Group adjacent narratives in the same standard and family.
+  families = []
+  for narrative in narratives:
+    if not families \
+     or families[-1][0]["id"] != narrative["standard"]["id"] \
+     or families[-1][1]["id"] != narrative["family"]["id"]:
+      families.append((narrative["standard"], narrative["family"], []))
+    families[-1][2].append(narrative)
+  return families
+
+def get_family_fingerprint(project, narratives):
+  # Return a value that changes whenever the rendered output for a control
+  # family could change: the content hashes of the source files that contributed
+  # narratives to the family, the names of the contributing components (which
+  # may be defined in a different file), and the project's standard files, which
+  # hold control and family names and descriptions.
+  return (
+    tuple(sorted({
+      (narrative["source_file"], opencontrol.get_file_digest(narrative["source_file"]))
+      for narrative in narratives
+    })),
+    tuple(sorted({ narrative["component"]["name"] for narrative in narratives })),
+    tuple(
+      (fn, opencontrol.get_file_digest(fn))
+      for fn in opencontrol.get_project_standard_files(project)
+    ),
+  )
+
+def get_cached_section(cache_key, fingerprint, render):
+  # Return the rendered text for a section from the cache if its fingerprint
+  # is unchanged, otherwise call render() to render it and cache the result.
+  if cache_key in _section_cache and _section_cache[cache_key][0] == fingerprint:
+    return _section_cache[cache_key][1]
+  text = render()
+  _section_cache[cache_key] = (fingerprint, text)
+  return text
+
+def render_family_section(narratives, options):
+  # Render the Markdown for the narratives in a single control family, starting
+  # at the family heading. The standard heading is written by build_ssp.
+  from io import StringIO
+  buf = StringIO()
+
   # Concatenate the narratives.
-  current_section = []
+  current_section = [narratives[0]["standard"]["name"]]
   for narrative in narratives:
     # Get the section names at the levels of hierarchy above this control.
     section = [
@@ -78,6 +126,44 @@ def build_ssp(project, options):
 
   return buf.getvalue()
 
+def build_ssp_sections(project, options):
+  # Return a list of (standard, family, text) tuples holding the rendered
+  # Markdown for each control family in the SSP, in document order. Sections
+  # come from the cache when none of their inputs have changed. If options
+  # has a "progress" function, it is called with the number of families done
+  # and the total number of families after each family.
+  sections = []
+  families = load_family_narratives(project, options)
+  for standard, family, narratives in families:
+    cache_key = ("md", project["path"], standard["id"], family["id"],
+                 bool(options.get("include-control-descriptions")))
+    text = get_cached_section(
+      cache_key,
+      get_family_fingerprint(project, narratives),
+      lambda : render_family_section(narratives, options))
+    sections.append((standard, family, text))
+    if options.get("progress"):
+      options["progress"](len(sections), len(families))
+  return sections
+
+def build_ssp(project, options):
+  # Create the introduction of the SSP.
+
+  from io import StringIO
+  buf = StringIO()
+  buf.write("# " + project['title'] + " System Security Plan\n\n")
+
+  # Assemble the document from the rendered sections for each control
+  # family, adding a heading each time we start a new standard.
+  current_standard = None
+  for standard, family, text in build_ssp_sections(project, options):
+    if standard["name"] != current_standard:
+      buf.write("# " + standard["name"] + "\n\n")
+      current_standard = standard["name"]
+    buf.write(text)
+
+  return buf.getvalue()
+
 if __name__ == "__main__":
   # Parse for optionally including control description from standard
   from argparse import ArgumentParser
@@ -0,0 +1,128 @@
+# Statistics about each component's control implementations, for the
+# component page and its statistics.json.
+#
+# Statistics are kept per component as running totals. When hyperGRC adds
+# or updates a narrative part, opencontrol calls apply_control_change with
+# the part's old and new values and the totals are adjusted by the difference.
+# A component's totals are only recomputed from its data files the first time
+# they are needed and after the file watcher (see watcher.py) reports that one
+# of its files was changed outside of hyperGRC.
+
+import os.path
+import re
+import threading
+from collections import Counter
+
+from . import opencontrol, watcher
+
+_lock = threading.Lock()
+_statistics = { } # (project path, component ID) => running totals (see compute_statistics)
+_files = { } # source file => set of (project path, component ID)
+
+def count_words(text):
+  return len(re.split(r"\W+", text or ""))
+
+def compute_statistics(controlimpls):
+  # Compute the running totals for a list of control implementations. Controls
+  # and families are counted by the number of narrative parts for each so that
+  # a part can be taken away again.
+  totals = {
+    "parts": 0,
+    "words": 0,
+    "controls": Counter(),
+    "families": Counter(),
+    "statuses": Counter(),
+  }
+  for controlimpl in controlimpls:
+    add_part(totals,
+             (controlimpl["standard"]["id"], controlimpl["control"]["id"]),
+             controlimpl["family"]["id"],
+             controlimpl["narrative"],
+             controlimpl["implementation_status"])
+  return totals
+
+def add_part(totals, control, family, narrative, implementation_status, sign=1):
+  # Add (or with sign=-1, take away) a narrative part.
+  totals["parts"] += sign
+  totals["words"] += sign * count_words(narrative)
+  for counter, key in ((totals["controls"], control), (totals["families"], family), (totals["statuses"], implementation_status or "")):
+    counter[key] += sign
+    if counter[key] <= 0:
+      del counter[key]
+
+def get_statistics_json(totals):
+  # The statistics in the format of statistics.json.
+  implementation_status_counts = dict(totals["statuses"])
+
+  # Re-label status an empty implementation status key as "Not specified"
+  if "" in implementation_status_counts:
+    implementation_status_counts["Not specified"] = implementation_status_counts.pop("")
+
+  return {
+    "control_count": len(totals["controls"]),
+    "control_part_count": totals["parts"],
+    "control_families_count": len(totals["families"]),
+    "total_words": totals["words"],
+    "average_words_per_controlpart": totals["words"] / (totals["parts"] or 1), # don't err if no controlimpls
+    "implementation_status_counts": implementation_status_counts,
+  }
+
+def get_component_statistics(component, standards=None):
+  # Return the statistics for a component, computing them from the
+  # component's data files if they aren't known.
+  key = (component["project"]["path"], component["id"])
+  with _lock:
+    if key in _statistics:
+      return get_statistics_json(_statistics[key])
+
+  # Each control's metadata, such as control family names, is loaded from
+  # standards.
+  if standards is None:
+    standards = opencontrol.load_project_standards(component["project"])
+  totals = compute_statistics(opencontrol.load_project_component_controls(component, standards))
+  with _lock:
+    _statistics[key] = totals
+    for fn in opencontrol.get_component_source_files(component):
+      _files.setdefault(fn, set()).add(key)
+    return get_statistics_json(totals)
+
+def apply_control_change(component, old, new):
+  # Adjust a component's totals for a narrative part that hyperGRC added or
+  # updated. This is registered as an opencontrol control listener.
+  key = (component["project"]["path"], component["id"])
+  with _lock:
+    if key not in _statistics:
+      return # not computed yet, so nothing to adjust
+  standards = opencontrol.load_project_standards(component["project"])
+  with _lock:
+    totals = _statistics.get(key)
+    if totals is None:
+      return
+    for part, sign in ((old, -1), (new, 1)):
+      if part:
+        add_part(totals,
+                 (part["standard"], part["control"]),
+                 opencontrol.get_control_family_id(part["standard"], part["control"], standards),
+                 part["narrative"],
+                 part["implementation_status"],
+                 sign)
+
+opencontrol.add_control_listener(apply_control_change)
+
+def forget_file(fn):
+  # Forget the totals for the components read from a file that was changed
+  # outside of hyperGRC, so that they are recomputed when next requested. A
+  # file we don't know about might be a new component file or a project file,
+  # so forget the totals for every component in the project that contains it.
+  # This is registered as a file watcher listener.
+  with _lock:
+    keys = _files.pop(fn, None)
+    if keys is None:
+      keys = {
+        key for key in _statistics
+        if os.path.abspath(fn).startswith(os.path.join(os.path.abspath(key[0]), ""))
+      }
+    for key in keys:
+      _statistics.pop(key, None)
+
+watcher.add_listener(forget_file)
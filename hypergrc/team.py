@@ -0,0 +1,96 @@
+# An index of each project's team (see opencontrol.load_project_teams) for
+# the team page and the team API.
+#
+# The index maps each member to the teams they are on and their roles, and
+# each role to the members who have it. Members are identified by email
+# address, or by name if they have no email address, and a member listed in
+# more than one team file is one member. A project's index is kept until one
+# of its team files changes, which is checked by file signature, so requests
+# don't parse YAML unless the team changed.
+
+import threading
+
+from . import opencontrol
+
+_lock = threading.Lock()
+_indexes = { } # project path => (team files, their signatures, index)
+
+def get_member_key(entry):
+  return (entry.get("email") or entry.get("name") or "").strip().lower()
+
+def build_index(project):
+  teams, source_files = opencontrol.load_project_teams(project)
+  index = {
+    "teams": [],
+    "members": { }, # member key => member
+    "roles": { }, # role => [member keys]
+    "by_name": { }, # lowercased name => [member keys]
+  }
+  for team in teams:
+    index["teams"].append({
+      "name": team["name"],
+      "source_file": team["source_file"],
+      "members": [
+        { "name": entry.get("name"), "email": entry.get("email"), "role": entry.get("role"), "key": get_member_key(entry) }
+        for entry in team["members"]
+      ],
+    })
+    for entry in team["members"]:
+      key = get_member_key(entry)
+      member = index["members"].get(key)
+      if member is None:
+        member = { "key": key, "name": entry.get("name"), "email": entry.get("email"), "roles": [], "teams": [] }
+        index["members"][key] = member
+        if member["name"]:
+          index["by_name"].setdefault(member["name"].strip().lower(), []).append(key)
+      if entry.get("role") and entry["role"] not in member["roles"]:
+        member["roles"].append(entry["role"])
+        index["roles"].setdefault(entry["role"], []).append(key)
+      if team["name"] not in member["teams"]:
+        member["teams"].append(team["name"])
+  return source_files, index
+
+def get_signatures(source_files):
+  signatures = []
+  for fn in source_files:
+    try:
+      signatures.append(opencontrol.get_file_signature(fn))
+    except OSError:
+      signatures.append(None)
+  return signatures
+
+def get_team_index(project):
+  # Return the project's team index. Raises ValueError if the project's team
+  # files can't be loaded.
+  with _lock:
+    cached = _indexes.get(project["path"])
+  if cached:
+    source_files, signatures, index = cached
+    if get_signatures(source_files) == signatures:
+      return index
+  source_files, index = build_index(project)
+  with _lock:
+    _indexes[project["path"]] = (source_files, get_signatures(source_files), index)
+  return index
+
+def find_members(index, name=None, email=None, role=None, team=None):
+  # Return the members matching all of the given criteria, looking members up
+  # by name, email address, or role through the index. Names and email
+  # addresses are matched without regard to case.
+  keys = None
+  def narrow(matches):
+    nonlocal keys
+    keys = [key for key in matches if keys is None or key in keys]
+  if email:
+    narrow([key for key in [email.strip().lower()] if key in index["members"]
+            and (index["members"][key]["email"] or "").lower() == key])
+  if name:
+    narrow(index["by_name"].get(name.strip().lower(), []))
+  if role:
+    narrow(index["roles"].get(role, []))
+  if keys is None:
+    keys = list(index["members"])
+  members = [index["members"][key] for key in keys]
+  if team:
+    members = [member for member in members if team in member["teams"]]
+  return members
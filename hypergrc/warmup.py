@@ -0,0 +1,129 @@
+# Load every project at startup so that the first request for each project
+# doesn't pay for parsing its data files.
+#
+# Projects are loaded in parallel on a pool of worker threads while the
+# server starts serving requests. Loading a project parses its system file,
+# its standards, certifications and crosswalks, and each of its components
+# and their included files, which fills opencontrol's file caches. A project
+# that fails to load is reported and the others are still loaded. Progress
+# is printed as each project finishes and is available from get_status, which
+# backs the /healthz/ready endpoint.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from . import opencontrol
+
+# The number of projects to load at once. Loading mostly waits on reading
+# files, so this is more than the number of CPUs.
+MAX_WORKERS = 8
+
+_lock = threading.Lock()
+_status = {
+  "state": "starting", # then "loading" and "ready"
+  "total": 0,
+  "loaded": 0,
+  "failed": 0,
+  "seconds": None,
+  "projects": { }, # project path => { "status", "seconds", "components", "error" }
+}
+
+def warm_project(project_dir):
+  # Load everything hyperGRC reads for a project. Returns the number of
+  # components loaded.
+  from . import crosswalk
+  project = opencontrol.load_project_from_path(project_dir)
+  standards = opencontrol.load_project_standards(project)
+  opencontrol.load_project_certified_controls(project)
+  crosswalk.get_project_crosswalk(project)
+  components = list(opencontrol.load_project_components(project))
+  for component in components:
+    for controlimpl in opencontrol.load_project_component_controls(component, standards):
+      pass
+    for evidence in opencontrol.load_project_component_evidence(component):
+      pass
+  return len(components)
+
+def warm_projects(project_dirs, verbose=True):
+  # Load the projects in parallel, recording each project's outcome and
+  # printing progress as each finishes.
+  start_time = time.time()
+  with _lock:
+    _status["total"] += len(project_dirs)
+
+  def warm(project_dir):
+    project_start_time = time.time()
+    try:
+      return { "status": "loaded", "components": warm_project(project_dir), "error": None,
+               "seconds": round(time.time() - project_start_time, 3) }
+    except Exception as e:
+      return { "status": "failed", "components": None, "error": str(e),
+               "seconds": round(time.time() - project_start_time, 3) }
+
+  with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    futures = { executor.submit(warm, project_dir): project_dir for project_dir in project_dirs }
+    for future in as_completed(futures):
+      project_dir = futures[future]
+      result = future.result()
+      with _lock:
+        _status["projects"][project_dir] = result
+        _status["loaded" if result["status"] == "loaded" else "failed"] += 1
+        done = _status["loaded"] + _status["failed"]
+      if verbose:
+        if result["status"] == "loaded":
+          print("[hyperGRC] loaded {} in {:.2f}s ({}/{})".format(project_dir, result["seconds"], done, _status["total"]))
+        else:
+          print("[hyperGRC] failed to load {}: {} ({}/{})".format(project_dir, result["error"], done, _status["total"]))
+
+  return time.time() - start_time
+
+def start(project_dirs, then=None):
+  # Load the projects in a background thread, and then call then.
+  with _lock:
+    _status["state"] = "loading"
+  project_dirs = list(project_dirs)
+
+  def run():
+    seconds = warm_projects(project_dirs)
+    with _lock:
+      _status["state"] = "ready"
+      _status["seconds"] = round(seconds, 3)
+    print("[hyperGRC] loading complete: {} projects loaded in {:.1f} seconds{}".format(
+      _status["loaded"], seconds,
+      ", {} failed".format(_status["failed"]) if _status["failed"] else ""))
+    if then:
+      then()
+
+  threading.Thread(target=run, name="hypergrc-warmup", daemon=True).start()
+
+def on_projects_changed(added, removed):
+  # Load projects added to the project list while running, and forget the
+  # status of removed ones. This is registered as a repos listener.
+  with _lock:
+    for project_dir in removed:
+      result = _status["projects"].pop(project_dir, None)
+      if result:
+        _status["total"] -= 1
+        _status["loaded" if result["status"] == "loaded" else "failed"] -= 1
+  if added:
+    threading.Thread(target=warm_projects, args=(added,), name="hypergrc-warmup", daemon=True).start()
+
+def is_ready():
+  return _status["state"] == "ready"
+
+def get_status(include_projects=False):
+  # Return the progress of loading. Each project's outcome is included only
+  # if include_projects is true, since there may be many projects, but the
+  # errors of projects that failed to load are always included.
+  with _lock:
+    status = dict(_status, ready=_status["state"] == "ready", errors={
+      project_dir: result["error"]
+      for project_dir, result in _status["projects"].items()
+      if result["status"] == "failed"
+    })
+    if include_projects:
+      status["projects"] = { project_dir: dict(result) for project_dir, result in _status["projects"].items() }
+    else:
+      del status["projects"]
+  return status
@@ -0,0 +1,161 @@
+# Watch the data files of the loaded projects for changes made outside of
+# hyperGRC, e.g. by a text editor or a `git pull`.
+#
+# A background thread polls the signatures (see opencontrol.get_file_signature)
+# of every file that hyperGRC reads for each project. When a file changes,
+# appears, or disappears, the watcher calls opencontrol.notify_file_changed so
+# that caches and indexes are updated just as they are after hyperGRC's own
+# writes, and then calls the watcher's own listeners, which are only told about
+# changes made outside of hyperGRC.
+#
+# Each project's list of files is kept between polls and is only listed again
+# when one of the project's files changes (which may add or remove files, e.g.
+# a component added to opencontrol.yaml) or the project is opened. A poll
+# stats every watched file, so with many projects the time between polls
+# grows to keep to STATS_PER_SECOND stats per second, unless an interval is
+# given with `--watch-interval`.
+
+import os.path
+import threading
+import time
+
+from . import opencontrol
+
+# The minimum seconds between polls.
+POLL_INTERVAL = 2.0
+
+# The most files to stat per second of time between polls.
+STATS_PER_SECOND = 2000
+
+_lock = threading.Lock()
+_signatures = { } # file path => signature, or None if the file does not exist
+_listeners = [ ]
+_extra_files = set() # other files to watch, see watch_file
+_project_files = { } # project directory => set of its files, or None to list them again
+_thread = None
+
+def add_listener(listener):
+  # Register a function to call with the path to a file that was changed
+  # outside of hyperGRC.
+  _listeners.append(listener)
+
+def watch_file(fn):
+  # Also watch a file that isn't a project data file, such as a listing file
+  # of repositories. Its changes are reported to the listeners too.
+  _extra_files.add(os.path.normpath(fn))
+
+def get_signature(fn):
+  try:
+    return opencontrol.get_file_signature(fn)
+  except OSError:
+    return None
+
+def record_change(fn):
+  # Remember the new signature of a file that hyperGRC changed so that the
+  # next poll doesn't report it, and list the files of its project again on
+  # the next poll. This is registered as an opencontrol change listener.
+  with _lock:
+    if fn in _signatures:
+      _signatures[fn] = get_signature(fn)
+    abs_fn = os.path.abspath(fn)
+    for project_dir in _project_files:
+      if abs_fn.startswith(os.path.join(os.path.abspath(project_dir), "")):
+        _project_files[project_dir] = None
+
+opencontrol.add_change_listener(record_change)
+
+def get_project_files(project_dir):
+  # Return the set of files to watch for a project. Projects that fail to
+  # load are watched by their system file only, so that fixing it is noticed.
+  files = { os.path.normpath(os.path.join(project_dir, "opencontrol.yaml")) }
+  try:
+    project = opencontrol.load_project_from_path(project_dir)
+    files.update(opencontrol.get_project_source_files(project))
+  except Exception:
+    pass
+  return files
+
+def get_watched_files(project_dirs):
+  # Return the set of files to watch for the projects, listing the files of
+  # projects that were opened or changed since the last poll.
+  project_dirs = list(project_dirs)
+  with _lock:
+    for project_dir in set(_project_files) - set(project_dirs):
+      del _project_files[project_dir]
+    stale = [project_dir for project_dir in project_dirs if _project_files.get(project_dir) is None]
+    # An empty set marks a project being listed. If one of its files changes
+    # while it is being listed, record_change sets it back to None.
+    for project_dir in stale:
+      _project_files[project_dir] = set()
+  for project_dir in stale:
+    files = get_project_files(project_dir)
+    with _lock:
+      if _project_files.get(project_dir) == set():
+        _project_files[project_dir] = files
+  with _lock:
+    files = set(_extra_files)
+    for project_files in _project_files.values():
+      files.update(project_files or ())
+  return files
+
+def poll(project_dirs):
+  # Check the files of the projects for changes and report them. Returns the
+  # list of changed files. Files seen for the first time are not reported.
+  changed = []
+
+  files = get_watched_files(project_dirs)
+  for fn in files | set(_signatures):
+    # Hold the file's lock (but only within this process) so that a write by
+    # hyperGRC isn't in progress while we compare signatures, and report the
+    # change before a write by hyperGRC can begin.
+    with opencontrol.get_file_lock(fn).thread_lock:
+      with _lock:
+        signature = get_signature(fn)
+        if fn not in _signatures:
+          _signatures[fn] = signature
+          continue
+        elif _signatures[fn] == signature:
+          continue
+        _signatures[fn] = signature
+      changed.append(fn)
+      opencontrol.notify_file_changed(fn)
+      for listener in _listeners:
+        try:
+          listener(fn)
+        except Exception:
+          import traceback
+          traceback.print_exc()
+
+  with _lock:
+    for fn in set(_signatures) - files:
+      if _signatures[fn] is None:
+        del _signatures[fn]
+
+  return changed
+
+def get_poll_interval():
+  # Return the seconds to wait until the next poll.
+  with _lock:
+    return max(POLL_INTERVAL, len(_signatures) / STATS_PER_SECOND)
+
+def start(project_dirs, interval=None):
+  # Start polling the projects' files in a background thread, every interval
+  # seconds, or by default every POLL_INTERVAL seconds or longer with many files.
+  global _thread
+  if _thread is not None:
+    return
+  poll(project_dirs) # record the initial signatures
+
+  def run():
+    while True:
+      time.sleep(interval or get_poll_interval())
+      try:
+        changed = poll(project_dirs)
+        if changed:
+          print("[hyperGRC] files changed outside of hyperGRC:", ", ".join(changed))
+      except Exception:
+        import traceback
+        traceback.print_exc()
+
+  _thread = threading.Thread(target=run, name="hypergrc-watcher", daemon=True)
+  _thread.start()
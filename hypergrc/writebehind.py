@@ -0,0 +1,144 @@
+# An optional write-behind queue for data files, enabled with
+# `--write-behind SECONDS`.
+#
+# Editors save a narrative each time the user finishes editing it, and each
+# save rewrites the narrative's source file. With the queue enabled,
+# opencontrol.write_file keeps a file's new content in memory instead (see
+# opencontrol.defer_write), where every read of the file sees it immediately,
+# and the file is written once no more changes have been made to it for
+# SECONDS, or at the latest MAX_DELAY_FACTOR times that long after its first
+# unwritten change. All of the changes made to a file in that window are
+# written together with one atomic write.
+#
+# Pending writes are flushed when hyperGRC exits, including when it is stopped
+# with SIGTERM. A change made outside of hyperGRC to a file that has unwritten
+# changes is overwritten when the file is flushed.
+
+import threading
+import time
+
+from . import opencontrol
+
+MAX_DELAY_FACTOR = 5
+
+_lock = threading.Condition()
+_window = None
+_pending = { } # file path => [time of first unwritten change, time of last change]
+_writing = set() # file paths being written
+_thread = None
+_stats = {
+  "changes": 0, # changes queued
+  "writes": 0, # files written
+  "failed_writes": 0,
+  "delay_seconds": 0.0, # total time from first unwritten change to write
+  "max_delay_seconds": 0.0,
+  "write_seconds": 0.0, # total time spent writing
+  "max_write_seconds": 0.0,
+}
+
+def is_enabled():
+  return _window is not None
+
+def queue_write(fn):
+  # Note a change to a file whose new content is in opencontrol._unflushed.
+  # This is called by opencontrol.write_file with the file's lock held.
+  now = time.time()
+  with _lock:
+    _pending.setdefault(fn, [now, now])[1] = now
+    _stats["changes"] += 1
+    _lock.notify_all()
+
+def get_due_time(times):
+  first, last = times
+  return min(last + _window, first + _window * MAX_DELAY_FACTOR)
+
+def flush_file(fn):
+  # Write a file's pending content now and record how long it took. Returns
+  # False if the write failed. While the file is being written it is in
+  # _writing, so that flush can wait for it.
+  with _lock:
+    times = _pending.pop(fn, None)
+    if times is None:
+      return True # already written
+    _writing.add(fn)
+  start_time = time.time()
+  try:
+    opencontrol.flush_file(fn)
+  except Exception:
+    # Keep the change queued so that it is tried again after another window.
+    import traceback
+    traceback.print_exc()
+    with _lock:
+      now = time.time()
+      _pending.setdefault(fn, [now, now])
+      _stats["failed_writes"] += 1
+      _writing.discard(fn)
+      _lock.notify_all()
+    return False
+  end_time = time.time()
+  with _lock:
+    _writing.discard(fn)
+    _lock.notify_all()
+    _stats["writes"] += 1
+    _stats["delay_seconds"] += end_time - times[0]
+    _stats["max_delay_seconds"] = max(_stats["max_delay_seconds"], end_time - times[0])
+    _stats["write_seconds"] += end_time - start_time
+    _stats["max_write_seconds"] = max(_stats["max_write_seconds"], end_time - start_time)
+  return True
+
+def flush():
+  # Write every pending change, including changes queued while flushing, so
+  # that nothing is left unwritten when this returns, unless writing fails.
+  # Files that the write-behind thread is in the middle of writing are waited
+  # for, since the thread is stopped without finishing when hyperGRC exits.
+  while True:
+    with _lock:
+      while _writing and not _pending:
+        _lock.wait()
+      files = list(_pending)
+    if not files:
+      return
+    if not any([flush_file(fn) for fn in files]):
+      print("[hyperGRC] could not write pending changes to:", ", ".join(files))
+      return
+
+def run():
+  # Write files as their changes become due.
+  while True:
+    with _lock:
+      now = time.time()
+      due = [fn for fn, times in _pending.items() if get_due_time(times) <= now]
+      if not due:
+        _lock.wait(min([get_due_time(times) for times in _pending.values()], default=now + 60) - now)
+        continue
+    for fn in due:
+      flush_file(fn)
+
+def enable(window):
+  # Start deferring writes, flushing them window seconds after a file's last
+  # change.
+  global _window, _thread
+  import atexit, signal, sys
+  _window = window
+  opencontrol.defer_write = queue_write
+
+  _thread = threading.Thread(target=run, name="hypergrc-write-behind", daemon=True)
+  _thread.start()
+
+  # Flush when the process exits normally, and turn SIGTERM into a normal exit.
+  atexit.register(flush)
+  def on_sigterm(signum, frame):
+    sys.exit(0)
+  signal.signal(signal.SIGTERM, on_sigterm)
+
+def get_stats():
+  with _lock:
+    stats = dict(_stats)
+    stats["pending_files"] = len(_pending)
+  return dict(stats,
+    enabled=is_enabled(),
+    window_seconds=_window,
+    coalescing_ratio=round(stats["changes"] / stats["writes"], 2) if stats["writes"] else None,
+    average_delay_seconds=round(stats["delay_seconds"] / stats["writes"], 4) if stats["writes"] else None,
+    average_write_seconds=round(stats["write_seconds"] / stats["writes"], 4) if stats["writes"] else None,
+  )
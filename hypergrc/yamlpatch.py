@@ -0,0 +1,153 @@
+# Targeted edits to YAML data files.
+#
+# Re-serializing a whole file to change one narrative costs a full parse and a
+# full dump, and rewrites parts of the file that didn't change (comments,
+# quoting, and line wrapping chosen by whoever wrote the file). Instead, we
+# compose the file, which gives the character span of every scalar without
+# constructing Python objects, find the narrative part being edited, and splice
+# the new values into the text in place of the old ones.
+#
+# Only edits that replace existing scalars are patched this way. When an edit
+# changes the structure of the file, e.g. when it adds or removes an
+# implementation_status key, or when the old value can't be replaced safely
+# (an anchor, alias, or tag, or a flow-style mapping), the patch functions
+# return None and the caller falls back to loading and dumping the whole file.
+
+import re
+
+import yaml
+import rtyaml
+
+try:
+  # Use the native code parser, if available, as rtyaml does.
+  from yaml import CSafeLoader as Loader
+except ImportError:
+  from yaml import SafeLoader as Loader
+
+def compose(text):
+  return yaml.compose(text, Loader=Loader)
+
+def construct(node):
+  # Return the Python value of a node. Most nodes are strings, which don't
+  # need a constructor.
+  if isinstance(node, yaml.ScalarNode) and node.tag == "tag:yaml.org,2002:str":
+    return node.value
+  return Loader("").construct_object(node, deep=True)
+
+def get_mapping_item(node, key):
+  # Return the (key node, value node) for a key in a mapping node, or
+  # (None, None) if the node isn't a mapping or doesn't have the key.
+  if isinstance(node, yaml.MappingNode):
+    for key_node, value_node in node.value:
+      if isinstance(key_node, yaml.ScalarNode) and construct(key_node) == key:
+        return key_node, value_node
+  return None, None
+
+def index_narrative_parts(root):
+  # Map each (standard key, control key, control part) in a composed component
+  # file to its narrative part's mapping node, matching entries the way
+  # opencontrol.index_narrative_parts does.
+  index = { }
+  satisfies = get_mapping_item(root, "satisfies")[1]
+  if not isinstance(satisfies, yaml.SequenceNode):
+    return index
+  for control in satisfies.value:
+    # Skip over entries that are strings -- they hold (OpenControl non-conformant) filenames.
+    if not isinstance(control, yaml.MappingNode):
+      continue
+    standard_key_node = get_mapping_item(control, "standard_key")[1]
+    control_key_node = get_mapping_item(control, "control_key")[1]
+    narrative = get_mapping_item(control, "narrative")[1]
+    if standard_key_node is None or control_key_node is None or not isinstance(narrative, yaml.SequenceNode):
+      continue
+    for narrative_part in narrative.value:
+      if isinstance(narrative_part, yaml.MappingNode):
+        key_node = get_mapping_item(narrative_part, "key")[1]
+        index.setdefault((construct(standard_key_node), construct(control_key_node), construct(key_node) if key_node is not None else None),
+                         narrative_part)
+  return index
+
+def format_scalar(key, value, column):
+  # Serialize value the way rtyaml would as the value of key in a block
+  # mapping whose keys are at the given column. Returns the text that goes
+  # after "key: ". Continuation lines (of block scalars and of wrapped plain
+  # scalars) are indented relative to the key.
+  text = rtyaml.dump({ key: value })
+  assert text.startswith(key + ": ") and text.endswith("\n")
+  lines = text[len(key)+2:-1].split("\n")
+  return "\n".join(
+    [lines[0]]
+    + [((" " * column + line) if line else line) for line in lines[1:]])
+
+def replace_scalar(text, key_node, value_node, key, value):
+  # Return a (start, end, replacement) splice that replaces a scalar value in
+  # text, or None if it can't be replaced safely.
+  if not isinstance(value_node, yaml.ScalarNode):
+    return None
+  start, end = value_node.start_mark.index, value_node.end_mark.index
+  if start == end or text[start] in "&*!":
+    # An empty (null) value, whose span has nowhere to put a space after the
+    # colon, or an anchor, alias, or tag.
+    return None
+
+  # Write line breaks the way the file does, so that a file with Windows
+  # line endings doesn't end up with mixed line endings.
+  replacement = format_scalar(key, value, key_node.start_mark.column)
+  if "\r\n" in text:
+    replacement = replacement.replace("\n", "\r\n")
+  old = text[start:end]
+  if old.endswith("\n"):
+    # Block scalars' spans include their final line break and any blank lines
+    # that follow. Keep them.
+    replacement += re.search(r"\r?\n([ \t]*\r?\n)*\Z", old).group(0)
+  elif "\n" in replacement and end < len(text) and text[end] not in "\r\n":
+    # A multi-line value would absorb what follows the old value on its line
+    # (like a comment).
+    return None
+  return (start, end, replacement)
+
+def patch_narrative_parts(text, edits):
+  # Replace the text and implementation status of narrative parts in the text
+  # of a component file. edits is a list of (standard key, control key, control
+  # part, narrative, implementation status) tuples. The file is composed once
+  # and all of the splices are applied together. Returns the new text and a
+  # list of the (old text, old implementation status) of each narrative part,
+  # or None if any of the narrative parts wasn't found or can't be edited in
+  # place.
+  try:
+    root = compose(text)
+  except yaml.YAMLError:
+    return None
+  narrative_parts = index_narrative_parts(root)
+
+  splices = []
+  old_values = []
+  for standard_key, control_key, control_part, narrative, implementation_status in edits:
+    narrative_part = narrative_parts.get((standard_key, control_key, control_part))
+    if narrative_part is None or narrative_part.flow_style:
+      return None
+
+    text_key_node, text_node = get_mapping_item(narrative_part, "text")
+    status_key_node, status_node = get_mapping_item(narrative_part, "implementation_status")
+    if text_node is None or (status_node is None) != (not implementation_status):
+      # Adding or removing a key changes the file's structure.
+      return None
+    old_narrative = construct(text_node)
+    old_status = construct(status_node) if status_node is not None else None
+    old_values.append((old_narrative, old_status))
+    if old_narrative != narrative:
+      splices.append(replace_scalar(text, text_key_node, text_node, "text", narrative))
+    if status_node is not None and old_status != implementation_status:
+      splices.append(replace_scalar(text, status_key_node, status_node, "implementation_status", implementation_status))
+  if None in splices:
+    return None
+
+  # Apply the splices in order in one pass over the text.
+  pieces = []
+  position = 0
+  for start, end, replacement in sorted(splices):
+    pieces.append(text[position:start])
+    pieces.append(replacement)
+    position = end
+  pieces.append(text[position:])
+  return "".join(pieces), old_values